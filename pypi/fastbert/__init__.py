@@ -7,4 +7,5 @@ sys.path.append(LIB_DIR)
 
 
 from .fastbert import FastBERT
+from .controller import SpeedController
 
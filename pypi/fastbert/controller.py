@@ -0,0 +1,167 @@
+# coding: utf-8
+"""
+Closed-loop speed controller for FastBERT.
+"""
+import time
+import threading
+import collections
+import numpy as np
+
+
+class SpeedController(object):
+
+    def __init__(self,
+                 model,
+                 target_latency=None,
+                 target_layers=None,
+                 **kwargs):
+        """
+        Wrap the batched inference of FastBERT, and scale the per-layer
+        thresholds according to the latency and exec layers observed recently.
+        The thresholds calibrated by model.calibrate are scaled, or the speed
+        if the model is not calibrated.
+
+        args:
+            model - FastBERT - the model for inference.
+            target_latency - float - the target p95 latency of a batch in seconds.
+            target_layers - float - the target average exec layers.
+            speed - float - the threshold of all layers if the model is not
+                calibrated, default 0.5.
+            scale - float - the initial scale of the thresholds, default 1.0.
+            min_scale - float - the lower bound of the scale, default 0.0.
+            max_scale - float - the upper bound of the scale, default 2.0.
+            step - float - the scale change of each adjustment, default 0.05.
+            window_size - int - the number of recent batches to be observed, default 100.
+            min_observations - int - the number of batches to be observed before
+                each adjustment, default 10.
+            tolerance - float - no adjustment if the observation is within
+                target * (1 +/- tolerance), default 0.1.
+        """
+        assert target_latency is not None or target_layers is not None, \
+                "target_latency or target_layers must be set."
+
+        self.model = model
+        self.target_latency = target_latency
+        self.target_layers = target_layers
+        self.speed = None if (model.thresholds >= 0).any().item() \
+                else kwargs.get('speed', 0.5)
+        self.scale = kwargs.get('scale', 1.0)
+        self.min_scale = kwargs.get('min_scale', 0.0)
+        self.max_scale = kwargs.get('max_scale', 2.0)
+        self.step = kwargs.get('step', 0.05)
+        self.window_size = kwargs.get('window_size', 100)
+        self.min_observations = kwargs.get('min_observations', 10)
+        self.tolerance = kwargs.get('tolerance', 0.1)
+
+        self.window = collections.deque(maxlen=self.window_size)
+        self.adjustments = collections.deque(maxlen=self.window_size)
+        self.batches_num = 0
+        self.samples_num = 0
+        self.adjustments_num = 0
+        self.lock = threading.Lock()
+
+    def __call__(self,
+                 sentences):
+        """
+        Predict labels for a batch of sentences with the current scale.
+
+        Input:
+            sentences - list - a list of input sentences.
+        Return:
+            labels - list - the predict labels.
+            exec_layer_nums - list - the number of the executed layers of each sentence.
+        """
+        scale = self.scale
+        start = time.perf_counter()
+        labels, exec_layer_nums = self.model.batch_forward(sentences,
+                speed=self.speed, threshold_scale=scale)
+        latency = time.perf_counter() - start
+
+        with self.lock:
+            self.window.append((latency, exec_layer_nums))
+            self.batches_num += 1
+            self.samples_num += len(sentences)
+            self._update()
+
+        return labels, exec_layer_nums
+
+    def stats(self):
+        """
+        Return the current state of the controller.
+
+        Return:
+            stats - dict - the scale, the scaled thresholds, the observations
+                in the window, and the recent adjustments.
+        """
+        with self.lock:
+            latencies, layers = self._observations()
+            layers_num = self.model.kernel.encoder.layers_num
+            exit_counts = np.bincount(layers, minlength=layers_num+1)[1:] \
+                    if len(layers) > 0 else np.zeros(layers_num, dtype=np.int64)
+            return {
+                'scale': self.scale,
+                'thresholds': self.model._exit_thresholds(self.speed, self.scale),
+                'target_latency': self.target_latency,
+                'target_layers': self.target_layers,
+                'batches_num': self.batches_num,
+                'samples_num': self.samples_num,
+                'adjustments_num': self.adjustments_num,
+                'window_batches_num': len(self.window),
+                'window_p95_latency': float(np.percentile(latencies, 95)) \
+                        if len(latencies) > 0 else None,
+                'window_ave_exec_layers': float(np.mean(layers)) \
+                        if len(layers) > 0 else None,
+                'window_exit_counts': exit_counts.tolist(),
+                'recent_adjustments': list(self.adjustments),
+            }
+
+    def _observations(self):
+        latencies = [latency for latency, _ in self.window]
+        layers = [l for _, exec_layer_nums in self.window for l in exec_layer_nums]
+        return np.array(latencies), np.array(layers, dtype=np.int64)
+
+    def _pressure(self,
+                  observation,
+                  target):
+        # +1 for running too slow, -1 for having room to be more accurate
+        if target is None:
+            return None
+        if observation > target * (1 + self.tolerance):
+            return 1
+        if observation < target * (1 - self.tolerance):
+            return -1
+        return 0
+
+    def _update(self):
+        if len(self.window) < self.min_observations:
+            return
+
+        latencies, layers = self._observations()
+        p95_latency = float(np.percentile(latencies, 95))
+        ave_layers = float(np.mean(layers))
+        pressures = [p for p in [
+                self._pressure(p95_latency, self.target_latency),
+                self._pressure(ave_layers, self.target_layers)
+            ] if p is not None]
+
+        # raise the thresholds if any target is missed,
+        # lower them only if all targets are met
+        if max(pressures) > 0:
+            new_scale = min(self.scale + self.step, self.max_scale)
+        elif max(pressures) < 0:
+            new_scale = max(self.scale - self.step, self.min_scale)
+        else:
+            new_scale = self.scale
+
+        if new_scale != self.scale:
+            self.adjustments.append({
+                'time': time.time(),
+                'old_scale': self.scale,
+                'new_scale': new_scale,
+                'p95_latency': p95_latency,
+                'ave_exec_layers': ave_layers,
+            })
+            self.adjustments_num += 1
+            self.scale = new_scale
+            # the observations under the old scale are outdated
+            self.window.clear()
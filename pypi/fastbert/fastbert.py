@@ -4,15 +4,23 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import random
+import time
 from .config import *
 from .utils import *
 from .uer.utils.tokenizer import BertTokenizer
-from .uer.utils.vocab import Vocab
+from .uer.utils.vocab import load_vocab
 from .uer.model_builder import build_model
 from .uer.utils.optimizers import AdamW, WarmupLinearSchedule
 from .uer.layers.multi_headed_attn import MultiHeadedAttention
 from .uer.model_saver import save_model
 from .uer.model_loader import load_model
+from .uer.utils.checkpoint import save_flat_state_dict, materialize_meta
+from .uer.utils.calibration import calibrate_thresholds, select_exit_layers
+from .uer.utils.exit_stats import ExitStats
+from .uer.utils.flops import FLOPS_ENCODERS, fastbert_flops
+from .uer.utils.misc import select_state
+from .uer.utils.token_pruning import keep_ratio_schedule, scheduled_lengths, prune_tokens
+from .uer.utils.precision import check_precision, autocast, grad_scaler, backward, optimizer_step
 
 
 class MiniClassifier(nn.Module):
@@ -35,7 +43,12 @@ class MiniClassifier(nn.Module):
     def forward(self, hidden, mask):
 
         hidden = torch.tanh(self.output_layer_0(hidden))
-        hidden = self.self_atten(hidden, hidden, hidden, mask)
+        if self.pooling not in ["mean", "max", "last"]:
+            # Only the first position is pooled, so attention is
+            # computed for its query alone.
+            hidden = self.self_atten(hidden, hidden, hidden[:, :1, :], mask[:, :, :1, :])
+        else:
+            hidden = self.self_atten(hidden, hidden, hidden, mask)
 
         if self.pooling == "mean":
             hidden = torch.mean(hidden, dim=-1)
@@ -47,7 +60,8 @@ class MiniClassifier(nn.Module):
             hidden = hidden[:, 0, :]
 
         output_1 = torch.tanh(self.output_layer_1(hidden))
-        logits = self.output_layer_2(output_1)
+        # losses, softmax and uncertainty are computed from float32 logits under autocast
+        logits = self.output_layer_2(output_1).float()
         return logits
 
 
@@ -66,6 +80,31 @@ class FastBERT(nn.Module):
             labels - list - a list containg all the labels.
             seq_length - int - the sentence length for FastBERT, default 128.
             device - str - 'cpu', 'cuda:0', 'cuda:1', etc.
+            exit_layers - list - the layers (starting from 1) where samples
+                are allowed to exit, default all layers. The classifiers of
+                the other layers are skipped at inference.
+            layer_timing - bool - whether to record the wall time of each
+                layer in exit_stats, default False. It synchronizes CUDA
+                after every layer.
+            verify_in_background - bool - verify the md5 of the pretrained
+                kernel in a background thread instead of before loading it,
+                default False. Once the check fails, inference and training
+                raise an error. Files verified before are not hashed again
+                unless they are modified.
+            flat_kernel_cache - bool - cache a flat copy of the pretrained
+                kernel beside it, which is memory-mapped at later startups
+                instead of being unpickled, default False. It takes as much
+                disk space as the kernel, and is only written once the
+                kernel has passed the md5 check.
+            keep_ratio - float - ratio of the tokens kept after each layer
+                at inference, default 1.0 (no pruning). The tokens receiving
+                the least attention from [CLS] are pruned.
+            prune_start_layer - int - the first layer (starting from 1)
+                after which tokens are pruned, default 1.
+            precision - str - precision of the forward passes in training
+                and inference, 'fp32' (default), 'bf16' or 'fp16'. bf16 runs
+                on CPU and CUDA, fp16 on CUDA only with gradient scaling.
+                The parameters are kept in fp32.
         """
         super(FastBERT, self).__init__()
         assert kernel_name in MODEL_CONFIG_FILE.keys(), \
@@ -75,6 +114,8 @@ class FastBERT(nn.Module):
                 file_dir=FILES_DIR)
         self.args.seq_length = kwargs.get('seq_length', DEFAULT_SEQ_LENGTH)
         self.args.device = torch.device(kwargs.get('device', DEFAULT_DEVICE))
+        self.precision = kwargs.get('precision', 'fp32')
+        check_precision(self.precision, self.args.device)
 
         assert isinstance(labels, list), "labels must be a list."
         self.label_map = {k: v for v, k in enumerate(labels)}
@@ -82,8 +123,7 @@ class FastBERT(nn.Module):
         self.labels_num = len(labels)
 
         # create vocab
-        self.vocab = Vocab()
-        self.vocab.load(self.args.vocab_path, is_quiet=True)
+        self.vocab = load_vocab(self.args.vocab_path, is_quiet=True)
         self.args.vocab = self.vocab
         self.cls_id = self.vocab.get('[CLS]')
         self.pad_id = self.vocab.get('[PAD]')
@@ -92,17 +132,21 @@ class FastBERT(nn.Module):
         self.tokenizer = BertTokenizer(self.args)
 
         # create kernel
-        self.args.target = 'bert'
+        self.args.target = 'none'
         self.args.subword_type = 'none'
-        self.kernel = build_model(self.args)
-        check_or_download(
+        self.kernel = build_model(self.args, meta=True)
+        checking = check_or_download(
                 self.args.pretrained_model_path,
                 self.args.pretrained_model_url, 
                 self.args.pretrained_model_md5,
                 kernel_name,
-                self.args.pretrained_model_url_bak)
-        self.kernel.load_state_dict(
-                torch.load(self.args.pretrained_model_path),strict=False)
+                self.args.pretrained_model_url_bak,
+                background=kwargs.get('verify_in_background', False))
+        # the kernel file checked in background, None if it is verified
+        self.checking_kernel_path = self.args.pretrained_model_path if checking else None
+        self._load_kernel(self.args.pretrained_model_path,
+                          kwargs.get('flat_kernel_cache', False))
+        materialize_meta(self.kernel)
 
         # create teacher and student classifiers
         self.classifiers = nn.ModuleList([
@@ -110,6 +154,30 @@ class FastBERT(nn.Module):
             for i in range(self.kernel.encoder.layers_num)
          ])
 
+        # per-layer thresholds, negative values mean not calibrated
+        self.register_buffer('thresholds', 
+                torch.full((self.kernel.encoder.layers_num, ), -1.0))
+
+        # layers where samples are allowed to exit
+        self.register_buffer('exit_layers', 
+                torch.ones(self.kernel.encoder.layers_num, dtype=torch.bool))
+        if kwargs.get('exit_layers') is not None:
+            self._set_exit_layers(kwargs['exit_layers'])
+
+        # early exit statistics of inference
+        self.exit_stats = ExitStats(self.kernel.encoder.layers_num, labels)
+        self.layer_timing = kwargs.get('layer_timing', False)
+
+        # ratio of the tokens kept after each layer at inference
+        self.keep_ratios = keep_ratio_schedule(
+                self.kernel.encoder.layers_num,
+                kwargs.get('keep_ratio', 1.0),
+                kwargs.get('prune_start_layer', 1))
+        self.pruning = min(self.keep_ratios) < 1.0
+        if self.pruning:
+            assert self.args.encoder == 'bert', \
+                    "token pruning is only supported by the bert encoder."
+
         # create loss
         self.softmax = nn.LogSoftmax(dim=-1)
         self.criterion = nn.NLLLoss()
@@ -140,6 +208,7 @@ class FastBERT(nn.Module):
             dev_speed - float - the speed for evaluating in the self-distilling process.
             model_saving_path - str - the path to saving model.
         """
+        self._check_kernel()
         if verbose:
             print("[FastBERT]: Training FastBERT")
 
@@ -170,23 +239,264 @@ class FastBERT(nn.Module):
         if verbose:
             print("[FastBERT]: Model have been saved at {}".format(model_saving_path))
 
+        # the evaluations during training are not counted
+        self.exit_stats.reset()
+
     def forward(self,
                 sentence,
-                speed=0.0):
+                speed=None):
         """
         Predict labels for the input sentence.
 
         Input:
             sentence - str - the input sentence.
-            speed - float - the speed value (0.0~1.0)
+            speed - float - the speed value (0.0~1.0), use the calibrated
+                per-layer thresholds if None, or 0.0 if not calibrated.
         Return:
             label - str/int - the predict label.
             exec_layer_num - int - the number of the executed layers.
         """
-        label_id, exec_layer_num = self._fast_infer(sentence, speed)
-        label = self.id2label[label_id]
+        label, exec_layer_num = self._fast_infer(sentence, speed)
         return label, exec_layer_num
 
+    def batch_forward(self,
+                      sentences,
+                      speed=None,
+                      threshold_scale=1.0):
+        """
+        Predict labels for a batch of sentences, easy sentences exit early
+        and the rest of the batch continues to the deeper layers.
+
+        Input:
+            sentences - list - a list of input sentences.
+            speed - float - the speed value (0.0~1.0), use the calibrated
+                per-layer thresholds if None, or 0.0 if not calibrated.
+            threshold_scale - float - the threshold of each layer is multiplied
+                by this factor (capped at 1.0), more samples exit early if > 1.0.
+        Return:
+            labels - list - the predict labels.
+            exec_layer_nums - list - the number of the executed layers of each sentence.
+        """
+        labels, exec_layer_nums = self._batch_fast_infer(sentences, speed, threshold_scale)
+        return labels, exec_layer_nums
+
+    def chunked_forward(self,
+                        sentences,
+                        speed=None,
+                        stride=None,
+                        aggregation='max_confidence',
+                        decided_uncertainty=None,
+                        batch_size=None):
+        """
+        Predict labels for sentences longer than seq_length. Each sentence
+        is split into overlapping windows, and the windows of all sentences
+        are batched together with early exit. The predictions of the windows
+        of a sentence are aggregated.
+
+        Input:
+            sentences - list - a list of input sentences.
+            speed - float - the speed value (0.0~1.0), use the calibrated
+                per-layer thresholds if None, or 0.0 if not calibrated.
+            stride - int - the distance between the starts of two windows,
+                default half of the window length (seq_length - 1).
+            aggregation - str - 'max_confidence' takes the prediction of the
+                window with the lowest uncertainty, 'mean_prob' averages the
+                probabilities of the windows.
+            decided_uncertainty - float - if given, the windows are run
+                window by window, and the rest windows of a sentence are skipped
+                once its aggregated uncertainty is below this value.
+            batch_size - int - the maximum number of windows in a batch,
+                default all windows in one batch.
+        Return:
+            labels - list - the predict labels.
+            exec_layer_nums - list - the total number of the executed
+                layers over the windows of each sentence.
+        """
+        assert aggregation in ['max_confidence', 'mean_prob'], \
+                "aggregation must be 'max_confidence' or 'mean_prob'."
+        if stride is None:
+            stride = max(1, (self.args.seq_length - 1) // 2)
+        windows = [self._convert_to_windows(sentence, stride) for sentence in sentences]
+
+        sentences_num = len(sentences)
+        probs_sum = torch.zeros(sentences_num, self.labels_num)
+        windows_num = torch.zeros(sentences_num, 1)
+        best_probs = torch.zeros(sentences_num, self.labels_num)
+        best_uncertainties = torch.full((sentences_num, ), float('inf'))
+        exec_layer_nums = [0] * sentences_num
+        decided = [False] * sentences_num
+
+        # all windows in one round, or the j-th windows in round j
+        if decided_uncertainty is None:
+            rounds = [[(i, window) for i in range(sentences_num) for window in windows[i]]]
+        else:
+            rounds = [[(i, windows[i][j]) for i in range(sentences_num) if j < len(windows[i])] \
+                    for j in range(max(len(w) for w in windows))] if sentences_num > 0 else []
+
+        for entries in rounds:
+            entries = [(i, window) for i, window in entries if not decided[i]]
+            step = batch_size if batch_size is not None else max(len(entries), 1)
+            for start in range(0, len(entries), step):
+                batch = entries[start: start + step]
+                ids_batch = torch.tensor([window[0] for _, window in batch],
+                        dtype=torch.int64, device=self.args.device)
+                masks_batch = torch.tensor([window[1] for _, window in batch],
+                        dtype=torch.int64, device=self.args.device)
+                probs_batch, exec_layers = self._fast_infer_tensors(ids_batch, masks_batch, speed)
+                probs_batch = probs_batch.cpu()
+                uncertainties = calc_uncertainty(probs_batch, labels_num=self.labels_num).tolist()
+                exec_layers = exec_layers.tolist()
+                for j, (i, _) in enumerate(batch):
+                    probs_sum[i] += probs_batch[j]
+                    windows_num[i] += 1
+                    exec_layer_nums[i] += exec_layers[j]
+                    if uncertainties[j] < best_uncertainties[i]:
+                        best_uncertainties[i] = uncertainties[j]
+                        best_probs[i] = probs_batch[j]
+
+            if decided_uncertainty is not None:
+                for i in set(i for i, _ in entries):
+                    if aggregation == 'max_confidence':
+                        uncertainty = best_uncertainties[i].item()
+                    else:
+                        uncertainty = calc_uncertainty(probs_sum[i: i + 1] / windows_num[i],
+                                labels_num=self.labels_num).item()
+                    decided[i] = uncertainty <= decided_uncertainty
+
+        if aggregation == 'max_confidence':
+            probs = best_probs
+        else:
+            probs = probs_sum / windows_num.clamp(min=1)
+        label_ids = torch.argmax(probs, dim=1).tolist()
+        labels = [self.id2label[label_id] for label_id in label_ids]
+        return labels, exec_layer_nums
+
+    def calibrate(self,
+                  sentences_dev,
+                  labels_dev,
+                  acc_floor=None,
+                  layers_budget=None,
+                  batch_size=16,
+                  verbose=True):
+        """
+        Fit a separate uncertainty threshold for each layer on the dev set.
+        The thresholds are saved with the model and used when speed is None.
+
+        Input:
+            sentences_dev - list - a list of validation sentences.
+            labels_dev - list - a list of validation labels.
+            acc_floor - float - minimize the exec layers while keeping
+                the accuracy above this floor.
+            layers_budget - float - maximize the accuracy while keeping
+                the average exec layers within this budget.
+            batch_size - int - batch size for running the dev set.
+        Return:
+            thresholds - list - the threshold of each layer.
+        """
+        if verbose:
+            print("[FastBERT]: Calibrating per-layer thresholds on {} samples.".\
+                    format(len(sentences_dev)))
+
+        self.eval()
+        uncertainties, corrects = [], []
+        with torch.no_grad(), self._autocast():
+            for start in range(0, len(sentences_dev), batch_size):
+                sentences_batch = sentences_dev[start: start+batch_size]
+                labels_batch = labels_dev[start: start+batch_size]
+                label_ids_batch = torch.tensor(
+                        [self.label_map[label] for label in labels_batch],
+                        dtype=torch.int64, device=self.args.device)
+                probs = F.softmax(self._layer_logits(sentences_batch), dim=-1)  # batch_size x layers_num x labels_num
+                uncertainties.append(calc_uncertainty(probs, \
+                        labels_num=self.labels_num).cpu())
+                corrects.append((torch.argmax(probs, dim=-1) == \
+                        label_ids_batch.unsqueeze(1)).cpu())
+
+        thresholds = calibrate_thresholds(
+                torch.cat(uncertainties).numpy(),
+                torch.cat(corrects).numpy(),
+                acc_floor=acc_floor,
+                layers_budget=layers_budget,
+                exit_mask=self.exit_layers.cpu().numpy())
+        self.thresholds.copy_(torch.from_numpy(thresholds))
+
+        if verbose:
+            print("[FastBERT]: Per-layer thresholds: {}".format(
+                ", ".join("{:.2f}".format(t) for t in thresholds)))
+        return thresholds.tolist()
+
+    def select_exit_layers(self,
+                           sentences_dev,
+                           min_exit_rate,
+                           speed=None,
+                           batch_size=16,
+                           verbose=True):
+        """
+        Only keep the layers where at least min_exit_rate of the dev
+        samples exit, the classifiers of the other layers are skipped
+        at inference. The exit layers are saved with the model.
+
+        Input:
+            sentences_dev - list - a list of validation sentences.
+            min_exit_rate - float - the lowest exit rate of a kept layer.
+            speed - float - the speed for measuring the exit rates, use the
+                calibrated per-layer thresholds if None.
+            batch_size - int - batch size for running the dev set.
+        Return:
+            exit_layers - list - the kept layers (starting from 1).
+        """
+        self.eval()
+        uncertainties = []
+        with torch.no_grad(), self._autocast():
+            for start in range(0, len(sentences_dev), batch_size):
+                sentences_batch = sentences_dev[start: start+batch_size]
+                probs = F.softmax(self._layer_logits(sentences_batch), dim=-1)  # batch_size x layers_num x labels_num
+                uncertainties.append(calc_uncertainty(probs, \
+                        labels_num=self.labels_num).cpu())
+
+        layers_num = self.kernel.encoder.layers_num
+        thresholds = self._exit_thresholds(speed)
+        exit_mask = select_exit_layers(
+                torch.cat(uncertainties).numpy(),
+                thresholds,
+                min_exit_rate,
+                exit_mask=self.exit_layers.cpu().numpy())
+        exit_layers = [i + 1 for i in range(layers_num) if exit_mask[i]]
+        self._set_exit_layers(exit_layers)
+
+        if verbose:
+            print("[FastBERT]: Exit layers: {}".format(exit_layers))
+        return exit_layers
+
+    def flops(self,
+              exec_layer_nums,
+              sentences=None):
+        """
+        Compute the FLOPs of each sentence analytically from the number of
+        its executed layers, e.g., those returned by batch_forward.
+
+        Input:
+            exec_layer_nums - list - the number of executed layers of each sentence.
+            sentences - list - the sentences, whose lengths give the number
+                of tokens kept by token pruning. Without them, no sentence
+                is assumed to be shorter than seq_length.
+        Return:
+            flops - list - the FLOPs of each sentence.
+        """
+        assert self.args.encoder in FLOPS_ENCODERS, \
+                "FLOPs are only counted for the {} encoders.".format("/".join(FLOPS_ENCODERS))
+        lengths = None
+        if sentences is not None:
+            lengths = [sum(self._convert_to_id_and_mask(sentence)[1]) \
+                    for sentence in sentences]
+        flops = fastbert_flops(
+                scheduled_lengths(self.args.seq_length, self.keep_ratios, lengths),
+                exec_layer_nums,
+                self.args,
+                self.labels_num,
+                exit_mask=self.exit_layers.cpu().numpy())
+        return flops.tolist()
+
     def load_model(self,
                    model_path):
         """
@@ -196,16 +506,21 @@ class FastBERT(nn.Module):
             sentence - str - the path of model file.
         """
         load_model(self, model_path)
+        # the weights of the pretrained kernel are replaced
+        self.checking_kernel_path = None
 
     def save_model(self,
-                   model_path):
+                   model_path,
+                   flat=False):
         """
         Saving model to the specified path.
 
         Input:
             sentence - str - the path of model file.
+            flat - bool - save in the flat format, which is memory-mapped
+                by load_model without copying the weights.
         """
-        save_model(self, model_path)
+        save_model(self, model_path, flat=flat)
 
     def to_device(self,
                   device):
@@ -215,21 +530,48 @@ class FastBERT(nn.Module):
         Input:
             device - str - 'cpu', 'cuda:0', 'cuda:1', etc.
         """
+        check_precision(self.precision, device)
         self.args.device = torch.device(device)
         self.to(self.args.device)
 
+    def _load_kernel(self,
+                     kernel_path,
+                     flat_kernel_cache=False):
+        # with flat_kernel_cache, a flat copy of the kernel is cached beside it,
+        # so that later startups memory-map the weights instead of unpickling them
+        flat_kernel_path = kernel_path + '.flat'
+        if not flat_kernel_cache:
+            load_model(self.kernel, kernel_path)
+            return
+        if not os.path.exists(flat_kernel_path) or \
+                os.path.getmtime(flat_kernel_path) < os.path.getmtime(kernel_path):
+            # the kernel is converted only once its md5 is verified, it is
+            # not stamped yet if it is still being verified in background
+            if not is_stamped(kernel_path, self.args.pretrained_model_md5):
+                load_model(self.kernel, kernel_path)
+                return
+            try:
+                save_flat_state_dict(
+                        torch.load(kernel_path, map_location='cpu'), flat_kernel_path)
+            except OSError:
+                load_model(self.kernel, kernel_path)
+                return
+        load_model(self.kernel, flat_kernel_path)
+
     def _fast_infer(self,
                     sentence,
                     speed):
+        self._check_kernel()
         ids, mask = self._convert_to_id_and_mask(sentence)
 
         self.eval()
-        with torch.no_grad():
+        with torch.no_grad(), self._autocast():
             ids = torch.tensor([ids], dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
             mask = torch.tensor([mask], dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
 
             # embedding layer
             emb = self.kernel.embedding(ids, mask)  # batch_size x seq_length x emb_size
+            state = self._init_layer_state(emb, mask)
             mask = (mask > 0).unsqueeze(1).repeat(1, self.args.seq_length, 1).\
                     unsqueeze(1)
             mask = (1.0 - mask.float()) * -10000.0  # batch_size x seq_length x seq_length
@@ -237,36 +579,216 @@ class FastBERT(nn.Module):
             # hidden layers
             hidden = emb
             exec_layer_num = self.kernel.encoder.layers_num
+            thresholds, exit_layers = self._exit_thresholds(speed), self.exit_layers.tolist()
             for i in range(self.kernel.encoder.layers_num):
-                hidden = self.kernel.encoder.transformer[i](hidden, mask) # batch_size x seq_length x seq_length
+                start = self._clock()
+                hidden, attn_probs = self._layer_forward(i, hidden, state) # batch_size x seq_length x hidden_size
+                if not exit_layers[i]:
+                    self.exit_stats.record_layer(i, 1, self._elapsed(start))
+                    hidden, mask = self._prune_tokens(i, hidden, mask, state, attn_probs)
+                    continue
                 logits = self.classifiers[i](hidden, mask)  # batch_size x labels_num
                 probs = F.softmax(logits, dim=1) # batch_size x labels_num
                 uncertainty = calc_uncertainty(probs, \
                         labels_num=self.labels_num).item()
+                self.exit_stats.record_layer(i, 1, self._elapsed(start), [uncertainty])
                 
-                if uncertainty < speed:
+                if uncertainty <= thresholds[i]:
                     exec_layer_num = i + 1
                     break
+                hidden, mask = self._prune_tokens(i, hidden, mask, state, attn_probs)
                 
         label_id = torch.argmax(probs, dim=1).item()
         label = self.id2label[label_id]
+        self.exit_stats.record_exits(exec_layer_num - 1, [label_id])
         return label, exec_layer_num
 
+    def _batch_fast_infer(self,
+                          sentences_batch,
+                          speed,
+                          threshold_scale=1.0):
+        ids_batch, masks_batch = self._convert_to_tensors(sentences_batch)
+        probs_batch, exec_layers = self._fast_infer_tensors(ids_batch, masks_batch, speed,
+                threshold_scale)
+        label_ids = torch.argmax(probs_batch, dim=1).tolist()
+        labels = [self.id2label[label_id] for label_id in label_ids]
+        return labels, exec_layers.tolist()
+
+    def _fast_infer_tensors(self,
+                            ids_batch,
+                            masks_batch,
+                            speed,
+                            threshold_scale=1.0):
+        self._check_kernel()
+        self.eval()
+        with torch.no_grad(), self._autocast():
+            batch_size = ids_batch.size(0)
+
+            # embedding layer
+            embs_batch = self.kernel.embedding(ids_batch, masks_batch)  # batch_size x seq_length x emb_size
+            states_batch = self._init_layer_state(embs_batch, masks_batch)
+            masks_batch = (masks_batch > 0).unsqueeze(1).repeat(1, self.args.seq_length, 1).\
+                    unsqueeze(1)
+            masks_batch = (1.0 - masks_batch.float()) * -10000.0  # batch_size x seq_length x seq_length
+
+            # hidden layers, the exited samples are removed from the batch
+            hiddens_batch = embs_batch
+            probs_batch = torch.zeros(batch_size, self.labels_num, device=self.args.device)
+            exec_layers = torch.full((batch_size, ), self.kernel.encoder.layers_num, 
+                    dtype=torch.int64, device=self.args.device)
+            idxs = torch.arange(batch_size, device=self.args.device)
+            thresholds = self._exit_thresholds(speed, threshold_scale)
+            exit_layers = self.exit_layers.tolist()
+            for i in range(self.kernel.encoder.layers_num):
+                start = self._clock()
+                hiddens_batch, attn_probs = self._layer_forward(i, hiddens_batch, states_batch)
+                if not exit_layers[i]:
+                    self.exit_stats.record_layer(i, idxs.size(0), self._elapsed(start))
+                    hiddens_batch, masks_batch = self._prune_tokens(
+                            i, hiddens_batch, masks_batch, states_batch, attn_probs)
+                    continue
+                logits = self.classifiers[i](hiddens_batch, masks_batch)  # remain_num x labels_num
+                probs = F.softmax(logits, dim=1)
+                probs_batch[idxs] = probs
+                uncertainties = calc_uncertainty(probs, labels_num=self.labels_num)
+                self.exit_stats.record_layer(i, idxs.size(0), self._elapsed(start),
+                        uncertainties.cpu().numpy())
+
+                exits = uncertainties <= thresholds[i]
+                if i == self.kernel.encoder.layers_num - 1:
+                    exits = torch.ones_like(exits)
+                self.exit_stats.record_exits(i, 
+                        torch.argmax(probs[exits], dim=1).cpu().numpy())
+                exec_layers[idxs[exits]] = i + 1
+                remains = ~exits
+                idxs = idxs[remains]
+                hiddens_batch = hiddens_batch[remains]
+                masks_batch = masks_batch[remains]
+                states_batch = select_state(states_batch, remains)
+                if idxs.size(0) == 0:
+                    break
+                if attn_probs is not None:
+                    attn_probs = attn_probs[remains]
+                hiddens_batch, masks_batch = self._prune_tokens(
+                        i, hiddens_batch, masks_batch, states_batch, attn_probs)
+
+        return probs_batch, exec_layers
+
+    def _init_layer_state(self,
+                          embs_batch,
+                          masks_batch):
+        states_batch = self.kernel.encoder.init_layer_state(embs_batch, masks_batch)
+        if self.pruning and not self.training:
+            # positions of the tokens, updated as tokens are pruned
+            states_batch['valid'] = masks_batch > 0
+        return states_batch
+
+    def _layer_forward(self,
+                       i,
+                       hiddens_batch,
+                       states_batch):
+        # the attention probabilities are needed only if tokens are pruned after this layer
+        if self.training or self.keep_ratios[i] >= 1.0:
+            return self.kernel.encoder.layer_forward(i, hiddens_batch, states_batch), None
+        return self.kernel.encoder.layer_forward(
+                i, hiddens_batch, states_batch, return_probs=True)
+
+    def _prune_tokens(self,
+                      i,
+                      hiddens_batch,
+                      masks_batch,
+                      states_batch,
+                      attn_probs):
+        # return the pruned hidden states and their mask, or the given ones if not pruned
+        if attn_probs is None:
+            return hiddens_batch, masks_batch
+        hiddens_batch, states_batch['valid'], states_batch['mask'] = prune_tokens(
+                hiddens_batch, attn_probs, states_batch['valid'], self.keep_ratios[i])
+        return hiddens_batch, states_batch['mask']
+
+    def _autocast(self):
+        # run the enclosed forward in self.precision
+        return autocast(self.args.device, self.precision)
+
+    def _clock(self):
+        if not self.layer_timing:
+            return None
+        # wait for the queued kernels so that the wall time is per layer
+        if self.args.device.type == 'cuda':
+            torch.cuda.synchronize(self.args.device)
+        return time.perf_counter()
+
+    def _elapsed(self,
+                 start):
+        if start is None:
+            return None
+        return self._clock() - start
+
+    def _set_exit_layers(self,
+                         exit_layers):
+        # the last layer is always an exit layer
+        self.exit_layers.fill_(False)
+        self.exit_layers[[l - 1 for l in exit_layers]] = True
+        self.exit_layers[-1] = True
+
+    def _check_kernel(self):
+        # raise once the background md5 check of the kernel has failed,
+        # the check is not waited for if it is still running
+        if self.checking_kernel_path is None:
+            return
+        verified = background_check(self.checking_kernel_path)
+        if verified is None:
+            return
+        if not verified:
+            raise Exception("[Error]: md5 of the pretrained kernel {} is wrong, ".format(
+                self.checking_kernel_path) + "the model may be broken. Please remove the file and restart.")
+        self.checking_kernel_path = None
+
+    def _exit_thresholds(self,
+                         speed,
+                         threshold_scale=1.0):
+        # the threshold of each layer on the host, read once instead of
+        # syncing the device at every layer, a sample exits if its
+        # uncertainty is at or below the threshold
+        if speed is not None:
+            thresholds = [speed] * self.kernel.encoder.layers_num
+        else:
+            thresholds = [t if t >= 0 else 0.0 for t in self.thresholds.tolist()]
+        if threshold_scale != 1.0:
+            thresholds = [min(t * threshold_scale, 1.0) for t in thresholds]
+        return thresholds
+
+    def _layer_logits(self,
+                      sentences_batch):
+        ids_batch, masks_batch = self._convert_to_tensors(sentences_batch)
+
+        # embedding layer
+        embs_batch = self.kernel.embedding(ids_batch, masks_batch)  # batch_size x seq_length x emb_size
+        states_batch = self._init_layer_state(embs_batch, masks_batch)
+        masks_batch = (masks_batch > 0).unsqueeze(1).repeat(1, self.args.seq_length, 1).\
+                 unsqueeze(1)
+        masks_batch = (1.0 - masks_batch.float()) * -10000.0  # batch_size x seq_length x seq_length
+
+        # run all layers and all classifiers
+        hiddens_batch = embs_batch
+        logits_batch = []
+        for i in range(self.kernel.encoder.layers_num):
+            hiddens_batch, attn_probs = self._layer_forward(i, hiddens_batch, states_batch)
+            logits_batch.append(self.classifiers[i](hiddens_batch, masks_batch))
+            hiddens_batch, masks_batch = self._prune_tokens(
+                    i, hiddens_batch, masks_batch, states_batch, attn_probs)
+        return torch.stack(logits_batch, dim=1)  # batch_size x layers_num x labels_num
+
     def _forward_for_loss(self,
                           sentences_batch,
                           labels_batch=None):
 
         self.train()
-        ids_batch, masks_batch = [], []
-        for sentence in sentences_batch:
-            ids, masks = self._convert_to_id_and_mask(sentence)
-            ids_batch.append(ids)
-            masks_batch.append(masks)
-        ids_batch = torch.tensor(ids_batch, dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
-        masks_batch = torch.tensor(masks_batch, dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
+        ids_batch, masks_batch = self._convert_to_tensors(sentences_batch)
 
         # embedding layer
         embs_batch = self.kernel.embedding(ids_batch, masks_batch)  # batch_size x seq_length x emb_size
+        states_batch = self.kernel.encoder.init_layer_state(embs_batch, masks_batch)
         masks_batch = (masks_batch > 0).unsqueeze(1).repeat(1, self.args.seq_length, 1).\
                  unsqueeze(1)
         masks_batch = (1.0 - masks_batch.float()) * -10000.0  # batch_size x seq_length x seq_length
@@ -280,8 +802,7 @@ class FastBERT(nn.Module):
 
             hiddens_batch = embs_batch
             for i in range(self.kernel.encoder.layers_num):
-                hiddens_batch = self.kernel.encoder.transformer[i](
-                        hiddens_batch, masks_batch)
+                hiddens_batch = self.kernel.encoder.layer_forward(i, hiddens_batch, states_batch)
             logits_batch = self.classifiers[-1](hiddens_batch, masks_batch)
             loss = self.criterion(
                     self.softmax(logits_batch.view(-1, self.labels_num)), 
@@ -297,8 +818,7 @@ class FastBERT(nn.Module):
             hiddens_batch_list = []
             with torch.no_grad():
                 for i in range(self.kernel.encoder.layers_num):
-                    hiddens_batch = self.kernel.encoder.transformer[i](
-                            hiddens_batch, masks_batch)
+                    hiddens_batch = self.kernel.encoder.layer_forward(i, hiddens_batch, states_batch)
                     hiddens_batch_list.append(hiddens_batch)
                 teacher_logits = self.classifiers[-1](
                         hiddens_batch_list[-1], masks_batch
@@ -314,10 +834,38 @@ class FastBERT(nn.Module):
                         self.softmax(student_logits), teacher_probs)
             return loss
 
+    def _convert_to_tensors(self,
+                            sentences_batch):
+        ids_batch, masks_batch = [], []
+        for sentence in sentences_batch:
+            ids, masks = self._convert_to_id_and_mask(sentence)
+            ids_batch.append(ids)
+            masks_batch.append(masks)
+        ids_batch = torch.tensor(ids_batch, dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
+        masks_batch = torch.tensor(masks_batch, dtype=torch.int64, device=self.args.device)  # batch_size x seq_length
+        return ids_batch, masks_batch
+
+    def _convert_to_windows(self,
+                            sentence,
+                            stride):
+        # overlapping windows of seq_length - 1 tokens, each preceded by [CLS],
+        # the last window ends at the last token
+        tokens = [self.vocab.get(t) for t in self.tokenizer.tokenize(sentence)]
+        window_length = self.args.seq_length - 1
+        starts = list(range(0, max(len(tokens) - window_length, 0) + 1, stride))
+        if starts[-1] + window_length < len(tokens):
+            starts.append(len(tokens) - window_length)
+        return [self._pad([self.cls_id] + tokens[start: start + window_length]) \
+                for start in starts]
+
     def _convert_to_id_and_mask(self,
                                 sentence):
         ids = [self.cls_id] + \
                 [self.vocab.get(t) for t in self.tokenizer.tokenize(sentence)]
+        return self._pad(ids)
+
+    def _pad(self,
+             ids):
         mask = [1] * len(ids)
         if len(ids) >= self.args.seq_length:
             ids = ids[ :self.args.seq_length]
@@ -365,6 +913,8 @@ class FastBERT(nn.Module):
                 correct_bias=False)
         scheduler = WarmupLinearSchedule(optimizer, \
                 warmup_steps=train_steps*warmup, t_total=train_steps)
+        # losses are scaled for fp16 only
+        scaler = grad_scaler(self.args.device, self.precision)
         
         # fine-tuning
         best_acc = 0.0
@@ -376,7 +926,8 @@ class FastBERT(nn.Module):
                 optimizer.zero_grad()
                 sentences_batch = sentences_train[step*batch_size : (step+1)*batch_size]
                 labels_batch = labels_train[step*batch_size : (step+1)*batch_size]
-                loss = self._forward_for_loss(sentences_batch, labels_batch)
+                with self._autocast():
+                    loss = self._forward_for_loss(sentences_batch, labels_batch)
 
                 report_loss += loss.item()
                 if (step+1) % report_steps == 0:
@@ -388,8 +939,8 @@ class FastBERT(nn.Module):
                                 "step {}/{}: loss = {:.3f}". \
                                 format(step+1, steps_num, ave_loss))
 
-                loss.backward()
-                optimizer.step()
+                backward(loss, scaler)
+                optimizer_step(optimizer, scaler)
                 scheduler.step()
 
             dev_acc, _ = self._evaluate(sentences_dev, labels_dev, speed=0.0) \
@@ -479,6 +1030,8 @@ class FastBERT(nn.Module):
                 correct_bias=False)
         scheduler = WarmupLinearSchedule(optimizer, \
                 warmup_steps=train_steps*warmup, t_total=train_steps)
+        # losses are scaled for fp16 only
+        scaler = grad_scaler(self.args.device, self.precision)
 
         for epoch in range(epochs_num):
             random.shuffle(sentences_train)
@@ -487,7 +1040,8 @@ class FastBERT(nn.Module):
                 optimizer.zero_grad()
 
                 sentences_batch = sentences_train[step*batch_size : (step+1)*batch_size]
-                loss = self._forward_for_loss(sentences_batch)
+                with self._autocast():
+                    loss = self._forward_for_loss(sentences_batch)
 
                 report_loss += loss.item()
                 if (step+1) % report_steps == 0:
@@ -499,8 +1053,8 @@ class FastBERT(nn.Module):
                                 "step {}/{}: loss = {:.3f}". \
                                 format(step+1, steps_num, ave_loss))
 
-                loss.backward()
-                optimizer.step()
+                backward(loss, scaler)
+                optimizer_step(optimizer, scaler)
                 scheduler.step()
 
             dev_acc, ave_layers = self._evaluate(sentences_dev, labels_dev, speed=0.5) \
@@ -3,6 +3,7 @@ import torch.nn as nn
 from uer.layers.layer_norm import LayerNorm
 from uer.layers.position_ffn import PositionwiseFeedForward
 from uer.layers.multi_headed_attn import MultiHeadedAttention
+from uer.utils.config import layer_param
 
 class AttnEncoder(nn.Module):
     """
@@ -11,26 +12,39 @@ class AttnEncoder(nn.Module):
     def __init__(self, args):
         super(AttnEncoder, self).__init__()
         self.layers_num = args.layers_num
-        self.self_attn = MultiHeadedAttention(
-            args.hidden_size, args.heads_num, args.dropout
-        )
         self.self_attn = nn.ModuleList([
             MultiHeadedAttention(
-                args.hidden_size, args.heads_num, args.dropout
+                args.hidden_size, layer_param(args.heads_num, i), args.dropout,
+                getattr(args, "per_head_size", None)
             )
-            for _ in range(self.layers_num)
+            for i in range(self.layers_num)
         ])
         
     def forward(self, emb, seg):
         """
         Args:
             emb: [batch_size x seq_length x emb_size]
-            mask: [batch_size x 1 x seq_length x seq_length]
+            seg: [batch_size x seq_length]
 
         Returns:
             hidden: [batch_size x seq_length x hidden_size]
         """
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
 
+    def init_layer_state(self, emb, seg):
+        """
+        Args:
+            emb: [batch_size x seq_length x emb_size]
+            seg: [batch_size x seq_length]
+
+        Returns:
+            state: A dict of the tensors shared by the layers,
+                   whose first dimension is the batch.
+        """
         seq_length = emb.size(1)
         # Generate mask according to segment indicators.
         mask = (seg > 0). \
@@ -40,9 +54,16 @@ class AttnEncoder(nn.Module):
 
         mask = mask.float()
         mask = (1.0 - mask) * -10000.0
+        return {"mask": mask}
 
-        hidden = emb
-        for i in range(self.layers_num):
-            hidden = self.self_attn[i](hidden, hidden, hidden, mask)
-            
-        return hidden
+    def layer_forward(self, i, hidden, state):
+        """
+        Args:
+            i: Index of the layer.
+            hidden: [batch_size x seq_length x hidden_size] output of the previous layer.
+            state: The state given by init_layer_state.
+
+        Returns:
+            hidden: [batch_size x seq_length x hidden_size]
+        """
+        return self.self_attn[i](hidden, hidden, hidden, state["mask"])
@@ -14,7 +14,7 @@ class BertEncoder(nn.Module):
         super(BertEncoder, self).__init__()
         self.layers_num = args.layers_num
         self.transformer = nn.ModuleList([
-            TransformerLayer(args) for _ in range(self.layers_num)
+            TransformerLayer(args, i) for i in range(self.layers_num)
         ])
         
     def forward(self, emb, seg):
@@ -26,7 +26,22 @@ class BertEncoder(nn.Module):
         Returns:
             hidden: [batch_size x seq_length x hidden_size]
         """
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        """
+        Args:
+            emb: [batch_size x seq_length x emb_size]
+            seg: [batch_size x seq_length]
 
+        Returns:
+            state: A dict of the tensors shared by the layers,
+                   whose first dimension is the batch.
+        """
         seq_length = emb.size(1)
         # Generate mask according to segment indicators.
         # mask: [batch_size x 1 x seq_length x seq_length]
@@ -37,8 +52,18 @@ class BertEncoder(nn.Module):
 
         mask = mask.float()
         mask = (1.0 - mask) * -10000.0
+        return {"mask": mask}
 
-        hidden = emb
-        for i in range(self.layers_num):
-            hidden = self.transformer[i](hidden, mask)
-        return hidden
+    def layer_forward(self, i, hidden, state, return_probs=False):
+        """
+        Args:
+            i: Index of the layer.
+            hidden: [batch_size x seq_length x hidden_size] output of the previous layer.
+            state: The state given by init_layer_state.
+            return_probs: Whether to return the attention probabilities as well.
+
+        Returns:
+            hidden: [batch_size x seq_length x hidden_size]
+            probs: [batch_size x heads_num x seq_length x seq_length] if return_probs.
+        """
+        return self.transformer[i](hidden, state["mask"], return_probs)
@@ -12,36 +12,49 @@ class BilstmEncoder(nn.Module):
         
         self.layers_num = args.layers_num
 
-        self.rnn_forward = nn.LSTM(input_size=args.emb_size,
-                           hidden_size=self.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True)
-
-        self.rnn_backward = nn.LSTM(input_size=args.emb_size,
-                           hidden_size=self.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True)
+        # One single-layer LSTM per layer and direction, so that the layers can be run one by one.
+        self.rnn_forward = stacked_rnn(nn.LSTM, args.emb_size, self.hidden_size, args.layers_num)
+
+        self.rnn_backward = stacked_rnn(nn.LSTM, args.emb_size, self.hidden_size, args.layers_num)
 
         self.drop = nn.Dropout(args.dropout)
 
     def forward(self, emb, seg):
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        return {"lengths": seq_lengths(seg)}
+
+    def layer_forward(self, i, hidden, state):
+        """
+        The output of a layer is the forward output concatenated with the
+        backward output, the input of both directions is the embedding at
+        the first layer and the output of the same direction afterwards.
+        """
+        lengths = state["lengths"]
+        if i == 0:
+            input_forward, input_backward = hidden, hidden
+        else:
+            input_forward, input_backward = hidden[:, :, :self.hidden_size], hidden[:, :, self.hidden_size:]
+
         # Forward.
-        emb_forward = emb
-        hidden_forward = self.init_hidden(emb_forward.size(0), emb_forward.device)
-        output_forward, hidden_forward = self.rnn_forward(emb_forward, hidden_forward) 
+        hidden_forward = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output_forward = run_packed(self.rnn_forward[i], input_forward, lengths, hidden_forward)
         output_forward = self.drop(output_forward)
 
-        # Backward.
-        emb_backward = flip(emb, 1)
-        hidden_backward = self.init_hidden(emb_backward.size(0), emb_backward.device)
-        output_backward, hidden_backward = self.rnn_backward(emb_backward, hidden_backward) 
+        # Backward, each sequence is reversed within its valid length.
+        input_backward = reverse_padded(input_backward, lengths)
+        hidden_backward = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output_backward = run_packed(self.rnn_backward[i], input_backward, lengths, hidden_backward)
         output_backward = self.drop(output_backward)
-        output_backward = flip(output_backward, 1)
+        output_backward = reverse_padded(output_backward, lengths)
 
         return torch.cat([output_forward, output_backward], 2)
 
-    def init_hidden(self, batch_size, device):
-        return (torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device),
-                torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device))
+    def init_hidden(self, batch_size, device, dtype=torch.float):
+        zeros = cached_zeros(self, (1, batch_size, self.hidden_size), device, dtype)
+        return (zeros, zeros)
@@ -15,7 +15,7 @@ class GptEncoder(nn.Module):
         super(GptEncoder, self).__init__()
         self.layers_num = args.layers_num
         self.transformer = nn.ModuleList([
-            TransformerLayer(args) for _ in range(self.layers_num)
+            TransformerLayer(args, i) for i in range(self.layers_num)
         ])
         
     def forward(self, emb, seg):
@@ -27,7 +27,22 @@ class GptEncoder(nn.Module):
         Returns:
             hidden: [batch_size x seq_length x hidden_size]
         """
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        """
+        Args:
+            emb: [batch_size x seq_length x emb_size]
+            seg: [batch_size x seq_length]
 
+        Returns:
+            state: A dict of the tensors shared by the layers,
+                   whose first dimension is the batch.
+        """
         batch_size, seq_length, _ = emb.size()
         # Generate mask according to segment indicators.
         # mask: [batch_size x 1 x seq_length x seq_length]
@@ -35,8 +50,16 @@ class GptEncoder(nn.Module):
         mask = torch.tril(mask)
         mask = (1.0 - mask) * -10000
         mask = mask.repeat(batch_size, 1, 1, 1)
+        return {"mask": mask}
 
-        hidden = emb
-        for i in range(self.layers_num):
-            hidden = self.transformer[i](hidden, mask)
-        return hidden
+    def layer_forward(self, i, hidden, state):
+        """
+        Args:
+            i: Index of the layer.
+            hidden: [batch_size x seq_length x hidden_size] output of the previous layer.
+            state: The state given by init_layer_state.
+
+        Returns:
+            hidden: [batch_size x seq_length x hidden_size]
+        """
+        return self.transformer[i](hidden, state["mask"])
@@ -1,6 +1,7 @@
 # -*- encoding:utf-8 -*-
 import torch
 import torch.nn as nn
+from uer.utils.misc import *
 
 
 class LstmEncoder(nn.Module):
@@ -16,28 +17,33 @@ class LstmEncoder(nn.Module):
         
         self.layers_num = args.layers_num
 
-        self.rnn = nn.LSTM(input_size=args.emb_size,
-                           hidden_size=self.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True,
-                           bidirectional=self.bidirectional)
+        # One single-layer LSTM per layer, so that the layers can be run one by one.
+        self.rnn = stacked_rnn(nn.LSTM, args.emb_size, self.hidden_size,
+                               args.layers_num, self.bidirectional)
 
         self.drop = nn.Dropout(args.dropout)
 
     def forward(self, emb, seg):
-        hidden = self.init_hidden(emb.size(0), emb.device)
-        output, hidden = self.rnn(emb, hidden) 
-        output = self.drop(output) 
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        return {"lengths": seq_lengths(seg)}
+
+    def layer_forward(self, i, hidden, state):
+        lengths = state["lengths"]
+        init_hidden = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output = run_packed(self.rnn[i], hidden, lengths, init_hidden)
+        output = self.drop(output)
         return output
 
-    def init_hidden(self, batch_size, device):
-        if self.bidirectional:
-            return (torch.zeros(self.layers_num*2, batch_size, self.hidden_size, device=device),
-                    torch.zeros(self.layers_num*2, batch_size, self.hidden_size, device=device))
-        else:
-            return (torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device),
-                    torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device))
+    def init_hidden(self, batch_size, device, dtype=torch.float):
+        directions_num = 2 if self.bidirectional else 1
+        zeros = cached_zeros(self, (directions_num, batch_size, self.hidden_size), device, dtype)
+        return (zeros, zeros)
 
 
 class GruEncoder(nn.Module):
@@ -53,23 +59,29 @@ class GruEncoder(nn.Module):
 
         self.layers_num = args.layers_num
 
-        self.rnn = nn.GRU(input_size=args.emb_size,
-                           hidden_size=self.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True,
-                           bidirectional=self.bidirectional)
+        # One single-layer GRU per layer, so that the layers can be run one by one.
+        self.rnn = stacked_rnn(nn.GRU, args.emb_size, self.hidden_size,
+                               args.layers_num, self.bidirectional)
 
         self.drop = nn.Dropout(args.dropout)
 
     def forward(self, emb, seg):
-        hidden = self.init_hidden(emb.size(0), emb.device)
-        output, hidden = self.rnn(emb, hidden) 
-        output = self.drop(output) 
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        return {"lengths": seq_lengths(seg)}
+
+    def layer_forward(self, i, hidden, state):
+        lengths = state["lengths"]
+        init_hidden = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output = run_packed(self.rnn[i], hidden, lengths, init_hidden)
+        output = self.drop(output)
         return output
 
-    def init_hidden(self, batch_size, device):
-        if self.bidirectional:
-            return torch.zeros(self.layers_num*2, batch_size, self.hidden_size, device=device)
-        else:
-            return torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device)
+    def init_hidden(self, batch_size, device, dtype=torch.float):
+        directions_num = 2 if self.bidirectional else 1
+        return cached_zeros(self, (directions_num, batch_size, self.hidden_size), device, dtype)
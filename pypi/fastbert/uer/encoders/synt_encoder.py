@@ -32,7 +32,22 @@ class SyntEncoder(nn.Module):
         Returns:
             hidden: [batch_size x seq_length x hidden_size]
         """
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        """
+        Args:
+            emb: [batch_size x seq_length x emb_size]
+            seg: [batch_size x seq_length]
 
+        Returns:
+            state: A dict of the tensors shared by the layers,
+                   whose first dimension is the batch.
+        """
         seq_length = emb.size(1)
         # Generate mask according to segment indicators.
         # mask: [batch_size x 1 x seq_length x seq_length]
@@ -43,8 +58,16 @@ class SyntEncoder(nn.Module):
 
         mask = mask.float()
         mask = (1.0 - mask) * -10000.0
+        return {"mask": mask}
 
-        hidden = emb
-        for i in range(self.layers_num):
-            hidden = self.synthesizer[i](hidden, mask)
-        return hidden
+    def layer_forward(self, i, hidden, state):
+        """
+        Args:
+            i: Index of the layer.
+            hidden: [batch_size x seq_length x hidden_size] output of the previous layer.
+            state: The state given by init_layer_state.
+
+        Returns:
+            hidden: [batch_size x seq_length x hidden_size]
+        """
+        return self.synthesizer[i](hidden, state["mask"])
@@ -8,29 +8,33 @@ class MultiHeadedAttention(nn.Module):
     Each head is a self-attention operation.
     self-attention refers to https://arxiv.org/pdf/1706.03762.pdf
     """
-    def __init__(self, hidden_size, heads_num, dropout):
+    def __init__(self, hidden_size, heads_num, dropout, per_head_size=None):
         super(MultiHeadedAttention, self).__init__()
         self.hidden_size = hidden_size
         self.heads_num = heads_num
-        self.per_head_size = hidden_size // heads_num
+        # per_head_size is given if heads are pruned, e.g., 64 with 8 heads of 768 hidden size.
+        self.per_head_size = per_head_size if per_head_size is not None else hidden_size // heads_num
+        self.inner_size = heads_num * self.per_head_size
 
         self.linear_layers = nn.ModuleList([
-                nn.Linear(hidden_size, hidden_size) for _ in range(3)
+                nn.Linear(hidden_size, self.inner_size) for _ in range(3)
             ])
         
         self.dropout = nn.Dropout(dropout)
-        self.final_linear = nn.Linear(hidden_size, hidden_size)
+        self.final_linear = nn.Linear(self.inner_size, hidden_size)
 
-    def forward(self, key, value, query, mask):
+    def forward(self, key, value, query, mask, return_probs=False):
         """
         Args:
             key: [batch_size x seq_length x hidden_size]
             value: [batch_size x seq_length x hidden_size]
-            query: [batch_size x seq_length x hidden_size]
-            mask: [batch_size x 1 x seq_length x seq_length]
+            query: [batch_size x query_length x hidden_size]
+            mask: [batch_size x 1 x query_length x seq_length]
+            return_probs: Whether to return the attention probabilities as well.
 
         Returns:
-            output: [batch_size x seq_length x hidden_size]
+            output: [batch_size x query_length x hidden_size]
+            probs: [batch_size x heads_num x query_length x seq_length] if return_probs.
         """
         batch_size, seq_length, hidden_size = key.size()
         heads_num = self.heads_num
@@ -46,7 +50,7 @@ class MultiHeadedAttention(nn.Module):
             return x. \
                    transpose(1, 2). \
                    contiguous(). \
-                   view(batch_size, seq_length, hidden_size)
+                   view(batch_size, -1, self.inner_size)
 
 
         query, key, value = [l(x). \
@@ -59,8 +63,9 @@ class MultiHeadedAttention(nn.Module):
         scores = scores / math.sqrt(float(per_head_size)) 
         scores = scores + mask
         probs = nn.Softmax(dim=-1)(scores)
-        probs = self.dropout(probs)
-        output = unshape(torch.matmul(probs, value))
+        output = unshape(torch.matmul(self.dropout(probs), value))
         output = self.final_linear(output)
         
+        if return_probs:
+            return output, probs
         return output
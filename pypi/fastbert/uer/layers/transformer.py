@@ -3,6 +3,7 @@ import torch.nn as nn
 from uer.layers.layer_norm import LayerNorm
 from uer.layers.position_ffn import PositionwiseFeedForward
 from uer.layers.multi_headed_attn import MultiHeadedAttention
+from uer.utils.config import layer_param
 
 
 class TransformerLayer(nn.Module):
@@ -10,33 +11,39 @@ class TransformerLayer(nn.Module):
     Transformer layer mainly consists of two parts:
     multi-headed self-attention and feed forward layer.
     """
-    def __init__(self, args):
+    def __init__(self, args, layer=0):
         super(TransformerLayer, self).__init__()
 
         # Multi-headed self-attention.
         self.self_attn = MultiHeadedAttention(
-            args.hidden_size, args.heads_num, args.dropout
+            args.hidden_size, layer_param(args.heads_num, layer), args.dropout,
+            getattr(args, "per_head_size", None)
         )
         self.dropout_1 = nn.Dropout(args.dropout)
         self.layer_norm_1 = LayerNorm(args.hidden_size)
         # Feed forward layer.
         self.feed_forward = PositionwiseFeedForward(
-            args.hidden_size, args.feedforward_size
+            args.hidden_size, layer_param(args.feedforward_size, layer)
         )
         self.dropout_2 = nn.Dropout(args.dropout)
         self.layer_norm_2 = LayerNorm(args.hidden_size)
 
-    def forward(self, hidden, mask):
+    def forward(self, hidden, mask, return_probs=False):
         """
         Args:
             hidden: [batch_size x seq_length x emb_size]
             mask: [batch_size x 1 x seq_length x seq_length]
+            return_probs: Whether to return the attention probabilities as well.
 
         Returns:
             output: [batch_size x seq_length x hidden_size]
+            probs: [batch_size x heads_num x seq_length x seq_length] if return_probs.
         """
-        inter = self.dropout_1(self.self_attn(hidden, hidden, hidden, mask))
+        inter, probs = self.self_attn(hidden, hidden, hidden, mask, return_probs=True)
+        inter = self.dropout_1(inter)
         inter = self.layer_norm_1(inter + hidden)
         output = self.dropout_2(self.feed_forward(inter))
         output = self.layer_norm_2(output + inter)  
+        if return_probs:
+            return output, probs
         return output
@@ -22,14 +22,20 @@ from uer.subencoders.cnn_subencoder import CnnSubencoder
 from uer.models.model import Model
 
 
-def build_model(args):
+def build_model(args, meta=False):
     """
     Build universial encoder representations models.
     The combinations of different embedding, encoder, 
     and target layers yield pretrained models of different 
     properties. 
     We could select suitable one for downstream tasks.
+    With meta=True, parameters are created on the meta device without
+    being allocated or initialized. They are expected to be loaded
+    by load_model, and the rest allocated by materialize_meta.
     """
+    if meta:
+        with torch.device("meta"):
+            return build_model(args)
 
     if args.subword_type != "none":
         subencoder = globals()[args.subencoder.capitalize() + "Subencoder"](args, len(args.sub_vocab))
@@ -38,7 +44,11 @@ def build_model(args):
 
     embedding = globals()[args.embedding.capitalize() + "Embedding"](args, len(args.vocab))
     encoder = globals()[args.encoder.capitalize() + "Encoder"](args)
-    target = globals()[args.target.capitalize() + "Target"](args, len(args.vocab))
+    if args.target == "none":
+        # Encoder-only model, e.g., for classification.
+        target = None
+    else:
+        target = globals()[args.target.capitalize() + "Target"](args, len(args.vocab))
     model = Model(args, embedding, encoder, target, subencoder)
 
     return model
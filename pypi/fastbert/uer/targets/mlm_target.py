@@ -35,10 +35,8 @@ class MlmTarget(nn.Module):
         output_mlm = self.mlm_linear_2(output_mlm)
         output_mlm = self.softmax(output_mlm)
 
-        one_hot = torch.zeros(output_mlm.size(0),  self.vocab_size). \
-           to(torch.device(output_mlm.device)). \
-           scatter_(1, tgt_mlm.contiguous().view(-1,1), 1.0)
-        numerator = -torch.sum(output_mlm * one_hot, 1)
+        # Negative log-likelihood of the target words, gathered without one-hot vectors.
+        numerator = -output_mlm.gather(1, tgt_mlm.contiguous().view(-1,1)).squeeze(1)
         denominator = torch.tensor(output_mlm.size(0) + 1e-6)
         loss_mlm = torch.sum(numerator) / denominator
         if output_mlm.size(0) == 0:
@@ -13,3 +13,27 @@ def load_hyperparam(args):
     args = Namespace(**args_dict)
 
     return args
+
+
+def save_hyperparam(args, config_path, keys=("feedforward_size", "heads_num", "per_head_size")):
+    """
+    Save a copy of the config at args.config_path, with the given keys
+    updated from args.
+    """
+    with open(args.config_path, mode="r", encoding="utf-8") as f:
+        param = json.load(f)
+    for key in keys:
+        param[key] = getattr(args, key, None)
+    with open(config_path, mode="w", encoding="utf-8") as f:
+        json.dump(param, f, indent=4)
+
+
+def layer_param(value, layer):
+    """
+    Value of a hyperparameter at the given layer, where the
+    value is either shared by all layers or a list, e.g.,
+    feedforward_size and heads_num of a pruned model.
+    """
+    if isinstance(value, (list, tuple)):
+        return value[layer]
+    return value
@@ -0,0 +1,68 @@
+# -*- encoding:utf-8 -*-
+import numpy as np
+import torch
+
+
+def confusion_matrix(pred, gold, labels_num):
+    """
+    Args:
+        pred: [samples_num] predicted label ids.
+        gold: [samples_num] gold label ids.
+        labels_num: The number of labels.
+
+    Returns:
+        confusion: [labels_num x labels_num] confusion[i, j] is the number
+                   of samples predicted as i whose gold label is j.
+    """
+    confusion = torch.bincount(pred.view(-1) * labels_num + gold.view(-1), minlength=labels_num * labels_num)
+    return confusion.view(labels_num, labels_num)
+
+
+def precision_recall_f1(confusion):
+    """
+    Args:
+        confusion: [labels_num x labels_num] confusion matrix from confusion_matrix.
+
+    Returns:
+        precision, recall, f1: [labels_num] scores of each label, 0 where undefined.
+    """
+    confusion = confusion.double()
+    correct = torch.diagonal(confusion)
+    precision = correct / confusion.sum(dim=1).clamp(min=1)
+    recall = correct / confusion.sum(dim=0).clamp(min=1)
+    f1 = 2 * precision * recall / (precision + recall).clamp(min=1e-12)
+    return precision, recall, f1
+
+
+def mean_reciprocal_rank(scores, labels, qids):
+    """
+    Samples of a question are consecutive. The reciprocal rank of a question
+    is given by its best ranked positive answer, and questions without any
+    positive answer are ignored.
+
+    Args:
+        scores: [samples_num] scores of the answers.
+        labels: [samples_num] 1 for positive answers and 0 otherwise.
+        qids: [samples_num] question ids.
+
+    Returns:
+        mrr: Mean reciprocal rank over the questions.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    positives = np.asarray(labels) == 1
+    qids = np.asarray(qids)
+    if qids.shape[0] == 0:
+        return 0.0
+
+    # Group id of each sample, a new group starts wherever the qid changes.
+    group_ids = np.concatenate([[0], np.cumsum(qids[1:] != qids[:-1])])
+    groups_num = group_ids[-1] + 1
+
+    best_positive_scores = np.full(groups_num, -np.inf)
+    np.maximum.at(best_positive_scores, group_ids[positives], scores[positives])
+    # Rank of the best positive answer is one plus the number of answers scored higher.
+    higher_counts = np.bincount(group_ids, weights=scores > best_positive_scores[group_ids], minlength=groups_num)
+    has_positive = np.bincount(group_ids[positives], minlength=groups_num) > 0
+    if not has_positive.any():
+        return 0.0
+    return float(np.mean(1.0 / (higher_counts[has_positive] + 1)))
@@ -4,17 +4,32 @@ import torch.nn as nn
 from uer.utils.constants import *
 
 
-def word2sub(word_ids, vocab, sub_vocab, subword_type):
+def build_sub_table(vocab, sub_vocab, subword_type):
+    '''
+    Precompute the sub ids of every word in the vocabulary.
+    Only char subword is supported, i.e., the sub words are the characters.
+
+    Returns:
+        sub_table: vocab_size, max_sub_length, padded with 0
+        sub_lengths: vocab_size
+    '''
+    sub_lengths = [len(w) for w in vocab.i2w]
+    max_length = max(sub_lengths) if sub_lengths else 0
+    sub_table = [[sub_vocab.w2i.get(c, UNK_ID) for c in w] + [0] * (max_length - len(w)) for w in vocab.i2w]
+    # The device is given explicitly, so that the table is built even if the model is on meta device.
+    sub_table = torch.tensor(sub_table, dtype=torch.long, device="cpu").view(len(vocab), max_length)
+    sub_lengths = torch.tensor(sub_lengths, dtype=torch.long, device="cpu")
+    return sub_table, sub_lengths
+
+
+def word2sub(word_ids, sub_table, sub_lengths):
     '''
     word_ids: batch_size, seq_length
+    sub_table, sub_lengths: from build_sub_table, on the device of word_ids
+
+    Returns:
+        sub_ids: batch_size * seq_length, max_sub_length of the batch
     '''
-    batch_size, seq_length = word_ids.size()
-    device = word_ids.device
-    word_ids = word_ids.contiguous().view(-1).tolist()
-    words = [vocab.i2w[i] for i in word_ids]
-    max_length = max([len(w) for w in words])
-    sub_ids = torch.zeros((len(words), max_length), dtype=torch.long).to(device)
-    for i in range(len(words)):
-        for j, c in enumerate(words[i]):
-            sub_ids[i, j] = sub_vocab.w2i.get(c, UNK_ID)
-    return sub_ids
+    word_ids = word_ids.contiguous().view(-1)
+    max_length = sub_lengths.index_select(0, word_ids).max().item()
+    return sub_table[:, :max_length].index_select(0, word_ids)
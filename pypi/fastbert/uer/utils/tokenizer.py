@@ -1,7 +1,7 @@
 # -*- encoding:utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 from uer.utils.constants import *
-from uer.utils.vocab import Vocab
+from uer.utils.vocab import Vocab, load_vocab
 import collections
 import unicodedata
 
@@ -63,8 +63,11 @@ class BertTokenizer(object):
           never_split: List of tokens which will never be split during tokenization.
                          Only has an effect when do_wordpiece_only=False
         """
-        self.vocab = Vocab()
-        self.vocab.load(args.vocab_path, is_quiet=True)
+        # Reuse the vocabulary of the caller if there is one.
+        if getattr(args, "vocab", None) is not None:
+            self.vocab = args.vocab
+        else:
+            self.vocab = load_vocab(args.vocab_path, is_quiet=True)
         self.ids_to_tokens = collections.OrderedDict(
             [(ids, tok) for ids, tok in enumerate(self.vocab.i2w)])
         self.do_basic_tokenize = do_basic_tokenize
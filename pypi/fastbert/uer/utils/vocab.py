@@ -1,9 +1,13 @@
 # -*- encoding:utf-8 -*-
 import os
+import heapq
+import struct
+import collections
+import threading
 import torch
 from multiprocessing import Pool
 from uer.utils.constants import *
-from uer.utils.misc import count_lines
+from uer.utils.checkpoint import atomic_write
 
 
 class Vocab(object):
@@ -17,18 +21,28 @@ class Vocab(object):
             os.path.abspath(os.path.join(os.path.dirname(__file__), "../../models/reserved_vocab.txt"))
         
     def load(self, vocab_path, is_quiet=False):
-        with open(vocab_path, mode="r", encoding="utf-8") as reader:
-            for index, line in enumerate(reader):
-                try:
-                    w = line.strip().split()[0]
-                    self.w2i[w] = index
-                    self.i2w.append(w)
-                except:
-                    self.w2i["???"+str(index)] = index
-                    self.i2w.append("???"+str(index))
+        stamp = _file_stamp(vocab_path)
+        i2w = _load_cache(vocab_path, stamp)
+        if i2w is None:
+            with open(vocab_path, mode="r", encoding="utf-8") as reader:
+                lines = reader.read().split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            i2w = []
+            for index, line in enumerate(lines):
+                w = line.split(None, 1)
+                if w:
+                    i2w.append(w[0])
+                else:
+                    i2w.append("???"+str(index))
                     if not is_quiet:
                         print("Vocabulary file line " + str(index+1) + " has bad format token")
-            assert len(self.w2i) == len(self.i2w)
+            # The file may have been modified while it was read.
+            if _file_stamp(vocab_path) == stamp:
+                _save_cache(vocab_path, stamp, i2w)
+        self.i2w = i2w
+        self.w2i = {w: i for i, w in enumerate(i2w)}
+        assert len(self.w2i) == len(self.i2w)
         if not is_quiet:
             print("Vocabulary Size: ", len(self))
 
@@ -45,69 +59,39 @@ class Vocab(object):
     def __len__(self):
         return len(self.i2w)
         
-    def worker(self, corpus_path, tokenizer, start, end):
-        """ 
-        Worker that creates vocabulary from corpus[start:end].
+    def build(self, corpus_path, tokenizer, workers_num=1, min_count=1, top_k=None, sketch_size=None):
+        """
+        Build vocabulary from the given corpus.
+        Each worker counts the lines starting in its byte range of the corpus,
+        and the counters are merged pairwise in the pool.
+        With sketch_size, every counter keeps at most sketch_size words
+        (Misra-Gries summary), so the memory is bounded regardless of the
+        corpus size. The counts are then underestimated by at most
+        tokens_num / (sketch_size + 1), which keeps the frequent words.
+        With top_k, at most top_k words are added besides the reserved ones.
         """
-        w2i, i2w, w2c = {}, [], {}
-        pos = 0
-        with open(corpus_path, mode="r", encoding="utf-8") as f:
-            while pos < start:
-               try:
-                   f.readline()
-               except:
-                   continue
-               finally:
-                   pos += 1
-            while True:
-                try:
-                    line = f.readline()
-                except:
-                    continue
-                finally:
-                   pos += 1
-
-                tokens = tokenizer.tokenize(line)
-                for t in tokens:
-                    if t not in w2i:
-                        w2i[t], w2c[t] = len(i2w), 1
-                        i2w.append(t)
-                    else:
-                        w2c[t] += 1
-                if pos >= end - 1:
-                    return (w2i, i2w, w2c)
-                            
-    def union(self, vocab_list):
-        """ Union vocab in all workers. """
-        w2i, i2w, w2c = {}, [], {}
-        index = 0
-        for v_p in vocab_list:
-            w2i_p, i2w_p, w2c_p = v_p.get()
-            for w in i2w_p:
-                if w not in w2i:
-                    w2i[w], w2c[w] = len(i2w), w2c_p[w]
-                    i2w.append(w)
-                else:
-                    w2c[w] += w2c_p[w]
-        return (w2i, i2w, w2c)
-                    
-    def build(self, corpus_path, tokenizer, workers_num=1, min_count=1):
-        """ Build vocabulary from the given corpus. """
         print("Start %d workers for building vocabulary..." % workers_num)
-        lines_num = count_lines(corpus_path)
+        file_size = os.path.getsize(corpus_path)
         pool = Pool(workers_num)
-        vocab_list = []
+        results = []
         for i in range(workers_num):
-            start = i * lines_num // workers_num
-            end = (i+1) * lines_num // workers_num
-            vocab_list.append((pool.apply_async(func=self.worker, args=[corpus_path, tokenizer, start, end])))
+            start = i * file_size // workers_num
+            end = (i+1) * file_size // workers_num
+            results.append(pool.apply_async(func=_count_worker, args=[corpus_path, tokenizer, start, end, sketch_size]))
+        counters = [result.get() for result in results]
+
+        # Merge the counters of all workers by tree reduction.
+        while len(counters) > 1:
+            pairs = [(counters[i], counters[i+1], sketch_size) for i in range(0, len(counters) - 1, 2)]
+            merged = pool.starmap(_merge_counters, pairs)
+            if len(counters) % 2 == 1:
+                merged.append(counters[-1])
+            counters = merged
         pool.close()
         pool.join()
-        
-        # Union vocab in all workers.
-        w2i, i2w, w2c = self.union(vocab_list)
+
         # Sort w2c according to word count.
-        sorted_w2c = sorted(w2c.items(), key=lambda item:item[1], reverse=True)
+        sorted_w2c = sorted(counters[0].items(), key=lambda item: (-item[1], item[0]))
 
         # Add special symbols and remove low frequency words.
         with open(self.reserved_vocab_path, mode="r", encoding="utf-8") as reader:
@@ -117,10 +101,133 @@ class Vocab(object):
             self.w2i[w] = i
             self.w2c[w] = -1
 
+        words_num = 0
         for w, c in sorted_w2c:
-            if c < min_count:
+            if c < min_count or (top_k is not None and words_num >= top_k):
                 break
             if w not in self.w2i:
                 self.w2i[w], self.w2c[w] = len(self.i2w), c
                 self.i2w.append(w)
-                
+                words_num += 1
+
+
+def _count_worker(corpus_path, tokenizer, start, end, sketch_size=None, batch_size=10000):
+    """
+    Count the tokens of the lines starting in [start, end) bytes of the corpus.
+    """
+    counter = collections.Counter()
+    with open(corpus_path, mode="rb") as f:
+        # Skip the line started before this range.
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            lines = []
+            while len(lines) < batch_size and f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line.decode("utf-8", errors="ignore"))
+            if not lines:
+                break
+            counter.update(t for line in lines for t in tokenizer.tokenize(line))
+            # Prune lazily, so that the pruning cost is amortized.
+            if sketch_size is not None and len(counter) > 2 * sketch_size:
+                counter = _prune_counter(counter, sketch_size)
+    if sketch_size is not None:
+        counter = _prune_counter(counter, sketch_size)
+    return counter
+
+
+def _merge_counters(counter_a, counter_b, sketch_size=None):
+    counter_a.update(counter_b)
+    if sketch_size is not None:
+        counter_a = _prune_counter(counter_a, sketch_size)
+    return counter_a
+
+
+def _prune_counter(counter, sketch_size):
+    """
+    Keep at most sketch_size words by subtracting the (sketch_size+1)-th
+    largest count from all counts (Misra-Gries).
+    """
+    if len(counter) <= sketch_size:
+        return counter
+    threshold = heapq.nlargest(sketch_size + 1, counter.values())[-1]
+    return collections.Counter({w: c - threshold for w, c in counter.items() if c > threshold})
+
+
+_shared_vocabs = {}
+_shared_vocabs_lock = threading.Lock()
+
+
+def load_vocab(vocab_path, is_quiet=False):
+    """
+    Load the vocabulary shared in the process, the file is loaded only
+    once unless it is modified. The returned vocabulary should not be
+    modified by the caller.
+    """
+    key = os.path.abspath(vocab_path)
+    stamp = _file_stamp(vocab_path)
+    with _shared_vocabs_lock:
+        if key not in _shared_vocabs or _shared_vocabs[key][0] != stamp:
+            vocab = Vocab()
+            vocab.load(vocab_path, is_quiet=True)
+            _shared_vocabs[key] = (stamp, vocab)
+        vocab = _shared_vocabs[key][1]
+    if not is_quiet:
+        print("Vocabulary Size: ", len(vocab))
+    return vocab
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+# The binary cache beside a vocabulary file holds its tokens as one
+# UTF-8 blob, separated by newlines, which tokens never contain:
+# magic | version | file size | file mtime_ns | tokens_num | blob size | blob
+_CACHE_MAGIC = b"UERVOCAB"
+_CACHE_VERSION = 1
+_CACHE_HEADER = struct.Struct("<8sIqqqq")
+
+
+def _cache_path(vocab_path):
+    return vocab_path + ".cache"
+
+
+def _load_cache(vocab_path, stamp):
+    # The cache is used only if it is made from the same file, anything
+    # else (including the pickles of older versions) is ignored.
+    try:
+        with open(_cache_path(vocab_path), mode="rb") as f:
+            header = f.read(_CACHE_HEADER.size)
+            if len(header) != _CACHE_HEADER.size:
+                return None
+            magic, version, size, mtime_ns, tokens_num, blob_size = _CACHE_HEADER.unpack(header)
+            if magic != _CACHE_MAGIC or version != _CACHE_VERSION or (size, mtime_ns) != stamp:
+                return None
+            blob = f.read(blob_size)
+        i2w = blob.decode("utf-8").split("\n") if tokens_num > 0 else []
+    except (OSError, ValueError):
+        return None
+    if len(blob) != blob_size or len(i2w) != tokens_num:
+        return None
+    return i2w
+
+
+def _save_cache(vocab_path, stamp, i2w):
+    blob = "\n".join(i2w).encode("utf-8")
+    header = _CACHE_HEADER.pack(_CACHE_MAGIC, _CACHE_VERSION, stamp[0], stamp[1], len(i2w), len(blob))
+
+    def write(tmp_path):
+        with open(tmp_path, mode="wb") as f:
+            f.write(header)
+            f.write(blob)
+
+    try:
+        atomic_write(_cache_path(vocab_path), write)
+    except OSError:
+        # The vocabulary is installed in a read-only directory.
+        pass
@@ -7,6 +7,7 @@ Some utils for fastbert.
 import os
 import json
 import torch
+import threading
 import random
 import numpy as np
 from argparse import Namespace
@@ -17,14 +18,62 @@ import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 
 
+MD5_CHUNK_SIZE = 1 << 20
+
+
 def md5sum(filename):
     with open(filename, 'rb') as f:
         d = hashlib.md5()
-        for buf in iter(partial(f.read, 128), b''):
+        for buf in iter(partial(f.read, MD5_CHUNK_SIZE), b''):
             d.update(buf)
     return d.hexdigest()
 
 
+def _stamp_path(file_path):
+    return file_path + '.md5stamp'
+
+
+def _file_key(file_path):
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_stamped(file_path,
+               file_md5):
+    '''
+    Whether the file has been verified with file_md5 and not changed since,
+    according to the size and mtime saved in its stamp file.
+    '''
+    try:
+        with open(_stamp_path(file_path), 'r', encoding='utf-8') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    key = _file_key(file_path)
+    key['md5'] = file_md5
+    return stamp == key
+
+
+def verify_md5(file_path,
+               file_md5):
+    '''
+    Check the md5 of the file, the stamp file is used to skip hashing
+    unchanged files, and is updated after a successful check.
+    '''
+    if is_stamped(file_path, file_md5):
+        return True
+    key = _file_key(file_path)
+    if md5sum(file_path) != file_md5:
+        return False
+    key['md5'] = file_md5
+    try:
+        with open(_stamp_path(file_path), 'w', encoding='utf-8') as f:
+            json.dump(key, f)
+    except OSError:
+        pass
+    return True
+
+
 def hello():
     print("Hello FastBERT!")
 
@@ -58,15 +107,43 @@ def cbk_for_urlretrieve(a, b, c):
     print('\r%.1f%% of %.2fM' % (per,c/(1024*1024)), end='')
 
 
+# results of the background checks by file path, kept out of the models
+# so that the models can still be copied and pickled
+_background_checks = {}
+_background_checks_lock = threading.Lock()
+
+
+def _verify_in_background(file_path,
+                          file_md5):
+    verified = verify_md5(file_path, file_md5)
+    with _background_checks_lock:
+        _background_checks[file_path] = verified
+
+
 def check_or_download(file_path,
                       file_url,
                       file_md5,
                       file_name='',
-                      file_url_bak=None):
+                      file_url_bak=None,
+                      background=False):
+    '''
+    Verify the file, or download it if it does not exist or is broken.
+    With background, an existing file not verified before is verified
+    in a background thread, whose result is given by background_check.
+    Return True if a background check is started, and False otherwise.
+    '''
     is_exist = False
     if os.path.exists(file_path):
-        this_file_md5 = md5sum(file_path)
-        if this_file_md5 == file_md5:
+        if background and not is_stamped(file_path, file_md5):
+            with _background_checks_lock:
+                _background_checks[file_path] = None
+            thread = threading.Thread(
+                    target=_verify_in_background,
+                    args=(file_path, file_md5),
+                    daemon=True)
+            thread.start()
+            return True
+        if verify_md5(file_path, file_md5):
             is_exist = True
         else:
             os.remove(file_path)
@@ -76,8 +153,7 @@ def check_or_download(file_path,
         print("Download {} file from {}".format(file_name, file_url))
         try:
             urllib.request.urlretrieve(file_url, file_path, cbk_for_urlretrieve)
-            this_file_md5 = md5sum(file_path)
-            if this_file_md5 == file_md5:
+            if verify_md5(file_path, file_md5):
                 print("\nDownload {} file successfully.".format(file_name))
             else:
                 raise Exception("Md5 wrong.")
@@ -89,11 +165,22 @@ def check_or_download(file_path,
                 "URL_A: {}\nURL_B:{}\nPATH: {} ". \
                 format(file_url, file_url_bak, file_path)
             raise Exception(infos + '\n' + options)
+    return False
+
+
+def background_check(file_path):
+    '''
+    Return None while the background check of the file is running,
+    True if its md5 is right, and False otherwise.
+    '''
+    with _background_checks_lock:
+        return _background_checks.get(file_path)
 
 
 def calc_uncertainty(p,
                      labels_num):
-    entropy = torch.distributions.Categorical(probs=p).entropy()
+    # Computed in float32, so exit decisions do not depend on the autocast precision.
+    entropy = torch.distributions.Categorical(probs=p.float()).entropy()
     normal = -np.log(1.0/labels_num)
     return entropy / normal
 
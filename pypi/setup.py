@@ -25,8 +25,8 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.4',
+    python_requires='>=3.8',
     install_requires=[
-        'torch>=1.2.0',
+        'torch>=2.0.0',
         ]
 )
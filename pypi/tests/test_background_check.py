@@ -0,0 +1,81 @@
+# coding: utf-8
+"""
+The md5 of the kernel may be checked in background, the model can still
+be copied and pickled, and raises once the check has failed.
+"""
+import os
+import sys
+sys.path.append("../")
+import copy
+import time
+import pickle
+import shutil
+import hashlib
+import tempfile
+from fastbert import FastBERT
+from fastbert.utils import check_or_download, background_check
+
+
+def wait_for(file_path,
+             timeout=10.0):
+    start = time.time()
+    while background_check(file_path) is None:
+        assert time.time() - start < timeout
+        time.sleep(0.01)
+    return background_check(file_path)
+
+
+def test_background_check():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        file_path = os.path.join(tmp_dir, 'kernel.bin')
+        with open(file_path, 'wb') as f:
+            f.write(b'kernel' * 1000)
+        with open(file_path, 'rb') as f:
+            file_md5 = hashlib.md5(f.read()).hexdigest()
+
+        assert check_or_download(file_path, None, '0' * 32, background=True)
+        assert wait_for(file_path) is False
+        assert check_or_download(file_path, None, file_md5, background=True)
+        assert wait_for(file_path) is True
+        # verified files are not checked again
+        assert not check_or_download(file_path, None, file_md5, background=True)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_model_with_failed_check():
+    model = FastBERT("google_bert_base_zh", labels=['0', '1'], device='cpu',
+                     seq_length=16, verify_in_background=True)
+    model.batch_forward(['我吃宫爆鸡丁!'], speed=0.5)
+    copy.deepcopy(model)
+    pickle.dumps(model)
+
+    # a failed check of a broken copy of the kernel
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        broken_path = os.path.join(tmp_dir, 'broken.bin')
+        with open(broken_path, 'wb') as f:
+            f.write(b'broken')
+        check_or_download(broken_path, None, '0' * 32, background=True)
+        assert wait_for(broken_path) is False
+        model.checking_kernel_path = broken_path
+        for infer in [lambda: model('我吃宫爆鸡丁!'), lambda: model.batch_forward(['我吃宫爆鸡丁!'])]:
+            try:
+                infer()
+            except Exception as error:
+                assert 'md5' in str(error)
+                continue
+            assert False
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_background_check()
+    test_model_with_failed_check()
+    print("[test_background_check]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# coding: utf-8
+"""
+Per-layer thresholds and exit layers fitted on a validation set,
+with the exit rule of inference: a sample exits at the first exit
+layer whose uncertainty is at or below the threshold.
+"""
+import sys
+sys.path.append("../")
+import numpy as np
+from fastbert.uer.utils.calibration import exit_layers, select_exit_layers, calibrate_thresholds
+
+
+def synthetic_dev(samples_num=500,
+                  layers_num=4,
+                  seed=7):
+    # deeper layers are more certain and more often correct, and
+    # a classifier is more often correct when it is more certain
+    rng = np.random.RandomState(seed)
+    depth = (np.arange(layers_num) + 1) / float(layers_num)
+    uncertainties = np.clip(rng.rand(samples_num, layers_num) * (1.2 - depth), 0.0, 1.0)
+    corrects = rng.rand(samples_num, layers_num) > uncertainties * 0.8
+    return uncertainties, corrects
+
+
+def simulate(uncertainties,
+             corrects,
+             thresholds,
+             exit_mask=None):
+    # the exit rule of FastBERT inference, layer by layer
+    samples_num, layers_num = uncertainties.shape
+    if exit_mask is None:
+        exit_mask = np.ones(layers_num, dtype=bool)
+    exec_layers, rights = [], []
+    for b in range(samples_num):
+        for i in range(layers_num):
+            if i == layers_num - 1 or (exit_mask[i] and uncertainties[b, i] <= thresholds[i]):
+                exec_layers.append(i + 1)
+                rights.append(corrects[b, i])
+                break
+    return np.mean(rights), np.mean(exec_layers)
+
+
+def test_exit_rule():
+    uncertainties = np.array([[0.5, 0.2, 0.9],
+                              [0.0, 0.9, 0.9],
+                              [0.6, 0.6, 0.9]])
+    thresholds = np.array([0.0, 0.5, 0.1])
+    # uncertainties equal to the threshold exit, the last layer always exits
+    assert exit_layers(uncertainties, thresholds).tolist() == [1, 0, 2]
+    assert exit_layers(uncertainties, thresholds, exit_mask=[False, True, True]).tolist() == [1, 2, 2]
+
+
+def test_calibrate_acc_floor():
+    uncertainties, corrects = synthetic_dev()
+    full_acc = corrects[:, -1].mean()
+    acc_floor = full_acc - 0.02
+    thresholds = calibrate_thresholds(uncertainties, corrects, acc_floor=acc_floor)
+    acc, layers = simulate(uncertainties, corrects, thresholds)
+    assert acc >= acc_floor, (acc, acc_floor)
+    assert layers < uncertainties.shape[1]
+    assert np.all((thresholds >= 0.0) & (thresholds <= 1.0))
+
+
+def test_calibrate_layers_budget():
+    uncertainties, corrects = synthetic_dev()
+    exit_mask = np.array([False, True, True, True])
+    thresholds = calibrate_thresholds(uncertainties, corrects, layers_budget=2.5, exit_mask=exit_mask)
+    acc, layers = simulate(uncertainties, corrects, thresholds, exit_mask)
+    assert layers <= 2.5, layers
+    # no threshold is fitted for a layer where samples cannot exit
+    assert thresholds[0] == 0.0
+    idxs = exit_layers(uncertainties, thresholds, exit_mask)
+    assert np.isclose(acc, corrects[np.arange(len(idxs)), idxs].mean())
+
+
+def test_select_exit_layers():
+    uncertainties, _ = synthetic_dev()
+    # nobody exits at the second layer
+    uncertainties[:, 1] = 1.0
+    exit_mask = select_exit_layers(uncertainties, [0.3, 0.3, 0.3, 0.3], min_exit_rate=0.05)
+    assert exit_mask.tolist()[1:] == [False, True, True]
+    assert exit_mask[0]
+    # the last layer is kept even if no sample reaches it
+    exit_mask = select_exit_layers(np.zeros((10, 4)), [0.5] * 4, min_exit_rate=0.5)
+    assert exit_mask.tolist() == [True, False, False, True]
+
+
+def main():
+    test_exit_rule()
+    test_calibrate_acc_floor()
+    test_calibrate_layers_budget()
+    test_select_exit_layers()
+    print("[test_calibration]: passed.")
+
+
+if __name__ == "__main__":
+    main()
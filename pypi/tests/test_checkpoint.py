@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+Round trip of the flat checkpoint format, including saving a model
+to the file its parameters are memory-mapped from.
+"""
+import os
+import sys
+sys.path.append("../")
+import shutil
+import tempfile
+from argparse import Namespace
+import torch
+from fastbert.uer.model_builder import build_model
+from fastbert.uer.model_saver import save_model
+from fastbert.uer.model_loader import load_model
+from fastbert.uer.utils.checkpoint import is_flat_checkpoint, is_meta_model
+
+
+ARGS = Namespace(emb_size=32, hidden_size=32, heads_num=2, feedforward_size=64,
+                 layers_num=2, dropout=0.0, embedding='bert', encoder='bert',
+                 target='none', subword_type='none', vocab=list(range(50)))
+
+
+def assert_same_state(model_a,
+                      model_b):
+    state_a, state_b = model_a.state_dict(), model_b.state_dict()
+    assert state_a.keys() == state_b.keys()
+    for name in state_a:
+        assert torch.equal(state_a[name], state_b[name]), name
+
+
+def test_flat_round_trip():
+    torch.manual_seed(7)
+    model = build_model(ARGS)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'model.bin')
+        save_model(model, path, flat=True)
+        assert is_flat_checkpoint(path)
+
+        loaded = load_model(build_model(ARGS, meta=True), path)
+        assert not is_meta_model(loaded)
+        assert_same_state(model, loaded)
+
+        # the parameters of loaded are views of the mapped file,
+        # which is replaced by each save
+        for flat in [True, False, True]:
+            save_model(loaded, path, flat=flat)
+            assert is_flat_checkpoint(path) == flat
+            assert_same_state(model, loaded)
+            assert_same_state(model, load_model(build_model(ARGS), path))
+            assert_same_state(model, load_model(build_model(ARGS, meta=True), path))
+
+        # no temporary file is left
+        assert os.listdir(tmp_dir) == ['model.bin']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_flat_round_trip()
+    print("[test_checkpoint]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# coding: utf-8
+"""
+chunked_forward covers a long sentence with overlapping windows and
+aggregates the predictions of the windows, a short sentence is one
+window and predicted as by forward.
+"""
+import sys
+sys.path.append("../")
+import torch
+from fastbert import FastBERT
+from fastbert.utils import calc_uncertainty
+
+
+SHORT = '我吃宫爆鸡丁!'
+LONG = '这本书的前半部分写得很好，后半部分有些拖沓，但总体来说值得一读。' * 2
+
+
+def build_model():
+    torch.manual_seed(7)
+    return FastBERT("google_bert_base_zh", labels=['0', '1'], device='cpu', seq_length=16)
+
+
+def window_predictions(model,
+                       windows,
+                       speed):
+    ids_batch = torch.tensor([ids for ids, _ in windows], dtype=torch.int64)
+    masks_batch = torch.tensor([mask for _, mask in windows], dtype=torch.int64)
+    probs, exec_layers = model._fast_infer_tensors(ids_batch, masks_batch, speed)
+    return probs, exec_layers.tolist()
+
+
+def test_short_sentence():
+    model = build_model()
+    assert model._convert_to_windows(SHORT, 7) == [model._convert_to_id_and_mask(SHORT)]
+    for speed in [0.0, 0.5, 1.0]:
+        label, exec_layer_num = model(SHORT, speed=speed)
+        for aggregation in ['max_confidence', 'mean_prob']:
+            labels, exec_layer_nums = model.chunked_forward([SHORT], speed=speed, aggregation=aggregation)
+            assert labels == [label], (speed, aggregation)
+            assert exec_layer_nums == [exec_layer_num], (speed, aggregation)
+
+
+def test_windows_cover_tokens():
+    model = build_model()
+    tokens = [model.vocab.get(t) for t in model.tokenizer.tokenize(LONG)]
+    window_length = model.args.seq_length - 1
+    assert len(tokens) > 3 * window_length
+    for stride in [1, 4, 7, window_length]:
+        windows = model._convert_to_windows(LONG, stride)
+        starts = [k * stride for k in range(len(windows) - 1)] + [len(tokens) - window_length]
+        # the last window ends at the last token, the others are stride apart
+        assert starts[-2] < starts[-1] <= starts[-2] + stride, stride
+        covered = [0] * len(tokens)
+        for (ids, mask), start in zip(windows, starts):
+            assert ids[0] == model.cls_id and sum(mask) == model.args.seq_length
+            assert ids[1:] == tokens[start: start + window_length]
+            for k in range(start, start + window_length):
+                covered[k] += 1
+        assert min(covered) >= 1, stride
+
+    # the default stride is half of the window length
+    assert model.chunked_forward([LONG], speed=0.5) == \
+            model.chunked_forward([LONG], speed=0.5, stride=window_length // 2)
+
+
+def test_aggregation():
+    model = build_model()
+    sentences = [LONG, SHORT, LONG[5:]]
+    stride = (model.args.seq_length - 1) // 2
+    for speed in [0.0, 0.5]:
+        for aggregation in ['max_confidence', 'mean_prob']:
+            for batch_size in [None, 3]:
+                labels, exec_layer_nums = model.chunked_forward(sentences, speed=speed,
+                        aggregation=aggregation, batch_size=batch_size)
+                for i, sentence in enumerate(sentences):
+                    probs, exec_layers = window_predictions(model,
+                            model._convert_to_windows(sentence, stride), speed)
+                    if aggregation == 'mean_prob':
+                        label_id = torch.argmax(probs.mean(dim=0)).item()
+                    else:
+                        uncertainties = calc_uncertainty(probs, labels_num=model.labels_num)
+                        label_id = torch.argmax(probs[torch.argmin(uncertainties)]).item()
+                    assert labels[i] == model.id2label[label_id], (speed, aggregation, i)
+                    assert exec_layer_nums[i] == sum(exec_layers), (speed, aggregation, i)
+
+
+def test_decided_uncertainty():
+    model = build_model()
+    stride = (model.args.seq_length - 1) // 2
+    probs, exec_layers = window_predictions(model, model._convert_to_windows(LONG, stride), 0.5)
+    # every sentence is decided after its first window
+    labels, exec_layer_nums = model.chunked_forward([LONG], speed=0.5, decided_uncertainty=2.0)
+    assert labels == [model.id2label[torch.argmax(probs[0]).item()]]
+    assert exec_layer_nums == [exec_layers[0]]
+    # no sentence is decided
+    labels, exec_layer_nums = model.chunked_forward([LONG], speed=0.5, decided_uncertainty=-1.0)
+    assert exec_layer_nums == [sum(exec_layers)]
+
+
+def main():
+    test_short_sentence()
+    test_windows_cover_tokens()
+    test_aggregation()
+    test_decided_uncertainty()
+    print("[test_chunked_forward]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# coding: utf-8
+"""
+With first pooling, the classifier attends from the first position only,
+which equals the first row of the full self-attention.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+from torch.testing import assert_close
+from fastbert.fastbert import MiniClassifier
+
+
+def full_attention_logits(classifier,
+                          hidden,
+                          mask):
+    # the baseline, self-attention over all positions and row 0 pooled
+    hidden = torch.tanh(classifier.output_layer_0(hidden))
+    hidden = classifier.self_atten(hidden, hidden, hidden, mask)[:, 0, :]
+    return classifier.output_layer_2(torch.tanh(classifier.output_layer_1(hidden)))
+
+
+def test_first_pooling():
+    torch.manual_seed(7)
+    classifier = MiniClassifier(Namespace(pooling='first', dropout=0.0), 32, 3)
+    classifier.eval()
+    seq_length = 12
+    hidden = torch.randn(4, seq_length, 32)
+    lengths = torch.tensor([12, 7, 3, 1])
+    valid = torch.arange(seq_length).unsqueeze(0) < lengths.unsqueeze(1)
+    with torch.no_grad():
+        # the mask of the encoder, [batch_size x 1 x seq_length x seq_length]
+        mask = valid.unsqueeze(1).repeat(1, seq_length, 1).unsqueeze(1)
+        mask = (1.0 - mask.float()) * -10000.0
+        logits = classifier(hidden, mask)
+        assert logits.size() == (4, 3)
+        assert_close(logits, full_attention_logits(classifier, hidden, mask))
+        # padding does not change the logits
+        assert_close(logits[2:3], classifier(hidden[2:3, :3], mask[2:3, :, :3, :3]))
+
+        # the mask after token pruning, [batch_size x 1 x 1 x seq_length]
+        assert_close(classifier(hidden, mask[:, :, :1, :]), logits)
+
+
+def main():
+    test_first_pooling()
+    print("[test_classifier]: passed.")
+
+
+if __name__ == "__main__":
+    main()
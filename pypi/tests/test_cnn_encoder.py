@@ -0,0 +1,116 @@
+# coding: utf-8
+"""
+The CNN encoders with causal Conv1d layers load the checkpoints of
+the Conv2d encoders they replaced and give the same outputs.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+import torch.nn as nn
+from fastbert.uer.encoders.cnn_encoder import CausalConv1d, CnnEncoder, GatedcnnEncoder
+
+
+class Conv2dCnnEncoder(nn.Module):
+    # the baseline CnnEncoder
+    def __init__(self, args):
+        super(Conv2dCnnEncoder, self).__init__()
+        self.kernel_size = args.kernel_size
+        self.emb_size = args.emb_size
+        self.hidden_size = args.hidden_size
+        self.conv_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
+        self.conv = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+            for _ in range(args.layers_num)])
+
+    def forward(self, emb, seg):
+        batch_size, seq_len, _ = emb.size()
+        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
+        emb = torch.cat([padding, emb], dim=1).unsqueeze(1)
+        hidden = self.conv_1(emb)
+        padding =  torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(emb.device)
+        hidden = torch.cat([padding, hidden], dim=2)
+        for i, conv_i in enumerate(self.conv):
+            hidden = conv_i(hidden)
+            hidden = torch.cat([padding, hidden], dim=2)
+        hidden = hidden[:,:,self.kernel_size-1:,:]
+        return hidden.transpose(1,2).contiguous().view(batch_size, seq_len, self.hidden_size)
+
+
+class Conv2dGatedcnnEncoder(nn.Module):
+    # the baseline GatedcnnEncoder
+    def __init__(self, args):
+        super(Conv2dGatedcnnEncoder, self).__init__()
+        self.kernel_size = args.kernel_size
+        self.block_size = args.block_size
+        self.emb_size = args.emb_size
+        self.hidden_size = args.hidden_size
+        self.conv_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
+        self.gate_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
+        self.conv = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+            for _ in range(args.layers_num-1)])
+        self.gate = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+            for _ in range(args.layers_num-1)])
+
+    def forward(self, emb, seg):
+        batch_size, seq_len, _ = emb.size()
+        res_input = torch.transpose(emb.unsqueeze(3), 1, 2)
+        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
+        emb = torch.cat([padding, emb], dim=1).unsqueeze(1)
+        hidden = self.conv_1(emb) * torch.sigmoid(self.gate_1(emb))
+        padding = torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(emb.device)
+        hidden = torch.cat([padding, hidden], dim=2)
+        for i, (conv_i, gate_i) in enumerate(zip(self.conv, self.gate)):
+            hidden = conv_i(hidden) * torch.sigmoid(gate_i(hidden))
+            if (i + 1) % self.block_size:
+                hidden = hidden + res_input
+                res_input = hidden
+            hidden = torch.cat([padding, hidden], dim=2)
+        hidden = hidden[:,:,self.kernel_size-1:,:]
+        return hidden.transpose(1,2).contiguous().view(batch_size, seq_len, self.hidden_size)
+
+
+def check_encoder(encoder_class,
+                  baseline_class,
+                  args):
+    torch.manual_seed(7)
+    baseline = baseline_class(args)
+    encoder = encoder_class(args)
+    encoder.load_state_dict(baseline.state_dict())
+    emb = torch.randn(2, 11, args.emb_size)
+    seg = torch.ones(2, 11, dtype=torch.int64)
+    with torch.no_grad():
+        assert torch.allclose(encoder(emb, seg), baseline(emb, seg), atol=1e-5)
+
+
+def test_cnn_encoder():
+    args = Namespace(emb_size=6, hidden_size=8, kernel_size=3, block_size=2, layers_num=3)
+    check_encoder(CnnEncoder, Conv2dCnnEncoder, args)
+
+
+def test_gatedcnn_encoder():
+    args = Namespace(emb_size=8, hidden_size=8, kernel_size=3, block_size=2, layers_num=4)
+    check_encoder(GatedcnnEncoder, Conv2dGatedcnnEncoder, args)
+
+
+def test_causality():
+    torch.manual_seed(7)
+    conv = CausalConv1d(4, 5, 3)
+    hidden = torch.randn(2, 4, 9)
+    changed = hidden.clone()
+    changed[:, :, 6:] = torch.randn(2, 4, 3)
+    with torch.no_grad():
+        output = conv(hidden)
+        assert output.size() == (2, 5, 9)
+        # the outputs before position 6 do not see the changed inputs
+        assert torch.allclose(output[:, :, :6], conv(changed)[:, :, :6], atol=1e-6)
+
+
+def main():
+    test_cnn_encoder()
+    test_gatedcnn_encoder()
+    test_causality()
+    print("[test_cnn_encoder]: passed.")
+
+
+if __name__ == "__main__":
+    main()
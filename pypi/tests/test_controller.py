@@ -0,0 +1,81 @@
+# coding: utf-8
+"""
+The speed controller scales the calibrated per-layer thresholds,
+and falls back to scaling the speed of an uncalibrated model.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+from fastbert import FastBERT, SpeedController
+
+
+class FakeModel(object):
+    # exits at the layer given by the scaled threshold of the first layer
+
+    def __init__(self,
+                 thresholds):
+        self.thresholds = torch.tensor(thresholds)
+        self.kernel = Namespace(encoder=Namespace(layers_num=len(thresholds)))
+        self.calls = []
+
+    def _exit_thresholds(self,
+                         speed,
+                         threshold_scale=1.0):
+        return FastBERT._exit_thresholds(self, speed, threshold_scale)
+
+    def batch_forward(self,
+                      sentences,
+                      speed=None,
+                      threshold_scale=1.0):
+        self.calls.append((speed, threshold_scale))
+        thresholds = self._exit_thresholds(speed, threshold_scale)
+        exec_layer = 1 if thresholds[0] >= 0.3 else len(thresholds)
+        return ['0'] * len(sentences), [exec_layer] * len(sentences)
+
+
+def test_exit_thresholds():
+    model = FakeModel([0.2, -1.0, 0.4, 0.6])
+    assert model._exit_thresholds(None) == [0.2, 0.0, 0.4, 0.6]
+    assert model._exit_thresholds(0.5) == [0.5] * 4
+    scaled = model._exit_thresholds(None, 2.0)
+    assert all(abs(a - b) < 1e-6 for a, b in zip(scaled, [0.4, 0.0, 0.8, 1.0]))
+
+
+def test_scale_calibrated_thresholds():
+    model = FakeModel([0.2, 0.3, 0.4, 0.6])
+    controller = SpeedController(model, target_layers=1.0, min_observations=1, step=0.5)
+    # too many layers, the calibrated thresholds are raised
+    controller(['a', 'b'])
+    assert model.calls[-1] == (None, 1.0)
+    assert controller.scale == 1.5
+    controller(['a', 'b'])
+    assert model.calls[-1] == (None, 1.5)
+    stats = controller.stats()
+    assert stats['scale'] == 1.5
+    assert abs(stats['thresholds'][0] - 0.3) < 1e-6
+    assert stats['recent_adjustments'][0]['new_scale'] == 1.5
+
+
+def test_scale_speed():
+    model = FakeModel([-1.0] * 4)
+    controller = SpeedController(model, target_layers=4.0, min_observations=1,
+                                 speed=0.4, step=0.5, min_scale=0.5)
+    # fewer layers than the target, the speed is lowered
+    controller(['a'])
+    assert model.calls[-1] == (0.4, 1.0)
+    assert controller.scale == 0.5
+    controller(['a'])
+    assert model.calls[-1] == (0.4, 0.5)
+    assert controller.scale == 0.5
+
+
+def main():
+    test_exit_thresholds()
+    test_scale_calibrated_thresholds()
+    test_scale_speed()
+    print("[test_controller]: passed.")
+
+
+if __name__ == "__main__":
+    main()
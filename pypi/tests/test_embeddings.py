@@ -0,0 +1,82 @@
+# coding: utf-8
+"""
+At inference, the BERT embedding looks up the fused position and
+segment table, which gives the sum of the separate lookups and follows
+the updates of the embeddings.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+from fastbert.uer.layers.embeddings import BertEmbedding
+
+
+ARGS = Namespace(emb_size=16, dropout=0.0)
+VOCAB_SIZE = 40
+
+
+def unfused(embedding,
+            src,
+            seg):
+    # the baseline, an arange repeated over the batch and three lookups
+    word_emb = embedding.word_embedding(src)
+    pos_emb = embedding.position_embedding(torch.arange(0, word_emb.size(1), device=word_emb.device, \
+                                          dtype=torch.long).unsqueeze(0).repeat(word_emb.size(0), 1))
+    seg_emb = embedding.segment_embedding(seg)
+    return embedding.layer_norm(word_emb + pos_emb + seg_emb)
+
+
+def random_batch():
+    src = torch.randint(1, VOCAB_SIZE, (3, 10))
+    seg = torch.tensor([[1] * 10, [1] * 4 + [2] * 4 + [0] * 2, [1] * 2 + [0] * 8])
+    return src, seg
+
+
+def test_fused_embedding():
+    torch.manual_seed(7)
+    embedding = BertEmbedding(ARGS, VOCAB_SIZE)
+    src, seg = random_batch()
+    with torch.no_grad():
+        expected = unfused(embedding, src, seg)
+    # gradients and training mode take the unfused path
+    assert torch.allclose(embedding(src, seg), expected, atol=1e-6)
+    assert embedding.fused_table is None
+
+    embedding.eval()
+    with torch.no_grad():
+        assert torch.allclose(embedding(src, seg), expected, atol=1e-6)
+        assert embedding.fused_table is not None
+
+
+def test_fused_table_updates():
+    torch.manual_seed(7)
+    embedding = BertEmbedding(ARGS, VOCAB_SIZE)
+    embedding.eval()
+    src, seg = random_batch()
+    with torch.no_grad():
+        embedding(src, seg)
+        # an in-place update
+        embedding.segment_embedding.weight.add_(1.0)
+        assert torch.allclose(embedding(src, seg), unfused(embedding, src, seg), atol=1e-6)
+        # loading a checkpoint
+        state_dict = BertEmbedding(ARGS, VOCAB_SIZE).state_dict()
+        embedding.load_state_dict(state_dict)
+        assert torch.allclose(embedding(src, seg), unfused(embedding, src, seg), atol=1e-6)
+
+    # the weights may be updated through .data in training
+    embedding.train()
+    assert embedding.fused_table is None
+    embedding.position_embedding.weight.data.mul_(2.0)
+    embedding.eval()
+    with torch.no_grad():
+        assert torch.allclose(embedding(src, seg), unfused(embedding, src, seg), atol=1e-6)
+
+
+def main():
+    test_fused_embedding()
+    test_fused_table_updates()
+    print("[test_embeddings]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+# coding: utf-8
+"""
+Exit statistics are copied and pickled with the model holding them.
+"""
+import sys
+sys.path.append("../")
+import copy
+import pickle
+from fastbert.uer.utils.exit_stats import ExitStats
+
+
+def test_copy_and_pickle():
+    stats = ExitStats(3, labels=['0', '1'])
+    stats.record_layer(0, 4, 0.01, [0.1, 0.5, 0.9, 0.2])
+    stats.record_exits(0, [1, 0])
+    for copied in [copy.deepcopy(stats), pickle.loads(pickle.dumps(stats))]:
+        assert copied.as_dict() == stats.as_dict()
+        assert copied.lock is not stats.lock
+        # the copy is independent of the original
+        copied.record_exits(1, [1])
+        assert copied.as_dict() != stats.as_dict()
+        copied.reset()
+
+
+def main():
+    test_copy_and_pickle()
+    print("[test_exit_stats]: passed.")
+
+
+if __name__ == "__main__":
+    main()
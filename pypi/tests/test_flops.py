@@ -0,0 +1,48 @@
+# coding: utf-8
+"""
+Analytic FLOPs of FastBERT, which are only counted for transformer
+encoders.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import numpy as np
+from fastbert.uer.utils.flops import fastbert_flops, transformer_layer_flops, classifier_flops
+
+
+def build_args(encoder='bert'):
+    return Namespace(encoder=encoder, hidden_size=32, feedforward_size=64,
+                     heads_num=4, layers_num=3, pooling='first')
+
+
+def test_fastbert_flops():
+    args = build_args()
+    flops = fastbert_flops(16, [1, 2, 3], args, labels_num=2)
+    layer = transformer_layer_flops(16, 32, 64) + classifier_flops(16, 32, 2)
+    assert np.allclose(flops, [layer, 2 * layer, 3 * layer])
+    # a length per layer, or per sample and layer
+    assert np.allclose(fastbert_flops([16] * 3, [1, 2, 3], args, 2), flops)
+    assert np.allclose(fastbert_flops(np.full((3, 3), 16), [1, 2, 3], args, 2), flops)
+    # only the last classifier runs in normal mode
+    normal = fastbert_flops(16, [3], args, 2, fast=False)
+    assert np.isclose(normal[0], 3 * layer - 2 * classifier_flops(16, 32, 2))
+
+
+def test_other_encoders():
+    assert fastbert_flops(16, [3], build_args('gpt'), 2)[0] > 0
+    for encoder in ['lstm', 'gru', 'cnn', 'gatedcnn', 'attn', 'rcnn', 'crnn', 'bilstm']:
+        try:
+            fastbert_flops(16, [3], build_args(encoder), 2)
+        except AssertionError:
+            continue
+        assert False, encoder
+
+
+def main():
+    test_fastbert_flops()
+    test_other_encoders()
+    print("[test_flops]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+Every encoder runs layer by layer: looping layer_forward over the state
+of init_layer_state gives the output of the encoder, also when samples
+leave the batch between layers as they do at early exit.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+from torch.testing import assert_close
+from fastbert.uer.model_builder import build_model
+from fastbert.uer.utils.misc import select_state
+
+
+ENCODERS = ['bert', 'gpt', 'attn', 'lstm', 'gru', 'bilstm', 'cnn', 'gatedcnn', 'rcnn', 'crnn']
+
+
+def build_encoder(encoder):
+    args = Namespace(emb_size=16, hidden_size=16, heads_num=2, feedforward_size=32,
+                     layers_num=3, dropout=0.0, kernel_size=3, block_size=2,
+                     bidirectional=False, embedding='bert', encoder=encoder,
+                     target='none', subword_type='none', vocab=list(range(50)))
+    return build_model(args).encoder
+
+
+def random_batch():
+    emb = torch.randn(4, 10, 16)
+    seg = torch.tensor([[1] * 10, [1] * 7 + [0] * 3, [1] * 3 + [2] * 3 + [0] * 4, [1] + [0] * 9])
+    return emb, seg
+
+
+def run_layers(encoder,
+               emb,
+               seg,
+               exit_layer=None,
+               remains=None):
+    # drop the samples not in remains after exit_layer layers
+    state = encoder.init_layer_state(emb, seg)
+    hidden = emb
+    for i in range(encoder.layers_num):
+        hidden = encoder.layer_forward(i, hidden, state)
+        if i + 1 == exit_layer:
+            hidden = hidden[remains]
+            state = select_state(state, remains)
+    return hidden
+
+
+def check_encoder(encoder):
+    torch.manual_seed(7)
+    model = build_encoder(encoder)
+    model.eval()
+    emb, seg = random_batch()
+    remains = torch.tensor([True, False, True, True])
+    with torch.no_grad():
+        output = model(emb, seg)
+        assert output.size() == (4, 10, 16), encoder
+        assert_close(run_layers(model, emb, seg), output)
+        for exit_layer in range(1, model.layers_num):
+            assert_close(run_layers(model, emb, seg, exit_layer, remains), output[remains],
+                         msg=lambda m: "{} exit at {}: {}".format(encoder, exit_layer, m))
+
+
+def test_layer_forward():
+    for encoder in ENCODERS:
+        check_encoder(encoder)
+
+
+def main():
+    test_layer_forward()
+    print("[test_layer_forward]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# coding: utf-8
+"""
+The vectorized metrics match the per-sample loops they replaced
+in the evaluation of run_fastbert.py.
+"""
+import sys
+sys.path.append("../")
+import numpy as np
+import torch
+from fastbert.uer.utils.metrics import confusion_matrix, precision_recall_f1, mean_reciprocal_rank
+
+
+def loop_confusion_matrix(pred,
+                          gold,
+                          labels_num):
+    confusion = torch.zeros(labels_num, labels_num, dtype=torch.long)
+    for j in range(pred.size()[0]):
+        confusion[pred[j], gold[j]] += 1
+    return confusion
+
+
+def loop_precision_recall_f1(confusion):
+    scores = []
+    for i in range(confusion.size()[0]):
+        p = confusion[i,i].item()/confusion[i,:].sum().item()
+        r = confusion[i,i].item()/confusion[:,i].sum().item()
+        f1 = 2*p*r / (p+r)
+        scores.append((p, r, f1))
+    return scores
+
+
+def loop_mean_reciprocal_rank(scores,
+                              labels,
+                              qids):
+    # the rank of the best positive answer of each question
+    rank = []
+    start = 0
+    while start < len(qids):
+        end = start
+        while end < len(qids) and qids[end] == qids[start]:
+            end += 1
+        group = sorted(scores[start:end], reverse=True)
+        true_rank = min(group.index(scores[k]) for k in range(start, end) if labels[k] == 1)
+        rank.append(1 / (true_rank + 1))
+        start = end
+    return sum(rank) / len(rank)
+
+
+def test_confusion_and_f1():
+    torch.manual_seed(7)
+    labels_num = 4
+    pred = torch.randint(0, labels_num, (1000, ))
+    gold = torch.randint(0, labels_num, (1000, ))
+    confusion = confusion_matrix(pred, gold, labels_num)
+    assert torch.equal(confusion, loop_confusion_matrix(pred, gold, labels_num))
+    precision, recall, f1 = precision_recall_f1(confusion)
+    for i, (p, r, f) in enumerate(loop_precision_recall_f1(confusion)):
+        assert abs(precision[i].item() - p) < 1e-12
+        assert abs(recall[i].item() - r) < 1e-12
+        assert abs(f1[i].item() - f) < 1e-12
+
+
+def test_undefined_scores():
+    # label 2 is never predicted nor gold
+    confusion = confusion_matrix(torch.tensor([0, 1, 1]), torch.tensor([0, 1, 0]), 3)
+    precision, recall, f1 = precision_recall_f1(confusion)
+    assert precision.tolist() == [1.0, 0.5, 0.0]
+    assert recall.tolist() == [0.5, 1.0, 0.0]
+    assert f1[2].item() == 0.0
+
+
+def test_mean_reciprocal_rank():
+    rng = np.random.RandomState(7)
+    qids, labels = [], []
+    for qid in range(50):
+        answers_num = rng.randint(1, 8)
+        positives = rng.rand(answers_num) < 0.3
+        positives[rng.randint(answers_num)] = True
+        qids += [qid] * answers_num
+        labels += positives.astype(int).tolist()
+    scores = rng.rand(len(qids)).tolist()
+    mrr = mean_reciprocal_rank(scores, labels, qids)
+    assert abs(mrr - loop_mean_reciprocal_rank(scores, labels, qids)) < 1e-12
+
+    # questions without a positive answer are ignored
+    assert mean_reciprocal_rank(scores + [1.0, 0.5], labels + [0, 0], qids + [50, 50]) == mrr
+    assert mean_reciprocal_rank([], [], []) == 0.0
+
+
+def main():
+    test_confusion_and_f1()
+    test_undefined_scores()
+    test_mean_reciprocal_rank()
+    print("[test_metrics]: passed.")
+
+
+if __name__ == "__main__":
+    main()
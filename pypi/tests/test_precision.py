@@ -0,0 +1,111 @@
+# coding: utf-8
+"""
+Check that the early exit decisions under bf16 autocast agree with fp32,
+on a small randomly initialized kernel, so no pretrained model is needed.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+import torch.nn.functional as F
+from fastbert.fastbert import MiniClassifier
+from fastbert.utils import calc_uncertainty
+from fastbert.uer.model_builder import build_model
+from fastbert.uer.utils.precision import autocast
+
+
+LABELS_NUM = 3
+SEQ_LENGTH = 32
+SPEEDS = [0.1, 0.3, 0.5, 0.7, 0.9]
+# decisions are compared for samples whose fp32 uncertainties
+# are at least this far from the speed at every layer
+MARGIN = 0.05
+
+
+def build_tiny_model():
+    args = Namespace(emb_size=64, hidden_size=64, heads_num=4, feedforward_size=128,
+                     layers_num=4, dropout=0.0, embedding='bert', encoder='bert',
+                     target='none', subword_type='none', pooling='first',
+                     vocab=list(range(100)))
+    kernel = build_model(args)
+    classifiers = torch.nn.ModuleList([
+        MiniClassifier(args, args.hidden_size, LABELS_NUM)
+        for i in range(args.layers_num)
+    ])
+    # spread the uncertainties over (0, 1) instead of near-uniform predictions
+    for classifier in classifiers:
+        torch.nn.init.normal_(classifier.output_layer_2.weight, std=2.0)
+    kernel.eval()
+    classifiers.eval()
+    return kernel, classifiers
+
+
+def layer_uncertainties(kernel,
+                        classifiers,
+                        ids_batch,
+                        masks_batch,
+                        precision):
+    with torch.no_grad(), autocast('cpu', precision):
+        embs_batch = kernel.embedding(ids_batch, masks_batch)
+        states_batch = kernel.encoder.init_layer_state(embs_batch, masks_batch)
+        cls_masks_batch = (masks_batch > 0).unsqueeze(1).repeat(1, SEQ_LENGTH, 1).unsqueeze(1)
+        cls_masks_batch = (1.0 - cls_masks_batch.float()) * -10000.0
+
+        hiddens_batch = embs_batch
+        uncertainties = []
+        for i in range(kernel.encoder.layers_num):
+            hiddens_batch = kernel.encoder.layer_forward(i, hiddens_batch, states_batch)
+            probs = F.softmax(classifiers[i](hiddens_batch, cls_masks_batch), dim=1)
+            uncertainties.append(calc_uncertainty(probs, labels_num=LABELS_NUM))
+    return torch.stack(uncertainties, dim=1)  # batch_size x layers_num
+
+
+def exec_layers(uncertainties,
+                speed):
+    # the first layer where the uncertainty is at or below speed, or the last layer
+    exits = uncertainties <= speed
+    exits[:, -1] = True
+    return (exits.long().cumsum(dim=1) == 0).long().sum(dim=1) + 1
+
+
+def test_uncertainty_dtype():
+    probs = F.softmax(torch.randn(8, LABELS_NUM), dim=1)
+    uncertainty = calc_uncertainty(probs.bfloat16(), labels_num=LABELS_NUM)
+    assert uncertainty.dtype == torch.float32
+    assert torch.allclose(uncertainty, calc_uncertainty(probs, labels_num=LABELS_NUM), atol=1e-2)
+
+
+def test_exit_parity():
+    torch.manual_seed(7)
+    kernel, classifiers = build_tiny_model()
+    ids_batch = torch.randint(1, 100, (256, SEQ_LENGTH))
+    lengths = torch.randint(4, SEQ_LENGTH + 1, (256, 1))
+    masks_batch = (torch.arange(SEQ_LENGTH).unsqueeze(0) < lengths).long()
+    ids_batch = ids_batch * masks_batch
+
+    uncertainties_fp32 = layer_uncertainties(kernel, classifiers, ids_batch, masks_batch, 'fp32')
+    uncertainties_bf16 = layer_uncertainties(kernel, classifiers, ids_batch, masks_batch, 'bf16')
+    assert uncertainties_bf16.dtype == torch.float32
+    max_diff = (uncertainties_fp32 - uncertainties_bf16).abs().max().item()
+    print("[test_exit_parity]: max uncertainty difference = {:.4f}".format(max_diff))
+
+    for speed in SPEEDS:
+        clear = ((uncertainties_fp32 - speed).abs() >= MARGIN).all(dim=1)
+        layers_fp32 = exec_layers(uncertainties_fp32, speed)
+        layers_bf16 = exec_layers(uncertainties_bf16, speed)
+        agree = (layers_fp32 == layers_bf16)
+        print("[test_exit_parity]: speed = {}, agreement = {:.3f}, {} clear samples".format(
+            speed, agree.float().mean().item(), clear.sum().item()))
+        assert clear.sum().item() > 0
+        assert agree[clear].all(), \
+                "exit decisions differ at speed {}".format(speed)
+
+
+def main():
+    test_uncertainty_dtype()
+    test_exit_parity()
+    print("[test_precision]: passed.")
+
+
+if __name__ == "__main__":
+    main()
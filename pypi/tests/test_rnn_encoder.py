@@ -0,0 +1,78 @@
+# coding: utf-8
+"""
+The RNN encoders load the checkpoints of a multi-layer RNN into their
+single-layer RNNs, and running them packed gives each sentence the
+output of the multi-layer RNN over its valid tokens only.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+import torch.nn as nn
+from fastbert.uer.encoders.rnn_encoder import LstmEncoder, GruEncoder
+from fastbert.uer.utils.misc import reverse_padded
+
+
+LENGTHS = [9, 6, 1]
+
+
+def build_args(bidirectional):
+    return Namespace(emb_size=8, hidden_size=12, layers_num=3,
+                     dropout=0.0, bidirectional=bidirectional)
+
+
+def random_batch(emb_size):
+    emb = torch.randn(len(LENGTHS), max(LENGTHS), emb_size)
+    seg = (torch.arange(max(LENGTHS)).unsqueeze(0) < torch.tensor(LENGTHS).unsqueeze(1)).long()
+    return emb, seg
+
+
+def check_encoder(encoder_class,
+                  rnn_class,
+                  bidirectional):
+    torch.manual_seed(7)
+    args = build_args(bidirectional)
+    hidden_size = args.hidden_size // 2 if bidirectional else args.hidden_size
+    # the baseline, one multi-layer rnn
+    rnn = rnn_class(args.emb_size, hidden_size, args.layers_num,
+                    batch_first=True, bidirectional=bidirectional)
+    encoder = encoder_class(args)
+    encoder.load_state_dict({"rnn." + name: param for name, param in rnn.state_dict().items()})
+    encoder.eval()
+
+    emb, seg = random_batch(args.emb_size)
+    with torch.no_grad():
+        output = encoder(emb, seg)
+        for b, length in enumerate(LENGTHS):
+            expected, _ = rnn(emb[b:b+1, :length])
+            assert torch.allclose(output[b, :length], expected[0], atol=1e-5), (b, length)
+            assert (output[b, length:] == 0).all()
+
+
+def test_lstm_encoder():
+    check_encoder(LstmEncoder, nn.LSTM, False)
+    check_encoder(LstmEncoder, nn.LSTM, True)
+
+
+def test_gru_encoder():
+    check_encoder(GruEncoder, nn.GRU, False)
+    check_encoder(GruEncoder, nn.GRU, True)
+
+
+def test_reverse_padded():
+    emb, seg = random_batch(4)
+    reversed_emb = reverse_padded(emb, seg.sum(dim=1))
+    for b, length in enumerate(LENGTHS):
+        assert torch.equal(reversed_emb[b, :length], emb[b, :length].flip(0))
+        assert torch.equal(reversed_emb[b, length:], emb[b, length:])
+
+
+def main():
+    test_lstm_encoder()
+    test_gru_encoder()
+    test_reverse_padded()
+    print("[test_rnn_encoder]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# coding: utf-8
+"""
+Pruned heads and feed forward neurons are sliced out without changing
+the outputs of the kept ones, and a pruned model is rebuilt from the
+config saved by save_hyperparam.
+"""
+import os
+import sys
+sys.path.append("../")
+import copy
+import json
+import shutil
+import tempfile
+from argparse import Namespace
+import torch
+from fastbert.uer.model_builder import build_model
+from fastbert.uer.utils.config import load_hyperparam, save_hyperparam
+from fastbert.uer.utils.structured_pruning import TaylorImportance, prune_heads, prune_neurons
+
+
+CONFIG = {"emb_size": 32, "hidden_size": 32, "heads_num": 4,
+          "feedforward_size": 64, "layers_num": 2, "dropout": 0.0}
+KEPT_HEADS = [[0, 2], [3]]
+KEPT_NEURONS = [list(range(0, 64, 2)), list(range(10))]
+
+
+def build_args(config_path):
+    args = Namespace(config_path=config_path, embedding='bert', encoder='bert',
+                     target='none', subword_type='none', vocab=list(range(50)))
+    return load_hyperparam(args)
+
+
+def encode(model,
+           src,
+           seg):
+    with torch.no_grad():
+        return model.encoder(model.embedding(src, seg), seg)
+
+
+def test_prune_and_rebuild():
+    torch.manual_seed(7)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(tmp_dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(CONFIG, f)
+        args = build_args(config_path)
+        model = build_model(args)
+        model.eval()
+        src = torch.randint(1, 50, (3, 10))
+        seg = torch.tensor([[1] * 10, [1] * 6 + [0] * 4, [1] * 3 + [0] * 7])
+
+        # the reference zeroes the inputs of the output projections
+        # from the pruned heads and neurons
+        zeroed = copy.deepcopy(model)
+        with torch.no_grad():
+            for layer, heads, neurons in zip(zeroed.encoder.transformer, KEPT_HEADS, KEPT_NEURONS):
+                per_head_size = layer.self_attn.per_head_size
+                pruned = torch.ones(CONFIG["hidden_size"], dtype=torch.bool)
+                for h in heads:
+                    pruned[h * per_head_size: (h + 1) * per_head_size] = False
+                layer.self_attn.final_linear.weight[:, pruned] = 0.0
+                pruned = torch.ones(CONFIG["feedforward_size"], dtype=torch.bool)
+                pruned[neurons] = False
+                layer.feed_forward.linear_2.weight[:, pruned] = 0.0
+
+        for layer, heads, neurons in zip(model.encoder.transformer, KEPT_HEADS, KEPT_NEURONS):
+            prune_heads(layer.self_attn, torch.tensor(heads))
+            prune_neurons(layer.feed_forward, torch.tensor(neurons))
+        output = encode(model, src, seg)
+        assert output.size() == (3, 10, CONFIG["hidden_size"])
+        assert torch.allclose(output, encode(zeroed, src, seg), atol=1e-5)
+
+        # rebuild the pruned model from the saved config
+        args.heads_num = [len(heads) for heads in KEPT_HEADS]
+        args.feedforward_size = [len(neurons) for neurons in KEPT_NEURONS]
+        args.per_head_size = CONFIG["hidden_size"] // CONFIG["heads_num"]
+        pruned_config_path = os.path.join(tmp_dir, 'pruned_config.json')
+        save_hyperparam(args, pruned_config_path)
+        reference = build_model(build_args(pruned_config_path))
+        reference.load_state_dict(model.state_dict())
+        reference.eval()
+        assert torch.allclose(output, encode(reference, src, seg), atol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_taylor_importance():
+    torch.manual_seed(7)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(tmp_dir, 'config.json')
+        with open(config_path, 'w') as f:
+            json.dump(CONFIG, f)
+        model = build_model(build_args(config_path))
+        src = torch.randint(1, 50, (4, 10))
+        seg = torch.ones(4, 10, dtype=torch.int64)
+        importance = TaylorImportance(list(model.encoder.transformer))
+        model.encoder(model.embedding(src, seg), seg).pow(2).mean().backward()
+        importance.accumulate()
+        heads_num, feedforward_size = importance.prune(head_keep_ratio=0.5, ffn_keep_ratio=0.25)
+        assert heads_num == [2, 2]
+        assert feedforward_size == [16, 16]
+        assert encode(model, src, seg).size() == (4, 10, CONFIG["hidden_size"])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_prune_and_rebuild()
+    test_taylor_importance()
+    print("[test_structured_pruning]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# coding: utf-8
+"""
+word2sub looks up the char ids of words from the precomputed table
+as the per-word loop it replaced did.
+"""
+import sys
+sys.path.append("../")
+import torch
+from fastbert.uer.utils.constants import UNK_ID
+from fastbert.uer.utils.vocab import Vocab
+from fastbert.uer.utils.subword import build_sub_table, word2sub
+
+
+def build_vocab(words):
+    vocab = Vocab()
+    vocab.i2w = list(words)
+    vocab.w2i = {w: i for i, w in enumerate(words)}
+    return vocab
+
+
+def loop_word2sub(word_ids,
+                  vocab,
+                  sub_vocab):
+    # the baseline
+    word_ids = word_ids.contiguous().view(-1).tolist()
+    words = [vocab.i2w[i] for i in word_ids]
+    max_length = max([len(w) for w in words])
+    sub_ids = torch.zeros((len(words), max_length), dtype=torch.long)
+    for i in range(len(words)):
+        for j, c in enumerate(words[i]):
+            sub_ids[i, j] = sub_vocab.w2i.get(c, UNK_ID)
+    return sub_ids
+
+
+def test_word2sub():
+    vocab = build_vocab(["[PAD]", "[UNK]", "[CLS]", "a", "ab", "abc", "北京", "xyz", "abcabcabcabc"])
+    sub_vocab = build_vocab(["[PAD]", "[UNK]", "a", "b", "c", "北", "京"])
+    sub_table, sub_lengths = build_sub_table(vocab, sub_vocab, "char")
+    assert sub_table.size() == (len(vocab), 12)
+    batches = [
+        # padding ids, and words shorter than the longest word of the vocabulary
+        torch.tensor([[2, 3, 4, 0, 0], [2, 6, 0, 0, 0]]),
+        # the unknown word, and a word of unknown chars
+        torch.tensor([[2, 1, 7, 5, 0]]),
+        # the longest word of the vocabulary
+        torch.tensor([[2, 8, 3], [2, 4, 8]]),
+        # padding only
+        torch.tensor([[0, 0, 0]]),
+    ]
+    for word_ids in batches:
+        sub_ids = word2sub(word_ids, sub_table, sub_lengths)
+        expected = loop_word2sub(word_ids, vocab, sub_vocab)
+        assert sub_ids.size() == expected.size(), (sub_ids.size(), expected.size())
+        assert torch.equal(sub_ids, expected)
+
+
+def main():
+    test_word2sub()
+    print("[test_subword]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""
+The losses of the language modeling targets, which gather the target
+log-probabilities, match the one-hot products they replaced, and the
+seq2seq target decodes the whole sequence as the step-by-step loop did.
+"""
+import sys
+sys.path.append("../")
+from argparse import Namespace
+import torch
+from fastbert.uer.utils.act_fun import gelu
+from fastbert.uer.targets.lm_target import LmTarget
+from fastbert.uer.targets.mlm_target import MlmTarget
+from fastbert.uer.targets.bilm_target import BilmTarget
+from fastbert.uer.targets.s2s_target import S2sTarget
+
+
+VOCAB_SIZE = 30
+ARGS = Namespace(hidden_size=16, emb_size=12)
+
+
+def one_hot_nll(output,
+                tgt):
+    # the baseline, output is [n x vocab_size] log-probabilities
+    one_hot = torch.zeros(output.size(0), VOCAB_SIZE). \
+        scatter_(1, tgt.contiguous().view(-1,1), 1.0)
+    return -torch.sum(output * one_hot, 1)
+
+
+def masked_loss(output,
+                tgt):
+    tgt = tgt.contiguous().view(-1)
+    label_mask = (tgt > 0).float()
+    return torch.sum(label_mask * one_hot_nll(output, tgt)) / (torch.sum(label_mask) + 1e-6)
+
+
+def random_batch(hidden_size):
+    memory_bank = torch.randn(3, 7, hidden_size)
+    tgt = torch.randint(1, VOCAB_SIZE, (3, 7))
+    tgt[1, 4:] = 0
+    tgt[2, 2:] = 0
+    return memory_bank, tgt
+
+
+def test_lm_target():
+    torch.manual_seed(7)
+    target = LmTarget(ARGS, VOCAB_SIZE)
+    memory_bank, tgt = random_batch(ARGS.hidden_size)
+    loss, correct, denominator = target(memory_bank, tgt)
+    output = target.softmax(target.output_layer(memory_bank).view(-1, VOCAB_SIZE))
+    assert torch.allclose(loss, masked_loss(output, tgt), atol=1e-6)
+    assert abs(denominator.item() - (tgt > 0).sum().item()) < 1e-4
+    label_mask = tgt.view(-1) > 0
+    assert correct.item() == output.argmax(dim=-1)[label_mask].eq(tgt.view(-1)[label_mask]).sum().item()
+
+
+def test_bilm_target():
+    torch.manual_seed(7)
+    target = BilmTarget(ARGS, VOCAB_SIZE)
+    memory_bank, tgt_forward = random_batch(ARGS.hidden_size)
+    _, tgt_backward = random_batch(ARGS.hidden_size)
+    loss_forward, loss_backward, _, _, _ = target(memory_bank, (tgt_forward, tgt_backward))
+    half = ARGS.hidden_size // 2
+    for loss, hidden, tgt in [(loss_forward, memory_bank[:, :, :half], tgt_forward),
+                              (loss_backward, memory_bank[:, :, half:], tgt_backward)]:
+        output = target.softmax(target.output_layer(hidden).contiguous().view(-1, VOCAB_SIZE))
+        assert torch.allclose(loss, masked_loss(output, tgt), atol=1e-6)
+
+
+def test_mlm_target():
+    torch.manual_seed(7)
+    target = MlmTarget(ARGS, VOCAB_SIZE)
+    memory_bank, tgt = random_batch(ARGS.hidden_size)
+    loss, correct, denominator = target.mlm(memory_bank, tgt)
+    tgt = tgt.view(-1)
+    output = target.layer_norm(gelu(target.mlm_linear_1(memory_bank))).view(-1, ARGS.hidden_size)
+    output = target.softmax(target.mlm_linear_2(output[tgt > 0]))
+    expected = torch.sum(one_hot_nll(output, tgt[tgt > 0])) / (output.size(0) + 1e-6)
+    assert torch.allclose(loss, expected, atol=1e-6)
+    assert correct.item() == output.argmax(dim=-1).eq(tgt[tgt > 0]).sum().item()
+
+
+def test_s2s_target():
+    torch.manual_seed(7)
+    target = S2sTarget(ARGS, VOCAB_SIZE)
+    memory_bank, tgt = random_batch(ARGS.hidden_size)
+    loss, correct, denominator = target(memory_bank, tgt)
+
+    # the baseline feeds the decoder one step at a time
+    emb = target.embedding_layer(tgt)
+    output = []
+    hidden_state = (memory_bank[:,-1,:].unsqueeze(0).contiguous(), memory_bank[:,-1,:].unsqueeze(0).contiguous())
+    for i, emb_i in enumerate(emb.split(1, dim=1)):
+        output_i, hidden_state = target.decoder(emb_i, hidden_state)
+        output.append(target.output_layer(output_i))
+    output = target.softmax(torch.cat(output, dim=1).contiguous().view(-1, VOCAB_SIZE))
+    assert torch.allclose(loss, masked_loss(output, tgt), atol=1e-5)
+    label_mask = tgt.view(-1) > 0
+    assert correct.item() == output.argmax(dim=-1)[label_mask].eq(tgt.view(-1)[label_mask]).sum().item()
+
+
+def test_inf_log_probability():
+    # a -inf log-probability of another word made the one-hot product nan
+    output = torch.log_softmax(torch.tensor([[0.0, 1.0, float('-inf')]]), dim=-1)
+    tgt = torch.tensor([[1]])
+    assert torch.isnan(torch.sum(output * torch.zeros(1, 3).scatter_(1, tgt, 1.0)))
+    assert torch.isfinite(-output.gather(1, tgt)).all()
+
+
+def main():
+    test_lm_target()
+    test_bilm_target()
+    test_mlm_target()
+    test_s2s_target()
+    test_inf_log_probability()
+    print("[test_targets]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# coding: utf-8
+"""
+Token pruning keeps the tokens of each sentence independently of the
+other sentences in the batch, so forward and batch_forward agree.
+"""
+import sys
+sys.path.append("../")
+import torch
+import torch.nn.functional as F
+from fastbert import FastBERT
+from fastbert.uer.utils.token_pruning import keep_ratio_schedule, scheduled_lengths, prune_tokens
+
+
+def random_batch(lengths,
+                 seq_length,
+                 hidden_size=8,
+                 heads_num=2):
+    hidden = torch.randn(len(lengths), seq_length, hidden_size)
+    valid = torch.arange(seq_length).unsqueeze(0) < torch.tensor(lengths).unsqueeze(1)
+    scores = torch.randn(len(lengths), heads_num, seq_length, seq_length)
+    scores = scores.masked_fill(~valid.unsqueeze(1).unsqueeze(1), -10000.0)
+    return hidden, F.softmax(scores, dim=-1), valid
+
+
+def test_prune_tokens_per_sample():
+    torch.manual_seed(7)
+    lengths = [16, 11, 5, 2]
+    hidden, probs, valid = random_batch(lengths, 16)
+    for ratio in [0.3, 0.5, 0.7, 1.0]:
+        pruned, pruned_valid, mask = prune_tokens(hidden, probs, valid, ratio)
+        assert mask.size() == (len(lengths), 1, 1, pruned.size(1))
+        for b, length in enumerate(lengths):
+            # the sentence alone, without the padding of the batch
+            alone, alone_valid, _ = prune_tokens(hidden[b:b+1, :length], probs[b:b+1, :, :length, :length],
+                                                 valid[b:b+1, :length], ratio)
+            assert torch.equal(pruned[b][pruned_valid[b]], alone[0][alone_valid[0]])
+            assert pruned_valid[b, 0].item()
+
+
+def test_scheduled_lengths():
+    torch.manual_seed(7)
+    lengths = [32, 20, 9, 1]
+    ratios = keep_ratio_schedule(4, 0.7, start_layer=1)
+    layer_lengths = scheduled_lengths(32, ratios, lengths)
+    hidden, probs, valid = random_batch(lengths, 32)
+    for i, ratio in enumerate(ratios[:-1]):
+        hidden, valid, _ = prune_tokens(hidden, probs, valid, ratio)
+        assert valid.sum(dim=1).tolist() == layer_lengths[:, i + 1].tolist()
+        length = hidden.size(1)
+        probs = F.softmax(torch.randn(len(lengths), 2, length, length), dim=-1)
+
+
+def test_forward_and_batch_forward():
+    sents = [
+        '你吃北京烤鸭吗?',
+        '我吃宫爆鸡丁!',
+        '还是吃老干妈吧',
+        '这本书的前半部分写得很好，后半部分有些拖沓，但总体来说值得一读。',
+    ]
+    model = FastBERT("google_bert_base_zh", labels=['0', '1'], device='cpu',
+                     seq_length=64, keep_ratio=0.5, prune_start_layer=1)
+    for speed in [0.0, 0.5, 1.0]:
+        labels, exec_layers = model.batch_forward(sents, speed=speed)
+        ids_batch, masks_batch = model._convert_to_tensors(sents)
+        probs_batch, _ = model._fast_infer_tensors(ids_batch, masks_batch, speed)
+        for i, sent in enumerate(sents):
+            label, exec_layer_num = model(sent, speed=speed)
+            assert label == labels[i], (speed, sent)
+            assert exec_layer_num == exec_layers[i], (speed, sent)
+            probs, _ = model._fast_infer_tensors(ids_batch[i:i+1], masks_batch[i:i+1], speed)
+            assert torch.allclose(probs[0], probs_batch[i], atol=1e-5), (speed, sent)
+
+
+def main():
+    test_prune_tokens_per_sample()
+    test_scheduled_lengths()
+    test_forward_and_batch_forward()
+    print("[test_token_pruning]: passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# coding: utf-8
+"""
+Vocabularies are built by workers counting byte ranges of the corpus,
+exactly or with bounded counters, and loaded from the binary cache
+beside the vocabulary file when it is made from the same file.
+"""
+import os
+import sys
+sys.path.append("../")
+import pickle
+import random
+import shutil
+import tempfile
+import collections
+from fastbert.uer.utils.vocab import Vocab, _cache_path, _file_stamp, _save_cache, \
+        _count_worker, _prune_counter
+
+
+TOKENS = ["[PAD]", "[UNK]", "的", "a", "##b", "[CLS]", "[SEP]"]
+
+
+def write_vocab(tmp_dir,
+                tokens=TOKENS):
+    vocab_path = os.path.join(tmp_dir, 'vocab.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(tokens) + "\n")
+    return vocab_path
+
+
+def load(vocab_path):
+    vocab = Vocab()
+    vocab.load(vocab_path, is_quiet=True)
+    return vocab
+
+
+RESERVED = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+class SpaceTokenizer(object):
+
+    def tokenize(self, text):
+        return text.split()
+
+
+def write_corpus(tmp_dir,
+                 lines_num=2000,
+                 seed=7):
+    # Zipf-like word frequencies, lines of various lengths and non-ascii words
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(300)] + ["北京", "烤鸭"]
+    weights = [1.0 / (i + 1) for i in range(len(words))]
+    lines = [" ".join(rng.choices(words, weights, k=rng.randint(0, 30))) for _ in range(lines_num)]
+    corpus_path = os.path.join(tmp_dir, 'corpus.txt')
+    with open(corpus_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    counter = collections.Counter(t for line in lines for t in line.split())
+    return corpus_path, counter
+
+
+def build(tmp_dir,
+          corpus_path,
+          **kwargs):
+    reserved_path = os.path.join(tmp_dir, 'reserved_vocab.txt')
+    with open(reserved_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(RESERVED) + "\n")
+    vocab = Vocab()
+    vocab.reserved_vocab_path = reserved_path
+    vocab.build(corpus_path, SpaceTokenizer(), **kwargs)
+    return vocab
+
+
+def test_build_exact():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        corpus_path, counter = write_corpus(tmp_dir)
+        expected = RESERVED + [w for w, _ in sorted(counter.items(), key=lambda item: (-item[1], item[0]))]
+        for workers_num in [1, 2, 3, 7]:
+            vocab = build(tmp_dir, corpus_path, workers_num=workers_num)
+            assert vocab.i2w == expected, workers_num
+            assert all(vocab.w2c[w] == c for w, c in counter.items())
+        vocab = build(tmp_dir, corpus_path, workers_num=3, min_count=5, top_k=50)
+        assert vocab.i2w == expected[:len(RESERVED) + 50]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_byte_ranges():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        corpus_path, counter = write_corpus(tmp_dir, lines_num=300)
+        file_size = os.path.getsize(corpus_path)
+        with open(corpus_path, 'rb') as f:
+            data = f.read()
+        line_starts = [0] + [i + 1 for i, b in enumerate(data) if b == ord("\n")]
+        # boundaries at line starts, just before and after them and inside
+        # lines (including inside a multi-byte char) count each line once
+        boundaries = sorted(set([b for s in line_starts[::7] for b in [s - 1, s, s + 1]] +
+                                random.Random(7).sample(range(file_size), 50)))
+        boundaries = [0] + [b for b in boundaries if 0 < b < file_size] + [file_size]
+        total = collections.Counter()
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            total.update(_count_worker(corpus_path, SpaceTokenizer(), start, end, batch_size=3))
+        assert total == counter
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_build_sketch():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        corpus_path, counter = write_corpus(tmp_dir)
+        tokens_num = sum(counter.values())
+        for sketch_size in [10, 40]:
+            vocab = build(tmp_dir, corpus_path, workers_num=4, sketch_size=sketch_size)
+            assert len(vocab) <= len(RESERVED) + sketch_size
+            for w, c in counter.items():
+                if c > tokens_num / float(sketch_size + 1):
+                    assert w in vocab.w2i, (sketch_size, w, c)
+                if w in vocab.w2c:
+                    # counts are underestimated by at most tokens_num / (sketch_size + 1)
+                    assert c - tokens_num / float(sketch_size + 1) <= vocab.w2c[w] <= c
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_prune_counter():
+    counter = collections.Counter({"a": 10, "b": 6, "c": 3, "d": 3, "e": 1})
+    assert _prune_counter(counter, 5) is counter
+    assert _prune_counter(counter, 2) == collections.Counter({"a": 7, "b": 3})
+    assert _prune_counter(counter, 3) == collections.Counter({"a": 7, "b": 3})
+
+
+def test_binary_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vocab_path = write_vocab(tmp_dir)
+        assert load(vocab_path).i2w == TOKENS
+        assert os.path.exists(_cache_path(vocab_path))
+        vocab = load(vocab_path)
+        assert vocab.i2w == TOKENS
+        assert vocab.w2i["a"] == 3
+
+        # the cache is read instead of the text when the stamps match
+        _save_cache(vocab_path, _file_stamp(vocab_path), ["x", "y"])
+        assert load(vocab_path).i2w == ["x", "y"]
+
+        # a modified file is read again
+        write_vocab(tmp_dir, TOKENS + ["c"])
+        os.utime(vocab_path, ns=(0, 10 ** 9))
+        assert load(vocab_path).i2w == TOKENS + ["c"]
+        assert load(vocab_path).i2w == TOKENS + ["c"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_invalid_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vocab_path = write_vocab(tmp_dir)
+        # the pickles of older versions are never unpickled
+        with open(_cache_path(vocab_path), 'wb') as f:
+            pickle.dump({"stamp": _file_stamp(vocab_path), "i2w": ["x"]}, f)
+        assert load(vocab_path).i2w == TOKENS
+        # a truncated cache
+        with open(_cache_path(vocab_path), 'rb') as f:
+            data = f.read()
+        with open(_cache_path(vocab_path), 'wb') as f:
+            f.write(data[:-3])
+        assert load(vocab_path).i2w == TOKENS
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_read_only_dir():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vocab_path = write_vocab(tmp_dir)
+        os.chmod(tmp_dir, 0o555)
+        if os.access(tmp_dir, os.W_OK):
+            # e.g., running as root
+            return
+        assert load(vocab_path).i2w == TOKENS
+        assert os.listdir(tmp_dir) == ['vocab.txt']
+    finally:
+        os.chmod(tmp_dir, 0o755)
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    test_build_exact()
+    test_byte_ranges()
+    test_build_sketch()
+    test_prune_counter()
+    test_binary_cache()
+    test_invalid_cache()
+    test_read_only_dir()
+    print("[test_vocab]: passed.")
+
+
+if __name__ == "__main__":
+    main()
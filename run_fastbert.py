@@ -10,26 +10,35 @@ import random
 import argparse
 import collections
 import torch.nn as nn
-from uer.utils.vocab import Vocab
+from uer.utils.vocab import load_vocab
 from uer.utils.constants import *
 from uer.utils.tokenizer import * 
 from uer.model_builder import build_model
 from uer.utils.optimizers import *
-from uer.utils.config import load_hyperparam
+from uer.utils.config import load_hyperparam, save_hyperparam
 from uer.utils.seed import set_seed
 from uer.model_saver import save_model
 from uer.model_loader import load_model
+from uer.utils.checkpoint import materialize_meta
+from uer.utils.calibration import calibrate_thresholds, select_exit_layers
+from uer.utils.exit_stats import ExitStats
+from uer.utils.flops import FLOPS_ENCODERS, fastbert_flops
+from uer.utils.metrics import confusion_matrix, precision_recall_f1, mean_reciprocal_rank
+from uer.utils.misc import select_state
+from uer.utils.token_pruning import keep_ratio_schedule, scheduled_lengths, prune_tokens
+from uer.utils.structured_pruning import TaylorImportance
+from uer.utils.precision import PRECISIONS, check_precision, autocast, grad_scaler, backward, optimizer_step
 from uer.layers.multi_headed_attn import MultiHeadedAttention
 import numpy as np
 import time
-from thop import profile
 
 
 torch.set_num_threads(1)
 
 
 def normal_shannon_entropy(p, labels_num):
-    entropy = torch.distributions.Categorical(probs=p).entropy()
+    # Computed in float32, so exit decisions do not depend on the autocast precision.
+    entropy = torch.distributions.Categorical(probs=p.float()).entropy()
     normal = -np.log(1.0/labels_num)
     return entropy / normal
 
@@ -51,7 +60,12 @@ class Classifier(nn.Module):
     def forward(self, hidden, mask):
 
         hidden = torch.tanh(self.output_layer_0(hidden))
-        hidden = self.self_atten(hidden, hidden, hidden, mask)
+        if self.pooling not in ["mean", "max", "last"]:
+            # Only the first position is pooled, so attention is
+            # computed for its query alone.
+            hidden = self.self_atten(hidden, hidden, hidden[:, :1, :], mask[:, :, :1, :])
+        else:
+            hidden = self.self_atten(hidden, hidden, hidden, mask)
         
         if self.pooling == "mean":
             hidden = torch.mean(hidden, dim=-1)
@@ -63,7 +77,8 @@ class Classifier(nn.Module):
             hidden = hidden[:, 0, :]
 
         output_1 = torch.tanh(self.output_layer_1(hidden))
-        logits = self.output_layer_2(output_1)
+        # Losses, softmax and entropy are computed from float32 logits under autocast.
+        logits = self.output_layer_2(output_1).float()
         return logits
 
 
@@ -82,6 +97,24 @@ class FastBertClassifier(nn.Module):
         self.criterion = nn.NLLLoss()
         self.soft_criterion = nn.KLDivLoss(reduction='batchmean')
         self.threshold = args.speed
+        # Per-layer thresholds calibrated on the devset,
+        # negative values fall back to the global speed.
+        self.register_buffer("thresholds", torch.full((self.encoder.layers_num,), -1.0))
+        # Layers where samples are allowed to exit, the classifiers
+        # of the other layers are skipped in fast mode.
+        exit_layers = torch.ones(self.encoder.layers_num, dtype=torch.bool)
+        if args.exit_layers is not None:
+            exit_layers.fill_(False)
+            exit_layers[[int(l) - 1 for l in args.exit_layers.split(",")]] = True
+        exit_layers[-1] = True
+        self.register_buffer("exit_layers", exit_layers)
+        # Exit statistics of fast mode, not recorded if None.
+        self.exit_stats = None
+        # Ratio of the tokens kept after each layer at inference.
+        self.keep_ratios = keep_ratio_schedule(self.encoder.layers_num, args.keep_ratio, args.prune_start_layer)
+        self.pruning = args.keep_ratio < 1.0
+        if self.pruning:
+            assert args.encoder == "bert", "Token pruning is only supported by the bert encoder."
 
     def forward(self, src, label, mask, fast=True):
         """
@@ -89,18 +122,12 @@ class FastBertClassifier(nn.Module):
             src: [batch_size x seq_length]
             label: [batch_size]
             mask: [batch_size x seq_length]
-        """
-        # Embedding.
-        emb = self.embedding(src, mask)
 
-        # Encoder.
-        seq_length = emb.size(1)
-        mask = (mask > 0). \
-                unsqueeze(1). \
-                repeat(1, seq_length, 1). \
-                unsqueeze(1)
-        mask = mask.float()
-        mask = (1.0 - mask) * -10000.0
+        Returns:
+            In inference, the executed layers of each sample ([batch_size],
+            None in normal mode) and the logits ([batch_size x labels_num]).
+        """
+        emb, mask, state = self._embedding(src, mask)
          
         if self.training:
 
@@ -109,7 +136,7 @@ class FastBertClassifier(nn.Module):
                 # training main part of the model
                 hidden = emb
                 for i in range(self.encoder.layers_num):
-                    hidden = self.encoder.transformer[i](hidden, mask)
+                    hidden = self.encoder.layer_forward(i, hidden, state)
                 logits = self.classifiers[-1](hidden, mask)
                 loss = self.criterion(self.softmax(logits.view(-1, self.labels_num)), label.view(-1))
                 return loss, logits
@@ -118,7 +145,7 @@ class FastBertClassifier(nn.Module):
                 loss, hidden, hidden_list = 0, emb, []
                 with torch.no_grad():
                     for i in range(self.encoder.layers_num):
-                        hidden = self.encoder.transformer[i](hidden, mask)
+                        hidden = self.encoder.layer_forward(i, hidden, state)
                         hidden_list.append(hidden)
                     teacher_logits = self.classifiers[-1](hidden_list[-1], mask).view(-1, self.labels_num) 
                 teacher_probs = nn.functional.softmax(teacher_logits, dim=1)
@@ -134,41 +161,164 @@ class FastBertClassifier(nn.Module):
                 # fast mode 
                 hidden = emb  # (batch_size, seq_len, emb_size)
                 batch_size = hidden.size(0)
-                logits = torch.zeros(batch_size, self.labels_num, dtype=hidden.dtype, device=hidden.device)
+                logits = torch.zeros(batch_size, self.labels_num, device=hidden.device)
+                exec_layers = torch.full((batch_size,), self.encoder.layers_num, dtype=torch.long, device=hidden.device)
                 abs_diff_idxs = torch.arange(0, batch_size, dtype=torch.long, device=hidden.device)
+                # Read once on the host, instead of syncing the device at every layer.
+                thresholds, exit_layers = self._thresholds(), self.exit_layers.tolist()
                 for i in range(self.encoder.layers_num):
+                    if self.exit_stats is not None:
+                        start = self._clock(hidden)
                     
-                    hidden = self.encoder.transformer[i](hidden, mask)
+                    hidden, probs = self._layer_forward(i, hidden, state)
+
+                    # skip the classifier if no sample is allowed to exit here
+                    if not exit_layers[i]:
+                        if self.exit_stats is not None:
+                            self._record_layer(i, hidden, None, None, start)
+                        hidden, mask = self._prune_tokens(i, hidden, mask, state, probs)
+                        continue
 
                     logits_this_layer = self.classifiers[i](hidden, mask)  # (batch_size, labels_num)
                     logits[abs_diff_idxs] = logits_this_layer
 
                     # filter easy sample
-                    abs_diff_idxs, rel_diff_idxs = self._difficult_samples_idxs(abs_diff_idxs, logits_this_layer) 
+                    exits = torch.ones(abs_diff_idxs.size(0), dtype=torch.bool, device=hidden.device)
+                    exec_idxs = abs_diff_idxs
+                    abs_diff_idxs, rel_diff_idxs = self._difficult_samples_idxs(abs_diff_idxs, logits_this_layer, thresholds[i])
+                    exits[rel_diff_idxs] = False
+                    exec_layers[exec_idxs[exits]] = i + 1
+                    if self.exit_stats is not None:
+                        self._record_layer(i, hidden, logits_this_layer, rel_diff_idxs, start)
                     hidden = hidden[rel_diff_idxs, :, :]
                     mask = mask[rel_diff_idxs, :, :]
+                    state = select_state(state, rel_diff_idxs)
                     
                     if len(abs_diff_idxs) == 0:
                         break
 
-                return None, logits
+                    if probs is not None:
+                        probs = probs[rel_diff_idxs]
+                    hidden, mask = self._prune_tokens(i, hidden, mask, state, probs)
+
+                return exec_layers, logits
             else:
                 # normal mode
                 hidden = emb
                 for i in range(self.encoder.layers_num):
-                    hidden = self.encoder.transformer[i](hidden, mask)
+                    hidden, probs = self._layer_forward(i, hidden, state)
+                    hidden, mask = self._prune_tokens(i, hidden, mask, state, probs)
                 logits = self.classifiers[-1](hidden, mask)
                 return None, logits
+
+    def layer_logits(self, src, mask):
+        """
+        Run all layers and all classifiers without early exit.
+
+        Args:
+            src: [batch_size x seq_length]
+            mask: [batch_size x seq_length]
+
+        Returns:
+            logits: [batch_size x layers_num x labels_num]
+        """
+        hidden, mask, state = self._embedding(src, mask)
+        logits = []
+        for i in range(self.encoder.layers_num):
+            hidden, probs = self._layer_forward(i, hidden, state)
+            logits.append(self.classifiers[i](hidden, mask))
+            hidden, mask = self._prune_tokens(i, hidden, mask, state, probs)
+        return torch.stack(logits, dim=1)
+
+    def fast_logits(self, layer_logits):
+        """
+        Simulate fast mode on the outputs of layer_logits, i.e., each sample
+        takes the logits of the first exit layer where it is not difficult.
+
+        Args:
+            layer_logits: [batch_size x layers_num x labels_num]
+
+        Returns:
+            exec_layers: [batch_size]
+            logits: [batch_size x labels_num]
+            entropys: [batch_size x layers_num]
+        """
+        probs = nn.Softmax(dim=-1)(layer_logits)
+        entropys = normal_shannon_entropy(probs, self.labels_num)
+        thresholds = torch.tensor(self._thresholds(), dtype=entropys.dtype, device=entropys.device)
+        exits = (entropys <= thresholds) & self.exit_layers
+        exits[:, -1] = True
+        # The number of layers before the first exit.
+        exit_idxs = (exits.long().cumsum(dim=1) == 0).long().sum(dim=1)
+        logits = layer_logits[torch.arange(layer_logits.size(0), device=layer_logits.device), exit_idxs]
+        return exit_idxs + 1, logits, entropys
+
+    def _embedding(self, src, mask):
+        # Embedding.
+        emb = self.embedding(src, mask)
+
+        # Encoder, its layers are run one by one with the shared state.
+        state = self.encoder.init_layer_state(emb, mask)
+        if self.pruning:
+            # Positions of the tokens, updated as tokens are pruned.
+            state["valid"] = mask > 0
+
+        # Mask of the classifiers.
+        seq_length = emb.size(1)
+        mask = (mask > 0). \
+                unsqueeze(1). \
+                repeat(1, seq_length, 1). \
+                unsqueeze(1)
+        mask = mask.float()
+        mask = (1.0 - mask) * -10000.0
+        return emb, mask, state
+
+    def _layer_forward(self, i, hidden, state):
+        # The attention probabilities are needed only if tokens are pruned after this layer.
+        if self.training or self.keep_ratios[i] >= 1.0:
+            return self.encoder.layer_forward(i, hidden, state), None
+        return self.encoder.layer_forward(i, hidden, state, return_probs=True)
+
+    def _prune_tokens(self, i, hidden, mask, state, probs):
+        # Return the pruned hidden states and their mask, or the given ones if not pruned.
+        if probs is None:
+            return hidden, mask
+        hidden, state["valid"], state["mask"] = prune_tokens(hidden, probs, state["valid"], self.keep_ratios[i])
+        return hidden, state["mask"]
+
+    def _clock(self, hidden):
+        # Wait for the queued kernels so that the wall time is per layer.
+        if hidden.is_cuda:
+            torch.cuda.synchronize(hidden.device)
+        return time.perf_counter()
+
+    def _record_layer(self, layer, hidden, logits, rel_diff_idxs, start):
+        seconds = self._clock(hidden) - start
+        if logits is None:
+            self.exit_stats.record_layer(layer, hidden.size(0), seconds)
+            return
+        probs = nn.Softmax(dim=1)(logits)
+        entropys = normal_shannon_entropy(probs, self.labels_num)
+        self.exit_stats.record_layer(layer, hidden.size(0), seconds, entropys.cpu().numpy())
+        # All remaining samples exit at the last layer.
+        exits = torch.ones(logits.size(0), dtype=torch.bool, device=logits.device)
+        if layer < self.encoder.layers_num - 1:
+            exits[rel_diff_idxs] = False
+        self.exit_stats.record_exits(layer, torch.argmax(probs[exits], dim=1).cpu().numpy())
+
+    def _thresholds(self):
+        # Threshold of each layer on the host, a sample exits if its entropy is at or below it.
+        return [t if t >= 0 else self.threshold for t in self.thresholds.tolist()]
                     
-    def _difficult_samples_idxs(self, idxs, logits):
+    def _difficult_samples_idxs(self, idxs, logits, threshold):
         # logits: (batch_size, labels_num)
         probs = nn.Softmax(dim=1)(logits)
         entropys = normal_shannon_entropy(probs, self.labels_num)
         # torch.nonzero() is very time-consuming on GPU 
         # Please see https://github.com/pytorch/pytorch/issues/14848
         # If anyone can optimize this operation, please contact me, thank you!
-        rel_diff_idxs = (entropys > self.threshold).nonzero().view(-1)
-        abs_diff_idxs = torch.tensor([idxs[i] for i in rel_diff_idxs], device=logits.device)
+        rel_diff_idxs = (entropys > threshold).nonzero().view(-1)
+        abs_diff_idxs = idxs[rel_diff_idxs]
         return abs_diff_idxs, rel_diff_idxs
         
         
@@ -190,6 +340,11 @@ def main():
                         help="Path of the testset.")
     parser.add_argument("--config_path", default="./models/bert_base_config.json", type=str,
                         help="Path of the config file.")
+    parser.add_argument("--output_config_path", default=None, type=str,
+                        help="Path of the output config file, which records the per-layer sizes of the pruned backbone. "
+                             "By default, it is the output model path with the suffix .json.")
+    parser.add_argument("--flat_checkpoint", action="store_true",
+                        help="Save the output model in the flat format, which is memory-mapped when loaded.")
 
     # Model options.
     parser.add_argument("--batch_size", type=int, default=1,
@@ -240,11 +395,44 @@ def main():
                         help="Specific steps to print prompt.")
     parser.add_argument("--seed", type=int, default=7,
                         help="Random seed.")
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32",
+                        help="Precision of the forward passes in training and inference. bf16 runs on CPU and CUDA, "
+                             "fp16 runs on CUDA only with gradient scaling. Parameters are kept in fp32.")
 
     # Evaluation options.
     parser.add_argument("--mean_reciprocal_rank", action="store_true", help="Evaluation metrics for DBQA dataset.")
     parser.add_argument("--fast_mode", dest='fast_mode', action='store_true', help="Whether turn on fast mode")
+    parser.add_argument("--eval_batch_size", type=int, default=64,
+                        help="Batch size of evaluation. Samples exit one by one within a batch in fast mode.")
     parser.add_argument("--speed", type=float, default=0.5, help="Threshold of Uncertainty, i.e., the Speed in paper.")
+    parser.add_argument("--acc_floor", type=float, default=None,
+                        help="Calibrate per-layer thresholds on the devset to minimize the executed layers "
+                             "while keeping the accuracy above this floor.")
+    parser.add_argument("--layers_budget", type=float, default=None,
+                        help="Calibrate per-layer thresholds on the devset to maximize the accuracy "
+                             "while keeping the average executed layers within this budget.")
+    parser.add_argument("--exit_layers", type=str, default=None,
+                        help="Comma-separated layers (starting from 1) where samples are allowed to exit, e.g., 2,4,6,8,10,12. "
+                             "Classifiers of the other layers are skipped in fast mode. The last layer is always included.")
+    parser.add_argument("--min_exit_rate", type=float, default=None,
+                        help="Only keep the exit layers where at least this rate of devset samples exit.")
+    parser.add_argument("--keep_ratio", type=float, default=1.0,
+                        help="Ratio of the tokens kept after each layer at inference, the tokens receiving "
+                             "the least attention from [CLS] are pruned. Only supported by the bert encoder.")
+    parser.add_argument("--prune_start_layer", type=int, default=1,
+                        help="The first layer (starting from 1) after which tokens are pruned.")
+
+    # Structured pruning options.
+    parser.add_argument("--head_keep_ratio", type=float, default=1.0,
+                        help="Ratio of the attention heads kept in each layer after backbone fine-tuning, "
+                             "the heads are ranked by their importance on the trainset.")
+    parser.add_argument("--ffn_keep_ratio", type=float, default=1.0,
+                        help="Ratio of the feed forward neurons kept in each layer after backbone fine-tuning, "
+                             "the neurons are ranked by their importance on the trainset.")
+    parser.add_argument("--importance_samples_num", type=int, default=1024,
+                        help="Number of training samples the importance of heads and neurons is computed on.")
+    parser.add_argument("--prune_epochs_num", type=int, default=1,
+                        help="Number of epochs the pruned backbone is fine-tuned for before self-distillation.")
 
     args = parser.parse_args()
 
@@ -271,30 +459,28 @@ def main():
     args.labels_num = len(labels_set) 
 
     # Load vocabulary.
-    vocab = Vocab()
-    vocab.load(args.vocab_path)
+    vocab = load_vocab(args.vocab_path)
     args.vocab = vocab
 
     # Build bert model.
-    # A pseudo target is added.
-    args.target = "bert"
-    model = build_model(args)
+    # The classifiers work on the encoder output, no target is needed.
+    args.target = "none"
+    # Parameters are not allocated until they are loaded or initialized.
+    model = build_model(args, meta=True)
 
     # Load or initialize parameters.
     if args.pretrained_model_path is not None:
         # Initialize with pretrained model.
-        model.load_state_dict(torch.load(args.pretrained_model_path), strict=False)  
-    else:
-        # Initialize with normal distribution.
-        for n, p in list(model.named_parameters()):
-            if 'gamma' not in n and 'beta' not in n:
-                p.data.normal_(0, 0.02)
+        model = load_model(model, args.pretrained_model_path)
+    # Initialize the rest with normal distribution.
+    materialize_meta(model)
     
     # Build classification model.
     model = FastBertClassifier(args, model)
 
     # For simplicity, we use DataParallel wrapper to use multiple GPUs.
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    check_precision(args.precision, device)
     if torch.cuda.device_count() > 1:
         print("{} GPUs are available. Let's use them.".format(torch.cuda.device_count()))
         model = nn.DataParallel(model)
@@ -388,6 +574,12 @@ def main():
 
     # Evaluation function.
     def evaluate(args, is_test, fast_mode=False):
+        """
+        Evaluate in normal mode (fast_mode=False), in fast mode (fast_mode=True),
+        or in both modes with a single pass (fast_mode="both"). In the last case,
+        fast mode is simulated on the outputs of all classifiers, and the results
+        of both modes are returned.
+        """
         if is_test:
             dataset = read_dataset(args.test_path)
         else:
@@ -397,145 +589,155 @@ def main():
         label_ids = torch.LongTensor([sample[1] for sample in dataset])
         mask_ids = torch.LongTensor([sample[2] for sample in dataset])
 
-        batch_size = 1
+        batch_size = args.eval_batch_size
         instances_num = input_ids.size()[0]
+        modes = [False, True] if fast_mode == "both" else [fast_mode]
 
         print("The number of evaluation instances: ", instances_num)
-        print("Fast mode: ", fast_mode)
-
-        correct = 0
-        # Confusion matrix.
-        confusion = torch.zeros(args.labels_num, args.labels_num, dtype=torch.long)
 
         model.eval()
-        
-        if not args.mean_reciprocal_rank:
-            total_flops, model_params_num = 0, 0
-            for i, (input_ids_batch, label_ids_batch,  mask_ids_batch) in enumerate(batch_loader(batch_size, input_ids, label_ids, mask_ids)):
-
-                input_ids_batch = input_ids_batch.to(device)
-                label_ids_batch = label_ids_batch.to(device)
-                mask_ids_batch = mask_ids_batch.to(device)
-                with torch.no_grad():
+        classifier = model.module if hasattr(model, "module") else model
+        layers_num = classifier.encoder.layers_num
+        exit_stats = {mode: ExitStats(layers_num) for mode in modes}
+        # FLOPs are counted analytically for transformer encoders only.
+        count_flops = args.encoder in FLOPS_ENCODERS
+        total_flops = {mode: 0.0 for mode in modes}
+        # Probabilities of each mode are written into preallocated buffers.
+        probs_all = {mode: torch.empty(instances_num, args.labels_num) for mode in modes}
+
+        exit_layers = classifier.exit_layers.tolist()
+
+        def record_simulated(stats, exec_layers, logits, entropys):
+            pred = torch.argmax(logits, dim=1)
+            for j in range(layers_num):
+                reached = exec_layers > j
+                uncertainties = entropys[reached, j].cpu().numpy() if exit_layers[j] else None
+                stats.record_layer(j, reached.sum().item(), None, uncertainties)
+                stats.record_exits(j, pred[exec_layers == j + 1].cpu().numpy())
 
-                    # Get FLOPs at this batch
-                    inputs = (input_ids_batch, label_ids_batch, mask_ids_batch, fast_mode)
-                    flops, params = profile(model, inputs, verbose=False)
-                    total_flops += flops
-                    model_params_num = params
-                    
-                    # inference
-                    loss, logits = model(input_ids_batch, label_ids_batch, mask_ids_batch, fast=fast_mode)
-
-                logits = nn.Softmax(dim=1)(logits)
-                pred = torch.argmax(logits, dim=1)
-                gold = label_ids_batch
-                for j in range(pred.size()[0]):
-                    confusion[pred[j], gold[j]] += 1
-                correct += torch.sum(pred == gold).item()
-
-            print("Number of model parameters: {}".format(model_params_num))
-            print("FLOPs per sample in average: {}".format(total_flops / float(instances_num)))
-        
-            if is_test:
-                print("Confusion matrix:")
-                print(confusion)
-                print("Report precision, recall, and f1:")
-            for i in range(confusion.size()[0]):
-                p = confusion[i,i].item()/confusion[i,:].sum().item()
-                r = confusion[i,i].item()/confusion[:,i].sum().item()
-                f1 = 2*p*r / (p+r)
-                if is_test:
-                    print("Label {}: {:.3f}, {:.3f}, {:.3f}".format(i,p,r,f1))
-            print("Acc. (Correct/Total): {:.4f} ({}/{}) ".format(correct/len(dataset), correct, len(dataset)))
-            return correct/len(dataset)
-        else:
-            for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(batch_size, input_ids, label_ids, mask_ids)):
-                input_ids_batch = input_ids_batch.to(device)
-                label_ids_batch = label_ids_batch.to(device)
-                mask_ids_batch = mask_ids_batch.to(device)
-                with torch.no_grad():
-                    loss, logits = model(input_ids_batch, label_ids_batch, mask_ids_batch)
-                logits = nn.Softmax(dim=1)(logits)
-                if i == 0:
-                    logits_all=logits
-                if i >= 1:
-                    logits_all=torch.cat((logits_all,logits),0)
-        
-            order = -1
-            gold = []
-            for i in range(len(dataset)):
-                qid = dataset[i][3]
-                label = dataset[i][1]
-                if qid == order:
-                    j += 1
-                    if label == 1:
-                        gold.append((qid,j))
-                else:
-                    order = qid
-                    j = 0
-                    if label == 1:
-                        gold.append((qid,j))
-
-
-            label_order = []
-            order = -1
-            for i in range(len(gold)):
-                if gold[i][0] == order:
-                    templist.append(gold[i][1])
-                elif gold[i][0] != order:
-                    order=gold[i][0]
-                    if i > 0:
-                        label_order.append(templist)
-                    templist = []
-                    templist.append(gold[i][1])
-            label_order.append(templist)
-
-            order = -1
-            score_list = []
-            for i in range(len(logits_all)):
-                score = float(logits_all[i][1])
-                qid=int(dataset[i][3])
-                if qid == order:
-                    templist.append(score)
+        for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(batch_size, input_ids, label_ids, mask_ids)):
+            input_ids_batch = input_ids_batch.to(device)
+            label_ids_batch = label_ids_batch.to(device)
+            mask_ids_batch = mask_ids_batch.to(device)
+            with torch.no_grad(), autocast(device, args.precision):
+                if len(modes) == 1:
+                    classifier.exit_stats = exit_stats[fast_mode]
+                    outputs = {fast_mode: model(input_ids_batch, label_ids_batch, mask_ids_batch, fast=fast_mode)}
+                    classifier.exit_stats = None
                 else:
-                    order = qid
-                    if i > 0:
-                        score_list.append(templist)
-                    templist = []
-                    templist.append(score)
-            score_list.append(templist)
-
-            rank = []
-            pred = []
-            for i in range(len(score_list)):
-                if len(label_order[i])==1:
-                    if label_order[i][0] < len(score_list[i]):
-                        true_score = score_list[i][label_order[i][0]]
-                        score_list[i].sort(reverse=True)
-                        for j in range(len(score_list[i])):
-                            if score_list[i][j] == true_score:
-                                rank.append(1 / (j + 1))
-                    else:
-                        rank.append(0)
+                    layer_logits = classifier.layer_logits(input_ids_batch, mask_ids_batch)
+                    exec_layers, logits, entropys = classifier.fast_logits(layer_logits)
+                    record_simulated(exit_stats[True], exec_layers, logits, entropys)
+                    outputs = {False: (None, layer_logits[:, -1]), True: (exec_layers, logits)}
+
+            # Input length of each layer of each sample after token pruning.
+            seq_lengths = scheduled_lengths(input_ids_batch.size(1), classifier.keep_ratios,
+                                            (mask_ids_batch > 0).sum(dim=1).cpu().numpy())
+            for mode, (exec_layers, logits) in outputs.items():
+                # Get FLOPs at this batch from the executed layers
+                if exec_layers is None:
+                    exec_layers = torch.full((input_ids_batch.size(0),), layers_num, dtype=torch.long)
+                if count_flops:
+                    total_flops[mode] += fastbert_flops(seq_lengths, exec_layers.cpu().numpy(), args,
+                                                        args.labels_num, classifier.exit_layers.cpu().numpy(),
+                                                        fast=mode).sum()
+                probs_all[mode][i*batch_size: i*batch_size+logits.size(0)] = nn.Softmax(dim=1)(logits).cpu()
+
+        results = []
+        for mode in modes:
+            print("Fast mode: ", mode)
+            print("Number of model parameters: {}".format(sum(p.numel() for p in model.parameters())))
+            if count_flops:
+                print("FLOPs per sample in average: {}".format(total_flops[mode] / float(instances_num)))
+            else:
+                print("FLOPs per sample in average: unavailable for the {} encoder".format(args.encoder))
+            if mode:
+                stats = exit_stats[mode].as_dict()
+                print("Exec layers in average: {:.4f}".format(stats["ave_exec_layers"]))
+                print("Exit counts per layer: {}".format(stats["exit_counts"]))
+                if len(modes) == 1:
+                    print("Wall time per layer (s): {}".format(
+                        ", ".join("{:.4f}".format(t) for t in stats["layer_seconds"])))
+                if is_test:
+                    print("Exit counts per predicted label and layer:")
+                    for label, counts in sorted(stats["label_exit_counts"].items()):
+                        print("Label {}: {}".format(label, counts))
+
+            if not args.mean_reciprocal_rank:
+                # Confusion matrix.
+                pred = torch.argmax(probs_all[mode], dim=1)
+                confusion = confusion_matrix(pred, label_ids, args.labels_num)
+                correct = torch.diagonal(confusion).sum().item()
+                if is_test:
+                    print("Confusion matrix:")
+                    print(confusion)
+                    print("Report precision, recall, and f1:")
+                    precision, recall, f1 = precision_recall_f1(confusion)
+                    for i in range(confusion.size()[0]):
+                        print("Label {}: {:.3f}, {:.3f}, {:.3f}".format(i, precision[i].item(), recall[i].item(), f1[i].item()))
+                print("Acc. (Correct/Total): {:.4f} ({}/{}) ".format(correct/len(dataset), correct, len(dataset)))
+                results.append(correct/len(dataset))
+            else:
+                qids = [sample[3] for sample in dataset]
+                MRR = mean_reciprocal_rank(probs_all[mode][:, 1].numpy(), label_ids.numpy(), qids)
+                print("Mean Reciprocal Rank: {:.4f}".format(MRR))
+                results.append(MRR)
 
-                else:
-                    true_rank = len(score_list[i])
-                    for k in range(len(label_order[i])):
-                        if label_order[i][k] < len(score_list[i]):
-                            true_score = score_list[i][label_order[i][k]]
-                            temp = sorted(score_list[i],reverse=True)
-                            for j in range(len(temp)):
-                                if temp[j] == true_score:
-                                    if j < true_rank:
-                                        true_rank = j
-                    if true_rank < len(score_list[i]):
-                        rank.append(1 / (true_rank + 1))
-                    else:
-                        rank.append(0)
-            MRR = sum(rank) / len(rank)
-            print("Mean Reciprocal Rank: {:.4f}".format(MRR))
-            return MRR
+        return results[0] if len(results) == 1 else tuple(results)
+
+    # Collect the uncertainty and correctness of every classifier on the devset.
+    def collect(args):
+        dataset = read_dataset(args.dev_path)
+
+        input_ids = torch.LongTensor([sample[0] for sample in dataset])
+        label_ids = torch.LongTensor([sample[1] for sample in dataset])
+        mask_ids = torch.LongTensor([sample[2] for sample in dataset])
+
+        classifier = model.module if hasattr(model, "module") else model
+        classifier.eval()
+
+        uncertainties, corrects = [], []
+        for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(args.eval_batch_size, input_ids, label_ids, mask_ids)):
+            input_ids_batch = input_ids_batch.to(device)
+            label_ids_batch = label_ids_batch.to(device)
+            mask_ids_batch = mask_ids_batch.to(device)
+            with torch.no_grad(), autocast(device, args.precision):
+                logits = classifier.layer_logits(input_ids_batch, mask_ids_batch)
+            probs = nn.Softmax(dim=-1)(logits)
+            uncertainties.append(normal_shannon_entropy(probs, args.labels_num).cpu())
+            corrects.append((torch.argmax(probs, dim=-1) == label_ids_batch.unsqueeze(1)).cpu())
+        return torch.cat(uncertainties).numpy(), torch.cat(corrects).numpy()
+
+    # Prune the least important heads and feed forward neurons of the backbone,
+    # scored on a subset of the trainset by the loss of the teacher classifier,
+    # so that the devset is left for model selection after pruning.
+    def prune_backbone(args, input_ids, label_ids, mask_ids):
+        input_ids = input_ids[:args.importance_samples_num]
+        label_ids = label_ids[:args.importance_samples_num]
+        mask_ids = mask_ids[:args.importance_samples_num]
+
+        classifier = model.module if hasattr(model, "module") else model
+        assert hasattr(classifier.encoder, "transformer"), "Only transformer encoders can be pruned."
+        importance = TaylorImportance(list(classifier.encoder.transformer))
+
+        # Dropout is off, but the gradients are needed.
+        model.eval()
+        for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(args.eval_batch_size, input_ids, label_ids, mask_ids)):
+            model.zero_grad()
+            input_ids_batch = input_ids_batch.to(device)
+            label_ids_batch = label_ids_batch.to(device)
+            mask_ids_batch = mask_ids_batch.to(device)
+            _, logits = model(input_ids_batch, label_ids_batch, mask_ids_batch, fast=False)
+            loss = classifier.criterion(classifier.softmax(logits), label_ids_batch)
+            loss.backward()
+            importance.accumulate()
+        model.zero_grad()
+
+        args.heads_num, args.feedforward_size = importance.prune(args.head_keep_ratio, args.ffn_keep_ratio)
+        if args.per_head_size is None:
+            args.per_head_size = classifier.encoder.transformer[0].self_attn.per_head_size
+        print("Heads per layer: {}".format(args.heads_num))
+        print("Feed forward size per layer: {}".format(args.feedforward_size))
 
     # Training phase.
     print("Start training.")
@@ -553,55 +755,87 @@ def main():
     print("Batch size: ", batch_size)
     print("The number of training instances:", instances_num)
 
-    param_optimizer = list(model.named_parameters())
-    no_decay = ['bias', 'gamma', 'beta']
-    optimizer_grouped_parameters = [
-                {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
-                {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
-    ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, correct_bias=False)
-    scheduler = WarmupLinearSchedule(optimizer, warmup_steps=train_steps*args.warmup, t_total=train_steps)
-   
-    # traning main part of model
-    print("Start fine-tuning the backbone of the model.")
-    total_loss = 0.
-    result = 0.0
-    best_result = 0.0 
-    for epoch in range(1, args.epochs_num+1):
-        model.train()
-        for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(batch_size, input_ids, label_ids, mask_ids)):
-            model.zero_grad()
+    # Fine-tune the backbone with the teacher classifier, and save the best model on the devset.
+    # The optimizer is built here, as pruning replaces the parameters.
+    def fine_tune_backbone(epochs_num, stage):
+        steps = int(instances_num * epochs_num / batch_size) + 1
+        param_optimizer = list(model.named_parameters())
+        no_decay = ['bias', 'gamma', 'beta']
+        optimizer_grouped_parameters = [
+                    {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.01},
+                    {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
+        ]
+        optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, correct_bias=False)
+        scheduler = WarmupLinearSchedule(optimizer, warmup_steps=steps*args.warmup, t_total=steps)
+
+        # Losses are scaled for fp16 only.
+        scaler = grad_scaler(device, args.precision)
+
+        total_loss = 0.
+        result = 0.0
+        best_result = 0.0 
+        for epoch in range(1, epochs_num+1):
+            model.train()
+            for i, (input_ids_batch, label_ids_batch, mask_ids_batch) in enumerate(batch_loader(batch_size, input_ids, label_ids, mask_ids)):
+                model.zero_grad()
 
-            input_ids_batch = input_ids_batch.to(device)
-            label_ids_batch = label_ids_batch.to(device)
-            mask_ids_batch = mask_ids_batch.to(device)
+                input_ids_batch = input_ids_batch.to(device)
+                label_ids_batch = label_ids_batch.to(device)
+                mask_ids_batch = mask_ids_batch.to(device)
 
-            loss, _ = model(input_ids_batch, label_ids_batch, mask_ids_batch)  # training
-            if torch.cuda.device_count() > 1:
-                loss = torch.mean(loss)
-            total_loss += loss.item()
-            if (i + 1) % args.report_steps == 0:
-                print("Epoch id: {}, backbone fine-tuning steps: {}, Avg loss: {:.3f}".format(epoch, i+1, total_loss / args.report_steps))
-                total_loss = 0.
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-        result = evaluate(args, False, False)
-        if result > best_result:
-            best_result = result
-            save_model(model, args.output_model_path)
-        else:
-            continue
+                with autocast(device, args.precision):
+                    loss, _ = model(input_ids_batch, label_ids_batch, mask_ids_batch)  # training
+                if torch.cuda.device_count() > 1:
+                    loss = torch.mean(loss)
+                total_loss += loss.item()
+                if (i + 1) % args.report_steps == 0:
+                    print("Epoch id: {}, {} steps: {}, Avg loss: {:.3f}".format(epoch, stage, i+1, total_loss / args.report_steps))
+                    total_loss = 0.
+                backward(loss, scaler)
+                optimizer_step(optimizer, scaler)
+                scheduler.step()
+            result = evaluate(args, False, False)
+            if result > best_result:
+                best_result = result
+                save_model(model, args.output_model_path, flat=args.flat_checkpoint)
+
+    # traning main part of model
+    print("Start fine-tuning the backbone of the model.")
+    fine_tune_backbone(args.epochs_num, "backbone fine-tuning")
 
     # Evaluation phase.
     if args.test_path is not None:
         print("Test set evaluation after bakbone fine-tuning.")
         model = load_model(model, args.output_model_path)
-        print("Test on normal model")
-        evaluate(args, True, False)
         if args.fast_mode:
-            print("Test on Fast mode")
-            evaluate(args, True, args.fast_mode)
+            print("Test on normal model and Fast mode")
+            evaluate(args, True, "both")
+        else:
+            print("Test on normal model")
+            evaluate(args, True, False)
+
+    # Structured pruning of the backbone.
+    if args.head_keep_ratio < 1.0 or args.ffn_keep_ratio < 1.0:
+        print("Start pruning heads and feed forward neurons of the backbone.")
+        model = load_model(model, args.output_model_path)
+        prune_backbone(args, input_ids, label_ids, mask_ids)
+        save_model(model, args.output_model_path, flat=args.flat_checkpoint)
+        output_config_path = args.output_config_path
+        if output_config_path is None:
+            output_config_path = os.path.splitext(args.output_model_path)[0] + ".json"
+        save_hyperparam(args, output_config_path)
+        print("Number of model parameters after pruning: {}".format(sum(p.numel() for p in model.parameters())))
+
+        # The backbone is fixed in self-distillation, so it recovers from pruning here.
+        if args.prune_epochs_num > 0:
+            print("Start fine-tuning the pruned backbone.")
+            fine_tune_backbone(args.prune_epochs_num, "pruned backbone fine-tuning")
+        else:
+            evaluate(args, False, False)
+        if args.test_path is not None:
+            print("Test set evaluation after pruning.")
+            model = load_model(model, args.output_model_path)
+            evaluate(args, True, False)
 
     # Distillate subclassifiers
     print("Start self-distillation for student-classifiers.")
@@ -614,6 +848,7 @@ def main():
     ]
     optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate*10, correct_bias=False)
     scheduler = WarmupLinearSchedule(optimizer, warmup_steps=train_steps*args.warmup, t_total=train_steps)
+    scaler = grad_scaler(device, args.precision)
 
     model = load_model(model, args.output_model_path)
     total_loss = 0.
@@ -628,18 +863,19 @@ def main():
             label_ids_batch = label_ids_batch.to(device)
             mask_ids_batch = mask_ids_batch.to(device)
 
-            loss, _ = model(input_ids_batch, None, mask_ids_batch)  # distillation
+            with autocast(device, args.precision):
+                loss, _ = model(input_ids_batch, None, mask_ids_batch)  # distillation
             if torch.cuda.device_count() > 1:
                 loss = torch.mean(loss)
             total_loss += loss.item()
             if (i + 1) % args.report_steps == 0:
                 print("Epoch id: {}, self-distillation steps: {}, Avg loss: {:.3f}".format(epoch, i+1, total_loss / args.report_steps))
                 total_loss = 0.
-            loss.backward()
-            optimizer.step()
+            backward(loss, scaler)
+            optimizer_step(optimizer, scaler)
             scheduler.step()
         result = evaluate(args, False, args.fast_mode)
-        save_model(model, args.output_model_path) 
+        save_model(model, args.output_model_path, flat=args.flat_checkpoint) 
 
         # Evaluation phase.
         if args.test_path is not None:
@@ -647,6 +883,39 @@ def main():
             model = load_model(model, args.output_model_path)
             evaluate(args, True, args.fast_mode)
 
+    # Calibrate per-layer thresholds and select exit layers.
+    calibrating = args.acc_floor is not None or args.layers_budget is not None
+    if calibrating or args.min_exit_rate is not None:
+        classifier = model.module if hasattr(model, "module") else model
+        uncertainties, corrects = collect(args)
+
+        def calibrate():
+            thresholds = calibrate_thresholds(uncertainties, corrects,
+                                              acc_floor=args.acc_floor,
+                                              layers_budget=args.layers_budget,
+                                              exit_mask=classifier.exit_layers.cpu().numpy())
+            classifier.thresholds.copy_(torch.from_numpy(thresholds))
+            print("Per-layer thresholds: {}".format(", ".join("{:.2f}".format(t) for t in thresholds)))
+
+        if calibrating:
+            print("Start calibrating per-layer thresholds on the devset.")
+            calibrate()
+        if args.min_exit_rate is not None:
+            thresholds = classifier._thresholds()
+            exit_layers = select_exit_layers(uncertainties, thresholds, args.min_exit_rate,
+                                             exit_mask=classifier.exit_layers.cpu().numpy())
+            classifier.exit_layers.copy_(torch.from_numpy(exit_layers))
+            print("Exit layers: {}".format(",".join(str(i + 1) for i in exit_layers.nonzero()[0])))
+            # Thresholds are refitted on the remaining layers.
+            if calibrating:
+                calibrate()
+
+        save_model(model, args.output_model_path, flat=args.flat_checkpoint)
+        evaluate(args, False, True)
+        if args.test_path is not None:
+            print("Test set evaluation with calibrated thresholds and exit layers.")
+            evaluate(args, True, True)
+
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,35 @@
 # -*- encoding:utf-8 -*-
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+class CausalConv1d(nn.Conv1d):
+    """
+    1-D convolution over [batch_size x channels x seq_length] where the
+    output at position t only depends on the inputs up to t. The input is
+    padded with kernel_size - 1 zeros on the left only, so every output
+    position is computed once and the output has the input length.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size):
+        super(CausalConv1d, self).__init__(in_channels, out_channels, kernel_size, padding=0)
+        self._register_load_state_dict_pre_hook(_conv2d_to_conv1d)
+
+    def forward(self, hidden):
+        return super(CausalConv1d, self).forward(F.pad(hidden, (self.kernel_size[0] - 1, 0)))
+
+
+def _conv2d_to_conv1d(state_dict, prefix, *args):
+    # Checkpoints before CausalConv1d store the Conv2d weights of kernel
+    # (kernel_size, emb_size) over 1 channel, or (kernel_size, 1) over hidden_size channels.
+    name = prefix + "weight"
+    weight = state_dict.get(name)
+    if weight is None or weight.dim() != 4:
+        return
+    if weight.size(3) == 1:
+        state_dict[name] = weight[:, :, :, 0].contiguous()
+    else:
+        state_dict[name] = weight[:, 0].transpose(1, 2).contiguous()
 
 
 class CnnEncoder(nn.Module):
@@ -12,29 +41,31 @@ class CnnEncoder(nn.Module):
         self.emb_size = args.emb_size
         self.hidden_size = args.hidden_size
 
-        self.conv_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
+        self.conv_1 = CausalConv1d(args.emb_size, args.hidden_size, args.kernel_size)
 
-        self.conv = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+        self.conv = nn.ModuleList([CausalConv1d(args.hidden_size, args.hidden_size, args.kernel_size) \
             for _ in range(args.layers_num)])
 
     def forward(self, emb, seg):
-        batch_size, seq_len, _ = emb.size()
-        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
-        emb = torch.cat([padding, emb], dim=1).unsqueeze(1) # batch_size, 1, seq_length+width-1, emb_size
-
-        hidden = self.conv_1(emb)
-
-        padding =  torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(emb.device)
-        hidden = torch.cat([padding, hidden], dim=2)
-
-        for i, conv_i in enumerate(self.conv):
-            hidden = conv_i(hidden)
-            hidden = torch.cat([padding, hidden], dim=2)
-
-        hidden = hidden[:,:,self.kernel_size-1:,:]
-        output = hidden.transpose(1,2).contiguous().view(batch_size, seq_len, self.hidden_size)
-
-        return output
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden.contiguous()
+
+    def init_layer_state(self, emb, seg):
+        return {}
+
+    def layer_forward(self, i, hidden, state):
+        """
+        Layer i runs the i-th convolution, preceded by the
+        embedding convolution at the first layer.
+        """
+        hidden = hidden.transpose(1, 2) # batch_size, hidden_size, seq_length
+        if i == 0:
+            hidden = self.conv_1(hidden)
+        hidden = self.conv[i](hidden)
+        return hidden.transpose(1, 2)
 
 
 class GatedcnnEncoder(nn.Module):
@@ -46,38 +77,36 @@ class GatedcnnEncoder(nn.Module):
         self.emb_size = args.emb_size
         self.hidden_size = args.hidden_size
 
-        self.conv_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
-        self.gate_1 = nn.Conv2d(1, args.hidden_size, (args.kernel_size, args.emb_size))
+        self.conv_1 = CausalConv1d(args.emb_size, args.hidden_size, args.kernel_size)
+        self.gate_1 = CausalConv1d(args.emb_size, args.hidden_size, args.kernel_size)
 
-        self.conv = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+        self.conv = nn.ModuleList([CausalConv1d(args.hidden_size, args.hidden_size, args.kernel_size) \
             for _ in range(args.layers_num-1)])
-        self.gate = nn.ModuleList([nn.Conv2d(args.hidden_size, args.hidden_size, (args.kernel_size, 1)) \
+        self.gate = nn.ModuleList([CausalConv1d(args.hidden_size, args.hidden_size, args.kernel_size) \
             for _ in range(args.layers_num-1)])
 
     def forward(self, emb, seg):
-        batch_size, seq_len, _ = emb.size()
-
-        res_input = torch.transpose(emb.unsqueeze(3), 1, 2)
-
-        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
-        emb = torch.cat([padding, emb], dim=1).unsqueeze(1) # batch_size, 1, seq_length+width-1, emb_size
-
-        hidden = self.conv_1(emb)
-        gate = self.gate_1(emb)
-        hidden = hidden * torch.sigmoid(gate)
-
-        padding = torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(emb.device)
-        hidden = torch.cat([padding, hidden], dim=2)
-
-        for i, (conv_i, gate_i) in enumerate(zip(self.conv, self.gate)):
-            hidden, gate = conv_i(hidden), gate_i(hidden)
-            hidden = hidden * torch.sigmoid(gate)
-            if (i + 1) % self.block_size:
-                hidden = hidden + res_input
-                res_input = hidden
-            hidden = torch.cat([padding, hidden], dim=2)
-
-        hidden = hidden[:,:,self.kernel_size-1:,:]
-        output = hidden.transpose(1,2).contiguous().view(batch_size, seq_len, self.hidden_size)
-
-        return output
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden.contiguous()
+
+    def init_layer_state(self, emb, seg):
+        # The input of the residual connections.
+        return {"res_input": emb.transpose(1, 2)}
+
+    def layer_forward(self, i, hidden, state):
+        """
+        Layer 0 runs the embedding convolution and layer i the (i-1)-th
+        convolution. The residual input in state is updated in place.
+        """
+        hidden = hidden.transpose(1, 2) # batch_size, hidden_size, seq_length
+        if i == 0:
+            hidden = self.conv_1(hidden) * torch.sigmoid(self.gate_1(hidden))
+        else:
+            hidden = self.conv[i-1](hidden) * torch.sigmoid(self.gate[i-1](hidden))
+            if i % self.block_size:
+                hidden = hidden + state["res_input"]
+                state["res_input"] = hidden
+        return hidden.transpose(1, 2)
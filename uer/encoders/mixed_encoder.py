@@ -1,6 +1,7 @@
 # -*- encoding:utf-8 -*-
 import torch
 import torch.nn as nn
+from uer.utils.misc import *
 
 
 class RcnnEncoder(nn.Module):
@@ -12,11 +13,8 @@ class RcnnEncoder(nn.Module):
         self.kernel_size = args.kernel_size
         self.layers_num = args.layers_num
 
-        self.rnn = nn.LSTM(input_size=args.emb_size,
-                           hidden_size=args.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True)
+        # One single-layer LSTM per layer, so that the layers can be run one by one.
+        self.rnn = stacked_rnn(nn.LSTM, args.emb_size, args.hidden_size, args.layers_num)
 
         self.drop = nn.Dropout(args.dropout)
 
@@ -25,17 +23,33 @@ class RcnnEncoder(nn.Module):
             for _ in range(args.layers_num-1)])
 
     def forward(self, emb, seg):
-        batch_size, seq_len, _ = emb.size()
-
-        hidden = self.init_hidden(batch_size, emb.device)
-        output, hidden = self.rnn(emb, hidden) 
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        return {"lengths": seq_lengths(seg)}
+
+    def layer_forward(self, i, hidden, state):
+        """
+        Layer i runs the i-th LSTM layer, the convolutions
+        follow the LSTM layers and run at the last layer.
+        """
+        init_hidden = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output = run_packed(self.rnn[i], hidden, state["lengths"], init_hidden)
         output = self.drop(output)
+        if i == self.layers_num - 1:
+            output = self.convolve(output)
+        return output
 
-        
-        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
+    def convolve(self, output):
+        batch_size, seq_len, _ = output.size()
+        padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(output.device)
         hidden = torch.cat([padding, output], dim=1).unsqueeze(1) # batch_size, 1, seq_length+width-1, emb_size
         hidden = self.conv_1(hidden)
-        padding =  torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(emb.device)
+        padding =  torch.zeros([batch_size, self.hidden_size, self.kernel_size-1, 1]).to(output.device)
         hidden = torch.cat([padding, hidden], dim=2)
         for i, conv_i in enumerate(self.conv):
             hidden = conv_i(hidden)
@@ -45,9 +59,9 @@ class RcnnEncoder(nn.Module):
 
         return output
 
-    def init_hidden(self, batch_size, device):
-        return (torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device),
-                torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device))
+    def init_hidden(self, batch_size, device, dtype=torch.float):
+        zeros = cached_zeros(self, (1, batch_size, self.hidden_size), device, dtype)
+        return (zeros, zeros)
 
 
 class CrnnEncoder(nn.Module):
@@ -64,14 +78,33 @@ class CrnnEncoder(nn.Module):
             for _ in range(args.layers_num-1)])
 
 
-        self.rnn = nn.LSTM(input_size=args.emb_size,
-                           hidden_size=args.hidden_size,
-                           num_layers=args.layers_num,
-                           dropout=args.dropout,
-                           batch_first=True)
+        # One single-layer LSTM per layer, so that the layers can be run one by one.
+        self.rnn = stacked_rnn(nn.LSTM, args.emb_size, args.hidden_size, args.layers_num)
         self.drop = nn.Dropout(args.dropout)
 
     def forward(self, emb, seg):
+        state = self.init_layer_state(emb, seg)
+        hidden = emb
+        for i in range(self.layers_num):
+            hidden = self.layer_forward(i, hidden, state)
+        return hidden
+
+    def init_layer_state(self, emb, seg):
+        return {"lengths": seq_lengths(seg)}
+
+    def layer_forward(self, i, hidden, state):
+        """
+        Layer i runs the i-th LSTM layer, the convolutions
+        precede the LSTM layers and run at the first layer.
+        """
+        if i == 0:
+            hidden = self.convolve(hidden)
+        init_hidden = self.init_hidden(hidden.size(0), hidden.device, hidden.dtype)
+        output = run_packed(self.rnn[i], hidden, state["lengths"], init_hidden)
+        output = self.drop(output)
+        return output
+
+    def convolve(self, emb):
         batch_size, seq_len, _ = emb.size()
         padding = torch.zeros([batch_size, self.kernel_size-1, self.emb_size]).to(emb.device)
         emb = torch.cat([padding, emb], dim=1).unsqueeze(1) # batch_size, 1, seq_length+width-1, emb_size
@@ -84,13 +117,8 @@ class CrnnEncoder(nn.Module):
         hidden = hidden[:,:,self.kernel_size-1:,:]
         output = hidden.transpose(1,2).contiguous().view(batch_size, seq_len, self.hidden_size)
 
-        hidden = self.init_hidden(batch_size, emb.device)
-        output, hidden = self.rnn(output, hidden) 
-        output = self.drop(output)
-
         return output
 
-    def init_hidden(self, batch_size, device):
-        return (torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device),
-                torch.zeros(self.layers_num, batch_size, self.hidden_size, device=device))
-
+    def init_hidden(self, batch_size, device, dtype=torch.float):
+        zeros = cached_zeros(self, (1, batch_size, self.hidden_size), device, dtype)
+        return (zeros, zeros)
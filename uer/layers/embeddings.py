@@ -17,17 +17,56 @@ class BertEmbedding(nn.Module):
         self.position_embedding = nn.Embedding(self.max_length, args.emb_size)
         self.segment_embedding = nn.Embedding(3, args.emb_size)
         self.layer_norm = LayerNorm(args.emb_size)
+        # Sliced for each batch instead of being created and repeated.
+        # It is allocated on cpu even if the model is built on the meta device.
+        self.register_buffer("position_ids", torch.arange(self.max_length, device="cpu").unsqueeze(0),
+                             persistent=False)
+        # Sums of the position and segment embeddings of every (position, segment)
+        # pair, used at inference and rebuilt whenever the embeddings change.
+        self.fused_table = None
+        self.fused_key = None
 
     def forward(self, src, seg):
         word_emb = self.word_embedding(src)
-        pos_emb = self.position_embedding(torch.arange(0, word_emb.size(1), device=word_emb.device, \
-                                          dtype=torch.long).unsqueeze(0).repeat(word_emb.size(0), 1))
-        seg_emb = self.segment_embedding(seg)
+        position_ids = self.position_ids[:, :word_emb.size(1)]
 
-        emb = word_emb + pos_emb + seg_emb
+        if not self.training and not torch.is_grad_enabled():
+            # One lookup of the fused table instead of two lookups and an add.
+            segments_num = self.segment_embedding.num_embeddings
+            fused_emb = nn.functional.embedding(position_ids * segments_num + seg, self.fused_position_segment())
+            emb = word_emb + fused_emb
+        else:
+            pos_emb = self.position_embedding(position_ids)
+            seg_emb = self.segment_embedding(seg)
+            emb = word_emb + pos_emb + seg_emb
         emb = self.dropout(self.layer_norm(emb))
         return emb
 
+    def train(self, mode=True):
+        # Optimizers may update the weights through .data, which is not
+        # tracked by _version, so the table is dropped in training.
+        if mode:
+            self.fused_table = None
+        return super(BertEmbedding, self).train(mode)
+
+    def fused_position_segment(self):
+        """
+        Returns:
+            table: [(max_length * 3) x emb_size] the sum of the embeddings
+                   of position i and segment j at row i * 3 + j.
+        """
+        position_weight = self.position_embedding.weight
+        segment_weight = self.segment_embedding.weight
+        # In-place updates bump _version, and loading may replace the tensors.
+        key = (position_weight.data_ptr(), position_weight._version, position_weight.dtype,
+               segment_weight.data_ptr(), segment_weight._version, segment_weight.dtype)
+        if self.fused_table is None or self.fused_key != key:
+            with torch.no_grad():
+                table = position_weight.unsqueeze(1) + segment_weight.unsqueeze(0)
+                self.fused_table = table.view(-1, table.size(-1))
+            self.fused_key = key
+        return self.fused_table
+
 
 class WordEmbedding(nn.Module):
     """
@@ -1,10 +1,19 @@
 # -*- encoding:utf-8 -*-
 import torch
+from uer.utils.checkpoint import is_flat_checkpoint, load_flat_state_dict, assign_state_dict, is_meta_model
 
 
 def load_model(model, model_path):
     if hasattr(model, "module"):
-        model.module.load_state_dict(torch.load(model_path, map_location='cpu'), strict=False)
+        target = model.module
     else:
-        model.load_state_dict(torch.load(model_path, map_location='cpu'), strict=False)
+        target = model
+    if is_flat_checkpoint(model_path):
+        # Parameters are assigned as views of the memory-mapped checkpoint.
+        assign_state_dict(target, load_flat_state_dict(model_path))
+    elif is_meta_model(target):
+        # Meta parameters can only be replaced, not copied into.
+        assign_state_dict(target, torch.load(model_path, map_location='cpu'))
+    else:
+        target.load_state_dict(torch.load(model_path, map_location='cpu'), strict=False)
     return model
@@ -1,9 +1,15 @@
 # -*- encoding:utf-8 -*-
 import torch
+from uer.utils.checkpoint import save_flat_state_dict, atomic_write
 
 
-def save_model(model, model_path):
+def save_model(model, model_path, flat=False):
     if hasattr(model, "module"):
-        torch.save(model.module.state_dict(), model_path)
+        state_dict = model.module.state_dict()
     else:
-        torch.save(model.state_dict(), model_path)
+        state_dict = model.state_dict()
+    if flat:
+        save_flat_state_dict(state_dict, model_path)
+    else:
+        # The tensors may be mapped from the file being replaced.
+        atomic_write(model_path, lambda tmp_path: torch.save(state_dict, tmp_path))
@@ -10,7 +10,7 @@ class Model(nn.Module):
     BertModel consists of three parts:
         - embedding: token embedding, position embedding, segment embedding
         - encoder: multi-layer transformer encoders
-        - target: mlm and nsp tasks
+        - target: mlm and nsp tasks, None for encoder-only models
     """
     def __init__(self, args, embedding, encoder, target, subencoder = None):
         super(Model, self).__init__()
@@ -23,6 +23,10 @@ class Model(nn.Module):
             self.vocab, self.sub_vocab = args.vocab, args.sub_vocab
             self.subword_type = args.subword_type
             self.subencoder = subencoder
+            # Sub ids of every word, looked up by word ids in forward.
+            sub_table, sub_lengths = build_sub_table(self.vocab, self.sub_vocab, self.subword_type)
+            self.register_buffer("sub_table", sub_table, persistent=False)
+            self.register_buffer("sub_lengths", sub_lengths, persistent=False)
         else:
             self.subencoder = None
 
@@ -32,11 +36,14 @@ class Model(nn.Module):
         emb = self.embedding(src, seg) 
 
         if self.subencoder is not None:
-            sub_ids = word2sub(src, self.vocab, self.sub_vocab, self.subword_type)
+            sub_ids = word2sub(src, self.sub_table, self.sub_lengths)
             emb = emb + self.subencoder(sub_ids).contiguous().view(*emb.size())
 
         output = self.encoder(emb, seg)            
 
+        if self.target is None:
+            return output
+
         loss_info = self.target(output, tgt)
             
         return loss_info
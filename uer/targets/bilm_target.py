@@ -40,10 +40,7 @@ class BilmTarget(nn.Module):
         output_forward = self.softmax(output_forward)        
         tgt_forward = tgt_forward.contiguous().view(-1,1)
         label_mask_forward = (tgt_forward > 0).float().to(torch.device(output_forward.device))
-        one_hot_forward = torch.zeros(label_mask_forward.size(0),  self.vocab_size). \
-           to(torch.device(output_forward.device)). \
-           scatter_(1, tgt_forward, 1.0)
-        numerator_forward = -torch.sum(output_forward * one_hot_forward, 1)
+        numerator_forward = -output_forward.gather(1, tgt_forward).squeeze(1)
         label_mask_forward = label_mask_forward.contiguous().view(-1)
         tgt_forward = tgt_forward.contiguous().view(-1)
         numerator_forward = torch.sum(label_mask_forward * numerator_forward)
@@ -57,10 +54,7 @@ class BilmTarget(nn.Module):
         output_backward = self.softmax(output_backward)
         tgt_backward = tgt_backward.contiguous().view(-1,1)
         label_mask_backward = (tgt_backward > 0).float().to(torch.device(output_backward.device))
-        one_hot_backward = torch.zeros(label_mask_backward.size(0),  self.vocab_size). \
-           to(torch.device(output_backward.device)). \
-           scatter_(1, tgt_backward, 1.0)
-        numerator_backward = -torch.sum(output_backward * one_hot_backward, 1)
+        numerator_backward = -output_backward.gather(1, tgt_backward).squeeze(1)
         label_mask_backward = label_mask_backward.contiguous().view(-1)
         tgt_backward = tgt_backward.contiguous().view(-1)
         numerator_backward = torch.sum(label_mask_backward * numerator_backward)
@@ -37,11 +37,8 @@ class LmTarget(nn.Module):
 
         tgt = tgt.contiguous().view(-1,1)
         label_mask = (tgt > 0).float().to(torch.device(output.device))
-        one_hot = torch.zeros(label_mask.size(0),  self.vocab_size). \
-           to(torch.device(output.device)). \
-           scatter_(1, tgt, 1.0)
-
-        numerator = -torch.sum(output * one_hot, 1)
+        # Negative log-likelihood of the target words, gathered without one-hot vectors.
+        numerator = -output.gather(1, tgt).squeeze(1)
         label_mask = label_mask.contiguous().view(-1)
         tgt = tgt.contiguous().view(-1)
         numerator = torch.sum(label_mask * numerator)
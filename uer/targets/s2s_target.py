@@ -23,24 +23,18 @@ class S2sTarget(nn.Module):
     def forward(self, memory_bank, tgt):
 
         emb = self.embedding_layer(tgt[:, :]) # bactch_size, seq_length, emb_size
-        output = []
         hidden_state = (memory_bank[:,-1,:].unsqueeze(0).contiguous(), memory_bank[:,-1,:].unsqueeze(0).contiguous())
-        for i, emb_i in enumerate(emb.split(1, dim=1)):
-            output_i, hidden_state = self.decoder(emb_i, hidden_state)
-            output.append(self.output_layer(output_i))
-
-        output = torch.cat(output, dim=1)
+        # Teacher forcing, the whole target sequence is decoded in one call.
+        output, _ = self.decoder(emb, hidden_state)
+        output = self.output_layer(output)
 
         output = output.contiguous().view(-1, self.vocab_size)
         output = self.softmax(output)
 
         tgt = tgt.contiguous().view(-1,1)
         label_mask = (tgt > 0).float().to(torch.device(output.device))
-        one_hot = torch.zeros(label_mask.size(0),  self.vocab_size). \
-           to(torch.device(output.device)). \
-           scatter_(1, tgt, 1.0)
-
-        numerator = -torch.sum(output * one_hot, 1)
+        # Negative log-likelihood of the target words, gathered without one-hot vectors.
+        numerator = -output.gather(1, tgt).squeeze(1)
         label_mask = label_mask.contiguous().view(-1)
         tgt = tgt.contiguous().view(-1)
         numerator = torch.sum(label_mask * numerator)
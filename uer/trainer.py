@@ -12,33 +12,31 @@ from torch.nn.parallel import DistributedDataParallel
 
 from uer.model_loader import load_model
 from uer.model_saver import save_model
+from uer.utils.checkpoint import materialize_meta
 from uer.model_builder import build_model
 from uer.utils.optimizers import *
 from uer.utils.data import *
-from uer.utils.vocab import Vocab
+from uer.utils.vocab import load_vocab
 from uer.utils.seed import set_seed
+from uer.utils.precision import check_precision, autocast, grad_scaler, backward, optimizer_step
 
 
 def train_and_validate(args):
     set_seed(args.seed)
 
     # Load vocabulary.
-    vocab = Vocab()
-    vocab.load(args.vocab_path)
+    vocab = load_vocab(args.vocab_path)
     args.vocab = vocab
 
-    # Build model.
-    model = build_model(args)
+    # Build model. Parameters are not allocated until they are loaded or initialized.
+    model = build_model(args, meta=True)
 
     # Load or initialize parameters.
     if args.pretrained_model_path is not None:
         # Initialize with pretrained model.
         model = load_model(model, args.pretrained_model_path) 
-    else:
-        # Initialize with normal distribution.
-        for n, p in list(model.named_parameters()):
-            if 'gamma' not in n and 'beta' not in n:
-                p.data.normal_(0, 0.02)
+    # Initialize the rest with normal distribution.
+    materialize_meta(model)
 
     if args.dist_train:
         # Multiprocessing distributed mode.
@@ -79,6 +77,11 @@ def worker(proc_id, gpu_ranks, args, model):
         torch.cuda.set_device(gpu_id)
         model.cuda(gpu_id)
 
+    # Mixed precision with torch.autocast, losses are scaled for fp16 only.
+    args.precision = getattr(args, "precision", "fp32")
+    check_precision(args.precision, "cpu" if gpu_id is None else "cuda")
+    args.scaler = grad_scaler("cpu" if gpu_id is None else "cuda", args.precision)
+
     # Build optimizer.
     param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'gamma', 'beta']
@@ -128,7 +131,8 @@ def train_bert(args, gpu_id, rank, loader, model, optimizer, scheduler):
             seg = seg.cuda(gpu_id)
         
         # Forward.
-        loss_info = model(src, (tgt_mlm, tgt_nsp), seg)
+        with autocast("cpu" if gpu_id is None else "cuda", args.precision):
+            loss_info = model(src, (tgt_mlm, tgt_nsp), seg)
         loss_mlm, loss_nsp, correct_mlm, correct_nsp, denominator = loss_info
         
          # Backward.
@@ -143,10 +147,10 @@ def train_bert(args, gpu_id, rank, loader, model, optimizer, scheduler):
         done_tokens += src.size(0) * src.size(1)
 
         loss = loss / args.accumulation_steps
-        loss.backward()
+        backward(loss, args.scaler)
 
         if steps % args.accumulation_steps == 0:
-            optimizer.step()
+            optimizer_step(optimizer, args.scaler)
             scheduler.step()
             model.zero_grad()
         
@@ -214,7 +218,8 @@ def train_lm(args, gpu_id, rank, loader, model, optimizer, scheduler):
             seg = seg.cuda(gpu_id)
         
         # Forward.
-        loss_info = model(src, tgt, seg)
+        with autocast("cpu" if gpu_id is None else "cuda", args.precision):
+            loss_info = model(src, tgt, seg)
         loss, correct, denominator = loss_info
         
         # Backward.
@@ -223,10 +228,10 @@ def train_lm(args, gpu_id, rank, loader, model, optimizer, scheduler):
         total_denominator += denominator.item()
 
         loss = loss / args.accumulation_steps
-        loss.backward()
+        backward(loss, args.scaler)
 
         if steps % args.accumulation_steps == 0:
-            optimizer.step()
+            optimizer_step(optimizer, args.scaler)
             scheduler.step()
             model.zero_grad()
         
@@ -286,7 +291,8 @@ def train_bilm(args, gpu_id, rank, loader, model, optimizer, scheduler):
             seg = seg.cuda(gpu_id)
         
         # Forward.
-        loss_info = model(src, (tgt_forward, tgt_backward), seg)
+        with autocast("cpu" if gpu_id is None else "cuda", args.precision):
+            loss_info = model(src, (tgt_forward, tgt_backward), seg)
         loss_forward, loss_backward, correct_forward, correct_backward, denominator = loss_info
         
         # Backward.
@@ -299,10 +305,10 @@ def train_bilm(args, gpu_id, rank, loader, model, optimizer, scheduler):
         total_denominator += denominator.item()
 
         loss = loss / args.accumulation_steps
-        loss.backward()
+        backward(loss, args.scaler)
 
         if steps % args.accumulation_steps == 0:
-            optimizer.step()
+            optimizer_step(optimizer, args.scaler)
             scheduler.step()
             model.zero_grad()
         
@@ -366,7 +372,8 @@ def train_cls(args, gpu_id, rank, loader, model, optimizer, scheduler):
             seg = seg.cuda(gpu_id)
         
         # Forward.
-        loss_info = model(src, tgt, seg)
+        with autocast("cpu" if gpu_id is None else "cuda", args.precision):
+            loss_info = model(src, tgt, seg)
         loss, correct = loss_info
         
         # Backward.
@@ -375,10 +382,10 @@ def train_cls(args, gpu_id, rank, loader, model, optimizer, scheduler):
         total_instances += src.size(0)
 
         loss = loss / args.accumulation_steps
-        loss.backward()
+        backward(loss, args.scaler)
 
         if steps % args.accumulation_steps == 0:
-            optimizer.step()
+            optimizer_step(optimizer, args.scaler)
             scheduler.step()
             model.zero_grad()
         
@@ -440,7 +447,8 @@ def train_mlm(args, gpu_id, rank, loader, model, optimizer, scheduler):
             seg = seg.cuda(gpu_id)
         
         # Forward.
-        loss_info = model(src, tgt, seg)
+        with autocast("cpu" if gpu_id is None else "cuda", args.precision):
+            loss_info = model(src, tgt, seg)
         loss, correct, denominator = loss_info
         
         # Backward.
@@ -449,10 +457,10 @@ def train_mlm(args, gpu_id, rank, loader, model, optimizer, scheduler):
         total_denominator += denominator.item()
 
         loss = loss / args.accumulation_steps
-        loss.backward()
+        backward(loss, args.scaler)
 
         if steps % args.accumulation_steps == 0:
-            optimizer.step()
+            optimizer_step(optimizer, args.scaler)
             scheduler.step()
             model.zero_grad()
         
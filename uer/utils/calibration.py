@@ -0,0 +1,106 @@
+# -*- encoding:utf-8 -*-
+import numpy as np
+
+
+def exit_layers(uncertainties, thresholds, exit_mask=None):
+    """
+    Args:
+        uncertainties: [samples_num x layers_num] normalized entropies of the classifiers.
+        thresholds: [layers_num] a sample exits at the first layer whose uncertainty is at or below
+                    the threshold, the same rule as inference.
+        exit_mask: [layers_num] whether samples are allowed to exit at each layer, all layers by default.
+
+    Returns:
+        exit_idxs: [samples_num] index of the layer where each sample exits.
+    """
+    exits = uncertainties <= thresholds[None, :]
+    if exit_mask is not None:
+        exits &= np.asarray(exit_mask, dtype=bool)[None, :]
+    exits[:, -1] = True
+    return exits.argmax(axis=1)
+
+
+def select_exit_layers(uncertainties, thresholds, min_exit_rate, exit_mask=None):
+    """
+    Keep the layers where at least min_exit_rate of the samples exit.
+    The last layer is always kept.
+
+    Args:
+        uncertainties: [samples_num x layers_num] normalized entropies of the classifiers.
+        thresholds: [layers_num] the threshold of each layer.
+        min_exit_rate: The lowest exit rate of a kept layer.
+        exit_mask: [layers_num] the candidate layers, all layers by default.
+
+    Returns:
+        exit_mask: [layers_num] whether each layer is kept.
+    """
+    uncertainties = np.asarray(uncertainties, dtype=np.float64)
+    samples_num, layers_num = uncertainties.shape
+    exit_idxs = exit_layers(uncertainties, np.asarray(thresholds), exit_mask)
+    exit_rates = np.bincount(exit_idxs, minlength=layers_num) / float(samples_num)
+    exit_mask = exit_rates >= min_exit_rate
+    exit_mask[-1] = True
+    return exit_mask
+
+
+def calibrate_thresholds(uncertainties, corrects, acc_floor=None, layers_budget=None, \
+                         exit_mask=None, grid_size=101, max_sweeps=5):
+    """
+    Fit a separate uncertainty threshold for each layer on a validation set.
+    With acc_floor, the average number of executed layers is minimized while
+    the accuracy stays above the floor. With layers_budget, the accuracy is
+    maximized while the average number of executed layers stays within the budget.
+    Thresholds are searched layer by layer on a grid until no layer changes.
+
+    Args:
+        uncertainties: [samples_num x layers_num] normalized entropies of the classifiers.
+        corrects: [samples_num x layers_num] whether each classifier predicts the gold label.
+        acc_floor: The lowest acceptable accuracy.
+        layers_budget: The largest acceptable average number of executed layers.
+        exit_mask: [layers_num] whether samples are allowed to exit at each layer, all layers by default.
+
+    Returns:
+        thresholds: [layers_num] the threshold of each layer.
+    """
+    assert (acc_floor is None) != (layers_budget is None), \
+        "Exactly one of acc_floor and layers_budget should be given."
+
+    uncertainties = np.asarray(uncertainties, dtype=np.float64)
+    corrects = np.asarray(corrects, dtype=np.float64)
+    samples_num, layers_num = uncertainties.shape
+    rows = np.arange(samples_num)
+    grid = np.linspace(0.0, 1.0, grid_size)
+
+    def score(thresholds):
+        exit_idxs = exit_layers(uncertainties, thresholds, exit_mask)
+        acc = corrects[rows, exit_idxs].mean()
+        layers = (exit_idxs + 1).mean()
+        # Feasible solutions always beat infeasible ones. Infeasible solutions
+        # are ranked by how close they are to the constraint.
+        if acc_floor is not None:
+            if acc >= acc_floor:
+                return (True, -layers, acc)
+            return (False, acc, -layers)
+        else:
+            if layers <= layers_budget:
+                return (True, acc, -layers)
+            return (False, -layers, acc)
+
+    # Start without early exit, i.e., all samples run through all layers.
+    thresholds = np.zeros(layers_num)
+    thresholds[-1] = 1.0
+    best_score = score(thresholds)
+    for _ in range(max_sweeps):
+        changed = False
+        for i in range(layers_num - 1):
+            if exit_mask is not None and not exit_mask[i]:
+                continue
+            for t in grid:
+                trial = thresholds.copy()
+                trial[i] = t
+                trial_score = score(trial)
+                if trial_score > best_score:
+                    thresholds, best_score, changed = trial, trial_score, True
+        if not changed:
+            break
+    return thresholds
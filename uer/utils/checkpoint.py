@@ -0,0 +1,211 @@
+# -*- encoding:utf-8 -*-
+"""
+A flat checkpoint format that can be memory-mapped:
+
+    magic (8 bytes) | header length (8 bytes, little endian)
+    | JSON header | padding | tensor blob
+
+The header maps each tensor name to its dtype, shape, byte offset in the
+blob and byte size. Every tensor starts at an aligned offset, so tensors
+are loaded as views of the mapped file without any copy.
+
+Checkpoints are written to a temporary file and then renamed over the
+target, so a model whose tensors are mapped from a checkpoint can be
+saved to the same path.
+"""
+import collections
+import json
+import mmap
+import os
+import struct
+import tempfile
+import torch
+import torch.nn as nn
+
+
+FLAT_MAGIC = b"UERFLAT1"
+ALIGNMENT = 64
+
+
+def is_flat_checkpoint(path):
+    with open(path, "rb") as f:
+        return f.read(len(FLAT_MAGIC)) == FLAT_MAGIC
+
+
+def save_flat_state_dict(state_dict, path):
+    """
+    Args:
+        state_dict: An ordered dict of tensors.
+        path: Path of the checkpoint.
+    """
+    atomic_write(path, lambda tmp_path: _write_flat_state_dict(state_dict, tmp_path))
+
+
+def atomic_write(path, write):
+    """
+    Call write(tmp_path) on a unique temporary file in the directory of
+    path, and replace path with it. Tensors mapped from the replaced file
+    stay valid, as the mapping keeps its pages alive.
+
+    Args:
+        path: Path of the written file.
+        write: A function writing the file at the given path.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        # mkstemp creates the file readable by the owner only.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _write_flat_state_dict(state_dict, path):
+    tensors = collections.OrderedDict()
+    header = collections.OrderedDict()
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.size()),
+            "offset": offset,
+            "nbytes": nbytes,
+        }
+        tensors[name] = tensor
+        offset += _align(nbytes)
+
+    header = json.dumps(header).encode("utf-8")
+    data_start = _align(len(FLAT_MAGIC) + 8 + len(header))
+    with open(path, "wb") as f:
+        f.write(FLAT_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(b"\0" * (data_start - f.tell()))
+        for name, tensor in tensors.items():
+            if tensor.numel() == 0:
+                continue
+            f.write(memoryview(tensor.view(-1).view(torch.uint8).numpy()))
+            f.write(b"\0" * (_align(f.tell()) - f.tell()))
+
+
+def load_flat_state_dict(path):
+    """
+    Args:
+        path: Path of the checkpoint.
+
+    Returns:
+        state_dict: An ordered dict of tensors backed by a private
+                    (copy-on-write) memory map of the file.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    assert buffer[:len(FLAT_MAGIC)] == FLAT_MAGIC, "{} is not a flat checkpoint.".format(path)
+    header_length = struct.unpack("<Q", buffer[len(FLAT_MAGIC): len(FLAT_MAGIC) + 8])[0]
+    header_start = len(FLAT_MAGIC) + 8
+    header = json.loads(buffer[header_start: header_start + header_length].decode("utf-8"),
+                        object_pairs_hook=collections.OrderedDict)
+    data_start = _align(header_start + header_length)
+
+    state_dict = collections.OrderedDict()
+    for name, meta in header.items():
+        dtype = getattr(torch, meta["dtype"])
+        numel = 1
+        for size in meta["shape"]:
+            numel *= size
+        if numel == 0:
+            state_dict[name] = torch.empty(meta["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + meta["offset"])
+        state_dict[name] = tensor.view(meta["shape"])
+    return state_dict
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Load a state dict into the model like load_state_dict(strict=False),
+    but the parameters and buffers share the memory of the given tensors
+    if possible instead of copying them. Parameter objects are kept, so
+    optimizers built on the model are still valid. Parameters and buffers
+    on the meta device are replaced by the given tensors. The load_state_dict
+    pre-hooks of the modules are applied first, as they convert the entries
+    of older checkpoints.
+
+    Args:
+        model: The model to be loaded.
+        state_dict: An ordered dict of tensors.
+    """
+    state_dict = _apply_load_hooks(model, state_dict)
+    targets = model.state_dict(keep_vars=True)
+    for name, tensor in state_dict.items():
+        if name not in targets:
+            continue
+        target = targets[name]
+        if target.size() != tensor.size():
+            raise RuntimeError("size mismatch for {}: copying a param with shape {} from checkpoint, "
+                               "the shape in current model is {}.".format(name, tensor.size(), target.size()))
+        with torch.no_grad():
+            if target.is_meta:
+                _replace_tensor(model, name, target, tensor.to(target.dtype))
+            elif target.device == tensor.device and target.dtype == tensor.dtype:
+                target.data = tensor
+            else:
+                target.copy_(tensor)
+
+
+def materialize_meta(model, device="cpu"):
+    """
+    Allocate the parameters and buffers left on the meta device, e.g.,
+    those missing in the checkpoint of a model built with meta=True.
+    gamma is initialized with ones, beta with zeros, and the others
+    with N(0, 0.02).
+
+    Args:
+        model: The model to be materialized.
+        device: Device of the allocated tensors.
+    """
+    for name, target in list(model.state_dict(keep_vars=True).items()):
+        if not target.is_meta:
+            continue
+        tensor = torch.empty(target.size(), dtype=target.dtype, device=device)
+        if name.endswith("gamma"):
+            tensor.fill_(1.0)
+        elif name.endswith("beta") or not tensor.is_floating_point():
+            tensor.zero_()
+        else:
+            tensor.normal_(0, 0.02)
+        _replace_tensor(model, name, target, tensor)
+
+
+def is_meta_model(model):
+    return any(t.is_meta for t in model.state_dict(keep_vars=True).values())
+
+
+def _apply_load_hooks(model, state_dict):
+    state_dict = collections.OrderedDict(state_dict)
+    for prefix, module in model.named_modules():
+        prefix = prefix + "." if prefix else ""
+        for hook in module._load_state_dict_pre_hooks.values():
+            hook(state_dict, prefix, {}, False, [], [], [])
+    return state_dict
+
+
+def _replace_tensor(model, name, target, tensor):
+    module_name, _, attr = name.rpartition(".")
+    module = model.get_submodule(module_name) if module_name else model
+    if isinstance(target, nn.Parameter):
+        setattr(module, attr, nn.Parameter(tensor, requires_grad=target.requires_grad))
+    else:
+        module._buffers[attr] = tensor
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
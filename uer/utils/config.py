@@ -9,9 +9,35 @@ def load_hyperparam(args):
     args.hidden_size = param.get("hidden_size", 768)
     args.kernel_size = param.get("kernel_size", 3)
     args.block_size = param.get("block_size", 2)
+    # feedforward_size and heads_num are either shared by all layers or lists of
+    # per-layer values, e.g., of a pruned model, whose per_head_size is given.
     args.feedforward_size = param.get("feedforward_size", 3072)
     args.heads_num = param.get("heads_num", 12)
+    args.per_head_size = param.get("per_head_size", None)
     args.layers_num = param.get("layers_num", 12)
     args.dropout = param.get("dropout", 0.1)
 
     return args
+
+
+def save_hyperparam(args, config_path, keys=("feedforward_size", "heads_num", "per_head_size")):
+    """
+    Save a copy of the config at args.config_path, with the given keys
+    updated from args.
+    """
+    with open(args.config_path, mode="r", encoding="utf-8") as f:
+        param = json.load(f)
+    for key in keys:
+        param[key] = getattr(args, key)
+    with open(config_path, mode="w", encoding="utf-8") as f:
+        json.dump(param, f, indent=4)
+
+
+def layer_param(value, layer):
+    """
+    Value of a hyperparameter at the given layer, where the
+    value is either shared by all layers or a list.
+    """
+    if isinstance(value, (list, tuple)):
+        return value[layer]
+    return value
@@ -0,0 +1,158 @@
+# -*- encoding:utf-8 -*-
+import threading
+import numpy as np
+
+
+class ExitStats(object):
+    """
+    Early exit statistics accumulated batch by batch, including the number
+    of samples exiting at each layer, the wall time of each layer, the
+    histograms of the uncertainties observed at each layer, and the exit
+    distribution of each predicted label.
+    """
+    def __init__(self, layers_num, labels=None, bins_num=10):
+        """
+        Args:
+            layers_num: The number of layers.
+            labels: Names of the labels, label ids are used if None.
+            bins_num: The number of uncertainty histogram bins over [0, 1].
+        """
+        self.layers_num = layers_num
+        self.labels = labels
+        self.bins_num = bins_num
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        # The lock cannot be copied or pickled, a new one is created instead.
+        with self.lock:
+            state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.exit_counts = np.zeros(self.layers_num, dtype=np.int64)
+            self.layer_samples = np.zeros(self.layers_num, dtype=np.int64)
+            self.layer_seconds = np.zeros(self.layers_num, dtype=np.float64)
+            self.uncertainty_hists = np.zeros((self.layers_num, self.bins_num), dtype=np.int64)
+            self.uncertainty_sums = np.zeros(self.layers_num, dtype=np.float64)
+            self.label_exit_counts = {}
+
+    def record_layer(self, layer, samples_num, seconds=None, uncertainties=None):
+        """
+        Args:
+            layer: Index of the layer, starting from 0.
+            samples_num: The number of samples reaching this layer.
+            seconds: Wall time spent on this layer.
+            uncertainties: [samples_num] uncertainties given by the classifier of this layer,
+                           None if the classifier is skipped.
+        """
+        with self.lock:
+            self.layer_samples[layer] += samples_num
+            if seconds is not None:
+                self.layer_seconds[layer] += seconds
+            if uncertainties is not None:
+                uncertainties = np.asarray(uncertainties, dtype=np.float64).reshape(-1)
+                bins = np.clip((uncertainties * self.bins_num).astype(np.int64), 0, self.bins_num - 1)
+                self.uncertainty_hists[layer] += np.bincount(bins, minlength=self.bins_num)
+                self.uncertainty_sums[layer] += uncertainties.sum()
+
+    def record_exits(self, layer, label_ids):
+        """
+        Args:
+            layer: Index of the layer, starting from 0.
+            label_ids: [samples_num] predicted label ids of the samples exiting at this layer.
+        """
+        label_ids = np.asarray(label_ids, dtype=np.int64).reshape(-1)
+        if label_ids.shape[0] == 0:
+            return
+        with self.lock:
+            self.exit_counts[layer] += label_ids.shape[0]
+            for label_id, count in zip(*np.unique(label_ids, return_counts=True)):
+                label = self._label_name(label_id)
+                if label not in self.label_exit_counts:
+                    self.label_exit_counts[label] = np.zeros(self.layers_num, dtype=np.int64)
+                self.label_exit_counts[label][layer] += count
+
+    def as_dict(self):
+        """
+        Returns:
+            stats: A dict of plain python values, the per-layer values are lists indexed by layer.
+        """
+        with self.lock:
+            samples_num = int(self.exit_counts.sum())
+            exec_layers = np.arange(1, self.layers_num + 1)
+            return {
+                "samples_num": samples_num,
+                "ave_exec_layers": float((self.exit_counts * exec_layers).sum()) / samples_num \
+                    if samples_num > 0 else None,
+                "exit_counts": self.exit_counts.tolist(),
+                "layer_samples": self.layer_samples.tolist(),
+                "layer_seconds": self.layer_seconds.tolist(),
+                "uncertainty_bins": np.linspace(0.0, 1.0, self.bins_num + 1).tolist(),
+                "uncertainty_hists": self.uncertainty_hists.tolist(),
+                "label_exit_counts": {label: counts.tolist() \
+                    for label, counts in self.label_exit_counts.items()},
+            }
+
+    def to_prometheus(self, prefix="fastbert"):
+        """
+        Args:
+            prefix: Prefix of the metric names.
+
+        Returns:
+            text: The statistics in Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = []
+
+            def metric(name, metric_type, help_text):
+                lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+                lines.append("# TYPE {}_{} {}".format(prefix, name, metric_type))
+
+            def sample(name, labels, value):
+                labels = ",".join("{}=\"{}\"".format(k, _escape(v)) for k, v in labels)
+                lines.append("{}_{}{{{}}} {}".format(prefix, name, labels, value))
+
+            metric("exits_total", "counter", "Number of samples exiting at each layer.")
+            for i in range(self.layers_num):
+                sample("exits_total", [("layer", i + 1)], self.exit_counts[i])
+
+            metric("layer_samples_total", "counter", "Number of samples reaching each layer.")
+            for i in range(self.layers_num):
+                sample("layer_samples_total", [("layer", i + 1)], self.layer_samples[i])
+
+            metric("layer_seconds_total", "counter", "Wall time spent on each layer.")
+            for i in range(self.layers_num):
+                sample("layer_seconds_total", [("layer", i + 1)], repr(float(self.layer_seconds[i])))
+
+            metric("uncertainty", "histogram", "Uncertainty of the classifier at each layer.")
+            edges = np.linspace(0.0, 1.0, self.bins_num + 1)[1:]
+            for i in range(self.layers_num):
+                cumulative = np.cumsum(self.uncertainty_hists[i])
+                for edge, count in zip(edges, cumulative):
+                    sample("uncertainty_bucket", [("layer", i + 1), ("le", repr(float(edge)))], count)
+                sample("uncertainty_bucket", [("layer", i + 1), ("le", "+Inf")], cumulative[-1])
+                sample("uncertainty_sum", [("layer", i + 1)], repr(float(self.uncertainty_sums[i])))
+                sample("uncertainty_count", [("layer", i + 1)], cumulative[-1])
+
+            metric("label_exits_total", "counter", "Number of samples exiting at each layer by predicted label.")
+            for label, counts in sorted(self.label_exit_counts.items(), key=lambda x: str(x[0])):
+                for i in range(self.layers_num):
+                    sample("label_exits_total", [("label", label), ("layer", i + 1)], counts[i])
+
+            return "\n".join(lines) + "\n"
+
+    def _label_name(self, label_id):
+        if self.labels is None:
+            return int(label_id)
+        return self.labels[label_id]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
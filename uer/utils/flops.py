@@ -0,0 +1,120 @@
+# -*- encoding:utf-8 -*-
+"""
+Analytic FLOPs of the transformer encoder and the FastBERT classifiers.
+Only matrix multiplications are counted, one multiply-accumulate being
+two FLOPs. Element-wise operations such as activations, layer norm and
+softmax are ignored. Other encoders (rnn, cnn, ...) are not covered.
+"""
+import numpy as np
+from uer.utils.config import layer_param
+
+
+# Encoders made of transformer layers, whose FLOPs are counted here.
+FLOPS_ENCODERS = ["bert", "gpt"]
+
+
+def attention_flops(seq_length, hidden_size, query_length=None, inner_size=None):
+    """
+    Args:
+        seq_length: Length of the keys and values.
+        hidden_size: Hidden size of the attention.
+        query_length: Length of the queries, seq_length by default.
+        inner_size: Size of all heads, hidden_size by default.
+
+    Returns:
+        flops: FLOPs of the projections, the attention scores and the weighted sum.
+    """
+    if query_length is None:
+        query_length = seq_length
+    if inner_size is None:
+        inner_size = hidden_size
+    macs = 2 * seq_length * hidden_size * inner_size  # key and value projections
+    macs += 2 * query_length * hidden_size * inner_size  # query and output projections
+    macs += 2 * query_length * seq_length * inner_size  # scores and weighted sum
+    return 2 * macs
+
+
+def transformer_layer_flops(seq_length, hidden_size, feedforward_size, inner_size=None):
+    """
+    Args:
+        seq_length: Length of the input sequence.
+        hidden_size: Hidden size of the layer.
+        feedforward_size: Inner size of the feed forward network.
+        inner_size: Size of all attention heads, hidden_size by default.
+
+    Returns:
+        flops: FLOPs of one transformer layer.
+    """
+    ffn_macs = 2 * seq_length * hidden_size * feedforward_size
+    return attention_flops(seq_length, hidden_size, inner_size=inner_size) + 2 * ffn_macs
+
+
+def classifier_flops(seq_length, hidden_size, labels_num, cla_hidden_size=128, pooling="first"):
+    """
+    Args:
+        seq_length: Length of the input sequence.
+        hidden_size: Hidden size of the encoder.
+        labels_num: The number of labels.
+        cla_hidden_size: Hidden size of the classifier.
+        pooling: Pooling of the classifier, only the first position
+                 is attended from with "first".
+
+    Returns:
+        flops: FLOPs of one FastBERT classifier.
+    """
+    query_length = seq_length if pooling in ["mean", "max", "last"] else 1
+    macs = seq_length * hidden_size * cla_hidden_size
+    macs += cla_hidden_size * cla_hidden_size + cla_hidden_size * labels_num
+    return 2 * macs + attention_flops(seq_length, cla_hidden_size, query_length)
+
+
+def fastbert_flops(seq_length, exec_layers, args, labels_num, exit_mask=None, fast=True,
+                   cla_hidden_size=128):
+    """
+    Args:
+        seq_length: Length of the input sequence, a list of the input
+                    length of each layer, or [samples_num x layers_num]
+                    input lengths of each sample, e.g., from scheduled_lengths.
+        exec_layers: [samples_num] the number of executed layers of each sample.
+        args: Config with hidden_size, feedforward_size, heads_num, layers_num
+              and pooling. feedforward_size and heads_num may be per-layer lists.
+        labels_num: The number of labels.
+        exit_mask: [layers_num] whether the classifier of each layer runs in
+                   fast mode, all layers by default.
+        fast: Whether the classifiers run at every exit layer (fast mode),
+              or only at the last layer (normal mode).
+
+    Returns:
+        flops: [samples_num] FLOPs of each sample.
+    """
+    assert getattr(args, "encoder", "bert") in FLOPS_ENCODERS, \
+        "FLOPs are only counted for the {} encoders.".format("/".join(FLOPS_ENCODERS))
+    layers_num = args.layers_num
+    seq_length = np.asarray(seq_length, dtype=np.float64)
+    if seq_length.ndim == 0:
+        seq_length = np.full(layers_num, seq_length)
+    if seq_length.ndim == 1:
+        # Shared by all samples.
+        seq_length = seq_length[np.newaxis, :]
+    if exit_mask is None:
+        exit_mask = np.ones(layers_num, dtype=bool)
+    if not fast:
+        exit_mask = np.zeros(layers_num, dtype=bool)
+        exit_mask[-1] = True
+
+    pooling = getattr(args, "pooling", "first")
+    per_head_size = getattr(args, "per_head_size", None)
+    layer_flops = np.zeros(seq_length.shape, dtype=np.float64)
+    for i in range(layers_num):
+        inner_size = None
+        if per_head_size is not None:
+            inner_size = layer_param(args.heads_num, i) * per_head_size
+        layer_flops[:, i] = transformer_layer_flops(seq_length[:, i], args.hidden_size,
+                                                    layer_param(args.feedforward_size, i), inner_size)
+        if exit_mask[i]:
+            layer_flops[:, i] += classifier_flops(seq_length[:, i], args.hidden_size, labels_num,
+                                                  cla_hidden_size, pooling)
+    cumulative_flops = np.cumsum(layer_flops, axis=1)
+    exec_layers = np.asarray(exec_layers, dtype=np.int64)
+    rows = np.arange(exec_layers.shape[0]) if cumulative_flops.shape[0] > 1 else 0
+    return cumulative_flops[rows, exec_layers - 1]
@@ -1,4 +1,5 @@
 # -*- encoding:utf-8 -*-
+import re
 import torch
 import torch.nn as nn
 
@@ -19,3 +20,107 @@ def flip(x, dim):
     indices[dim] = torch.arange(x.size(dim) - 1, -1, -1,
                                 dtype=torch.long, device=x.device)
     return x[tuple(indices)]
+
+
+def seq_lengths(seg):
+    """
+    Args:
+        seg: [batch_size x seq_length] segment ids, 0 for padding.
+
+    Returns:
+        lengths: [batch_size] the number of valid positions of each sequence, at least 1.
+    """
+    return (seg > 0).sum(dim=1).clamp(min=1)
+
+
+def reverse_padded(x, lengths):
+    """
+    Reverse each sequence within its valid length, padding positions stay in place.
+
+    Args:
+        x: [batch_size x seq_length x hidden_size]
+        lengths: [batch_size] valid lengths.
+
+    Returns:
+        x: [batch_size x seq_length x hidden_size]
+    """
+    positions = torch.arange(x.size(1), device=x.device).unsqueeze(0)
+    lengths = lengths.to(x.device).unsqueeze(1)
+    indices = torch.where(positions < lengths, lengths - 1 - positions, positions)
+    return x.gather(1, indices.unsqueeze(2).expand_as(x))
+
+
+def run_packed(rnn, emb, lengths, hidden=None):
+    """
+    Run the rnn over the valid positions only, padding positions are zeros in the output.
+
+    Args:
+        rnn: A batch_first nn.RNN/nn.LSTM/nn.GRU.
+        emb: [batch_size x seq_length x input_size]
+        lengths: [batch_size] valid lengths.
+        hidden: Initial state of the rnn.
+
+    Returns:
+        output: [batch_size x seq_length x hidden_size]
+    """
+    packed = nn.utils.rnn.pack_padded_sequence(emb, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    output, _ = rnn(packed, hidden)
+    output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=emb.size(1))
+    return output
+
+
+def cached_zeros(module, size, device, dtype=torch.float):
+    """
+    A zero tensor cached on the module, which is allocated again only
+    when the size, device or dtype changes. It must not be modified.
+    """
+    zeros = getattr(module, "cached_zeros", None)
+    if zeros is None or zeros.size() != torch.Size(size) \
+            or zeros.device != device or zeros.dtype != dtype:
+        zeros = torch.zeros(size, device=device, dtype=dtype)
+        module.cached_zeros = zeros
+    return zeros
+
+
+def select_state(state, idxs):
+    """
+    Select samples from the layer state of an encoder, see init_layer_state.
+
+    Args:
+        state: A dict of tensors whose first dimension is the batch.
+        idxs: [samples_num] indices of the selected samples, or a boolean mask.
+
+    Returns:
+        state: A dict of the selected samples.
+    """
+    return {name: tensor[idxs] for name, tensor in state.items()}
+
+
+def stacked_rnn(rnn_class, input_size, hidden_size, layers_num, bidirectional=False):
+    """
+    A ModuleList of single-layer rnns, so that the layers can be run one by one.
+    Checkpoints of the multi-layer rnn_class are loaded as well.
+    """
+    directions_num = 2 if bidirectional else 1
+    layers = nn.ModuleList([
+        rnn_class(input_size=input_size if i == 0 else hidden_size * directions_num,
+                  hidden_size=hidden_size,
+                  num_layers=1,
+                  batch_first=True,
+                  bidirectional=bidirectional)
+        for i in range(layers_num)
+    ])
+    layers._register_load_state_dict_pre_hook(_split_rnn_layers)
+    return layers
+
+
+def _split_rnn_layers(state_dict, prefix, *args):
+    # A multi-layer rnn names the weights of layer k as weight_ih_l{k}[_reverse],
+    # they are moved to the k-th single-layer rnn.
+    pattern = re.compile(re.escape(prefix) + r"((?:weight|bias)_(?:ih|hh)_l)(\d+)(_reverse)?$")
+    for name in list(state_dict.keys()):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        new_name = "{}{}.{}0{}".format(prefix, match.group(2), match.group(1), match.group(3) or "")
+        state_dict[new_name] = state_dict.pop(name)
@@ -0,0 +1,74 @@
+# -*- encoding:utf-8 -*-
+"""
+Mixed precision with torch.autocast. Parameters and optimizer states
+stay in float32, and matrix multiplications run in bfloat16 on CPU, or
+in float16/bfloat16 on CUDA. Losses scaled by a GradScaler are only
+needed for float16, whose range is too narrow for small gradients.
+"""
+import contextlib
+import torch
+
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def check_precision(precision, device):
+    """
+    Args:
+        precision: One of PRECISIONS.
+        device: torch.device or device string the model runs on.
+    """
+    device_type = torch.device(device).type
+    assert precision in PRECISIONS, \
+        "Unknown precision {}, choose from {}.".format(precision, PRECISIONS)
+    assert precision != "fp16" or device_type == "cuda", \
+        "fp16 autocast requires CUDA, use bf16 on {}.".format(device_type)
+
+
+def autocast(device, precision):
+    """
+    Args:
+        device: torch.device or device string the model runs on.
+        precision: One of PRECISIONS.
+
+    Returns:
+        A context manager running the enclosed forward in the given precision,
+        a no-op for fp32.
+    """
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=AUTOCAST_DTYPES[precision])
+
+
+def grad_scaler(device, precision):
+    """
+    Returns:
+        scaler: A torch.amp.GradScaler("cuda") for fp16 on CUDA, None otherwise.
+            torch.cuda.amp.GradScaler is deprecated since torch 2.3 and only
+            used on torch 2.0-2.2, which lack torch.amp.GradScaler.
+    """
+    if precision == "fp16" and torch.device(device).type == "cuda":
+        if hasattr(torch.amp, "GradScaler"):
+            return torch.amp.GradScaler("cuda")
+        return torch.cuda.amp.GradScaler()
+    return None
+
+
+def backward(loss, scaler=None):
+    if scaler is None:
+        loss.backward()
+    else:
+        scaler.scale(loss).backward()
+
+
+def optimizer_step(optimizer, scaler=None):
+    """
+    Step the optimizer. With a scaler, the gradients are unscaled first,
+    and the step is skipped if they overflow.
+    """
+    if scaler is None:
+        optimizer.step()
+    else:
+        scaler.step(optimizer)
+        scaler.update()
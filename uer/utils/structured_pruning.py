@@ -0,0 +1,125 @@
+# -*- encoding:utf-8 -*-
+"""
+Structured pruning of transformer layers. Attention heads and feed
+forward neurons are scored by the first-order Taylor estimate of the
+loss change when they are removed, and the least important ones are
+sliced out of the nn.Linear weights.
+"""
+import math
+import torch
+import torch.nn as nn
+
+
+class TaylorImportance(object):
+    """
+    Importance of the heads and feed forward neurons of transformer layers,
+    accumulated over batches as |sum(weight * grad)| of their parameters.
+    """
+    def __init__(self, layers):
+        """
+        Args:
+            layers: A list of TransformerLayer.
+        """
+        self.layers = layers
+        self.head_scores = [torch.zeros(layer.self_attn.heads_num) for layer in layers]
+        self.neuron_scores = [torch.zeros(layer.feed_forward.linear_1.out_features) for layer in layers]
+
+    def accumulate(self):
+        """
+        Accumulate the importance from the gradients of the
+        parameters, to be called after the loss is backwarded.
+        """
+        with torch.no_grad():
+            for i, layer in enumerate(self.layers):
+                attn = layer.self_attn
+                # Every output feature of the query, key and value projections
+                # and every input feature of the final projection belongs to a head.
+                contribs = _contribs(attn.final_linear, dim=1)
+                for linear in attn.linear_layers:
+                    contribs = contribs + _contribs(linear, dim=0)
+                contribs = contribs.view(attn.heads_num, attn.per_head_size).sum(dim=1)
+                self.head_scores[i] += contribs.abs().cpu()
+
+                ffn = layer.feed_forward
+                contribs = _contribs(ffn.linear_1, dim=0) + _contribs(ffn.linear_2, dim=1)
+                self.neuron_scores[i] += contribs.abs().cpu()
+
+    def prune(self, head_keep_ratio=1.0, ffn_keep_ratio=1.0):
+        """
+        Keep the most important heads and neurons of each layer, at least one of each.
+
+        Args:
+            head_keep_ratio: Ratio of the kept heads in each layer.
+            ffn_keep_ratio: Ratio of the kept feed forward neurons in each layer.
+
+        Returns:
+            heads_num: [layers_num] the number of heads of each layer.
+            feedforward_size: [layers_num] the feed forward size of each layer.
+        """
+        heads_num, feedforward_size = [], []
+        for i, layer in enumerate(self.layers):
+            heads = _top_idxs(self.head_scores[i], head_keep_ratio)
+            prune_heads(layer.self_attn, heads)
+            self.head_scores[i] = self.head_scores[i][heads]
+            heads_num.append(layer.self_attn.heads_num)
+
+            neurons = _top_idxs(self.neuron_scores[i], ffn_keep_ratio)
+            prune_neurons(layer.feed_forward, neurons)
+            self.neuron_scores[i] = self.neuron_scores[i][neurons]
+            feedforward_size.append(layer.feed_forward.linear_1.out_features)
+        return heads_num, feedforward_size
+
+
+def prune_heads(attn, heads):
+    """
+    Args:
+        attn: A MultiHeadedAttention.
+        heads: [kept_heads_num] indices of the kept heads.
+    """
+    per_head_size = attn.per_head_size
+    heads = heads.to(attn.final_linear.weight.device)
+    idxs = (heads.unsqueeze(1) * per_head_size + torch.arange(per_head_size, device=heads.device)).view(-1)
+    for linear in attn.linear_layers:
+        prune_linear(linear, idxs, dim=0)
+    prune_linear(attn.final_linear, idxs, dim=1)
+    attn.heads_num = heads.size(0)
+    attn.inner_size = heads.size(0) * per_head_size
+
+
+def prune_neurons(ffn, neurons):
+    """
+    Args:
+        ffn: A PositionwiseFeedForward.
+        neurons: [kept_neurons_num] indices of the kept neurons.
+    """
+    neurons = neurons.to(ffn.linear_1.weight.device)
+    prune_linear(ffn.linear_1, neurons, dim=0)
+    prune_linear(ffn.linear_2, neurons, dim=1)
+
+
+def prune_linear(linear, idxs, dim):
+    """
+    Keep the given output (dim=0) or input (dim=1) features of an nn.Linear in place.
+    """
+    with torch.no_grad():
+        weight = linear.weight.index_select(dim, idxs).clone()
+        linear.weight = nn.Parameter(weight, requires_grad=linear.weight.requires_grad)
+        if dim == 0:
+            if linear.bias is not None:
+                linear.bias = nn.Parameter(linear.bias[idxs].clone(), requires_grad=linear.bias.requires_grad)
+            linear.out_features = idxs.size(0)
+        else:
+            linear.in_features = idxs.size(0)
+
+
+def _contribs(linear, dim):
+    # sum(weight * grad) of each output (dim=0) or input (dim=1) feature.
+    contribs = (linear.weight * linear.weight.grad).sum(dim=1 - dim)
+    if dim == 0 and linear.bias is not None:
+        contribs = contribs + linear.bias * linear.bias.grad
+    return contribs
+
+
+def _top_idxs(scores, ratio):
+    kept_num = min(scores.size(0), max(1, int(math.ceil(scores.size(0) * ratio))))
+    return scores.topk(kept_num)[1].sort()[0]
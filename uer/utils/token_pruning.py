@@ -0,0 +1,106 @@
+# -*- encoding:utf-8 -*-
+"""
+Length-adaptive inference: tokens receiving little attention from
+the first ([CLS]) position are dropped between transformer layers.
+"""
+import math
+import numpy as np
+import torch
+
+
+def keep_ratio_schedule(layers_num, keep_ratio, start_layer=1):
+    """
+    Args:
+        layers_num: The number of layers.
+        keep_ratio: Ratio of the tokens kept after each pruned layer.
+        start_layer: Tokens are pruned after this layer (starting from 1)
+                     and every following layer but the last one.
+
+    Returns:
+        ratios: [layers_num] ratio of the tokens kept after each layer, 1.0 for no pruning.
+    """
+    return [keep_ratio if start_layer <= i + 1 < layers_num else 1.0 for i in range(layers_num)]
+
+
+def scheduled_lengths(seq_length, ratios, lengths=None):
+    """
+    The padding of a sequence is processed until the first pruned layer,
+    and only its kept tokens afterwards.
+
+    Args:
+        seq_length: Padded length of the input sequences.
+        ratios: [layers_num] ratios given by keep_ratio_schedule.
+        lengths: [samples_num] the number of tokens of each sequence,
+                 no sequence is shorter than seq_length by default.
+
+    Returns:
+        layer_lengths: [samples_num x layers_num] input length of each layer
+                       for each sequence, [layers_num] if lengths is None.
+    """
+    tokens_num = np.asarray(seq_length if lengths is None else lengths, dtype=np.int64).reshape(-1)
+    current = np.full_like(tokens_num, seq_length)
+    layer_lengths = np.zeros((tokens_num.shape[0], len(ratios)), dtype=np.int64)
+    for i, ratio in enumerate(ratios):
+        layer_lengths[:, i] = current
+        if ratio < 1.0:
+            tokens_num = keep_num(tokens_num, ratio)
+            current = tokens_num
+    return layer_lengths[0].tolist() if lengths is None else layer_lengths
+
+
+def keep_num(tokens_num, ratio):
+    """
+    The number of tokens kept out of tokens_num, either an int or an array.
+    The ceiling is taken in float64 like the per-sample counts of prune_tokens.
+    """
+    if np.isscalar(tokens_num):
+        return max(1, int(math.ceil(tokens_num * ratio)))
+    return np.maximum(1, np.ceil(np.asarray(tokens_num, dtype=np.float64) * ratio)).astype(np.int64)
+
+
+def prune_tokens(hidden, probs, valid, ratio):
+    """
+    Keep the tokens receiving the most attention from the first position,
+    averaged over the heads. The first position is always kept and the
+    kept tokens stay in their original order. Each sequence keeps
+    keep_num of its own tokens, so the result of a sequence does not
+    depend on the other sequences of the batch. The batch is cut to the
+    longest kept sequence, and the rest of the shorter ones is masked.
+
+    Args:
+        hidden: [batch_size x seq_length x hidden_size]
+        probs: [batch_size x heads_num x seq_length x seq_length] attention
+               probabilities of the layer producing hidden.
+        valid: [batch_size x seq_length] whether each position is a token.
+        ratio: Ratio of the kept tokens.
+
+    Returns:
+        hidden: [batch_size x kept_length x hidden_size]
+        valid: [batch_size x kept_length]
+        mask: [batch_size x 1 x 1 x kept_length] attention mask of the kept tokens.
+    """
+    kept_nums = torch.ceil(valid.sum(dim=1).double() * ratio).long().clamp(min=1)
+    kept_length = int(kept_nums.max().item())
+    scores = probs[:, :, 0, :].float().mean(dim=1)
+    scores = scores.masked_fill(~valid, -1.0)
+    scores[:, 0] = 2.0
+    idxs = scores.topk(kept_length, dim=1)[1]
+    # Tokens ranked after the kept number of their sequence are masked.
+    kept = torch.arange(kept_length, device=idxs.device).unsqueeze(0) < kept_nums.unsqueeze(1)
+    idxs, order = idxs.sort(dim=1)
+    kept = kept.gather(1, order)
+
+    hidden = hidden.gather(1, idxs.unsqueeze(2).expand(-1, -1, hidden.size(2)))
+    valid = valid.gather(1, idxs) & kept
+    return hidden, valid, attention_mask(valid)
+
+
+def attention_mask(valid):
+    """
+    Args:
+        valid: [batch_size x seq_length] whether each position is a token.
+
+    Returns:
+        mask: [batch_size x 1 x 1 x seq_length] additive mask broadcast over the queries.
+    """
+    return (1.0 - valid.float()).unsqueeze(1).unsqueeze(1) * -10000.0